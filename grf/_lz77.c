@@ -0,0 +1,193 @@
+/*
+ * Native implementation of the GRF sprite LZ77 compression.
+ *
+ * Follows the greedy algorithm of nml.lz77 exactly so the output is byte-identical
+ * to the nml encoder, but finds matches using hash chains instead of scanning the window.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#define WINDOW_SIZE ((1 << 11) - 1)
+#define MIN_OVERLAP 3
+#define MAX_OVERLAP 15
+#define MAX_LITERAL 0x80
+
+#define HASH_BITS 12
+#define HASH_SIZE (1 << HASH_BITS)
+#define RING_SIZE (1 << 11)
+#define RING_MASK (RING_SIZE - 1)
+
+
+static inline uint32_t hash3(const unsigned char *p)
+{
+    uint32_t v = ((uint32_t)p[0] << 16) | ((uint32_t)p[1] << 8) | p[2];
+    return (v * 2654435761u) >> (32 - HASH_BITS);
+}
+
+
+/*
+ * Positions of every 3-byte sequence in the window, chained in ascending order for each hash
+ * so the first chain entry that matches is the first occurrence in the window (as str.find).
+ * Only the last RING_SIZE positions are kept, older ones are removed from chain heads.
+ */
+typedef struct {
+    int32_t head[HASH_SIZE];
+    int32_t tail[HASH_SIZE];
+    int32_t next[RING_SIZE];
+    Py_ssize_t inserted;
+} Chains;
+
+
+static void chains_insert(Chains *c, const unsigned char *s, Py_ssize_t pos)
+{
+    if (pos >= RING_SIZE) {
+        /* Slot is about to be reused, drop the old position from its chain (it's always the head) */
+        Py_ssize_t old = pos - RING_SIZE;
+        uint32_t oh = hash3(s + old);
+        if (c->head[oh] == old) {
+            c->head[oh] = c->next[old & RING_MASK];
+            if (c->head[oh] < 0)
+                c->tail[oh] = -1;
+        }
+    }
+    uint32_t h = hash3(s + pos);
+    c->next[pos & RING_MASK] = -1;
+    if (c->tail[h] >= 0)
+        c->next[c->tail[h] & RING_MASK] = (int32_t)pos;
+    else
+        c->head[h] = (int32_t)pos;
+    c->tail[h] = (int32_t)pos;
+}
+
+
+static PyObject *lz77_encode(PyObject *self, PyObject *arg)
+{
+    Py_buffer view;
+    if (PyObject_GetBuffer(arg, &view, PyBUF_C_CONTIGUOUS) < 0)
+        return NULL;
+
+    const unsigned char *stream = (const unsigned char *)view.buf;
+    Py_ssize_t stream_len = view.len;
+    if (stream_len > INT32_MAX) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "Sprite data is too large");
+        return NULL;
+    }
+
+    /* Worst case is all literals: one length byte per 128 bytes of data. */
+    Py_ssize_t max_size = stream_len + stream_len / MAX_LITERAL + 1;
+    PyObject *res = PyBytes_FromStringAndSize(NULL, max_size);
+    if (res == NULL) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    Chains *chains = PyMem_RawMalloc(sizeof(Chains));
+    if (chains == NULL) {
+        Py_DECREF(res);
+        PyBuffer_Release(&view);
+        return PyErr_NoMemory();
+    }
+    unsigned char *output = (unsigned char *)PyBytes_AS_STRING(res);
+    Py_ssize_t out = 0;
+
+    Py_ssize_t position = 0;
+    Py_ssize_t literal_start = 0, literal_len = 0;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    memset(chains->head, 0xff, sizeof(chains->head));
+    memset(chains->tail, 0xff, sizeof(chains->tail));
+    chains->inserted = 0;
+
+    while (position < stream_len) {
+        Py_ssize_t overlap_len = 0, overlap_ofs = 0;
+        Py_ssize_t start_pos = position > WINDOW_SIZE ? position - WINDOW_SIZE : 0;
+        Py_ssize_t max_len = stream_len - position;
+        if (max_len > MAX_OVERLAP)
+            max_len = MAX_OVERLAP;
+
+        /* Index every sequence that ends before the current position */
+        while (chains->inserted + MIN_OVERLAP <= position) {
+            chains_insert(chains, stream, chains->inserted);
+            chains->inserted++;
+        }
+
+        if (max_len >= MIN_OVERLAP) {
+            const unsigned char *pat = stream + position;
+            Py_ssize_t j = chains->head[hash3(pat)];
+            while (j >= 0 && j < start_pos)
+                j = chains->next[j & RING_MASK];
+
+            /* Every occurrence of a longer pattern is also an occurrence of the shorter one,
+               so the search for the next length continues from the previous match. */
+            for (Py_ssize_t i = MIN_OVERLAP; i <= max_len; i++) {
+                while (j >= 0 && j <= position - i && memcmp(stream + j, pat, i) != 0)
+                    j = chains->next[j & RING_MASK];
+                if (j < 0 || j > position - i)
+                    break;
+                overlap_ofs = position - j;
+                overlap_len = i;
+            }
+        }
+
+        if (overlap_len > 0) {
+            if (literal_len > 0) {
+                output[out++] = (unsigned char)literal_len;
+                memcpy(output + out, stream + literal_start, literal_len);
+                out += literal_len;
+                literal_len = 0;
+            }
+            output[out++] = (unsigned char)((((-overlap_len) << 3) & 0xFF) | (overlap_ofs >> 8));
+            output[out++] = (unsigned char)(overlap_ofs & 0xFF);
+            position += overlap_len;
+        } else {
+            if (literal_len == 0)
+                literal_start = position;
+            literal_len++;
+            if (literal_len == MAX_LITERAL) {
+                output[out++] = 0;
+                memcpy(output + out, stream + literal_start, literal_len);
+                out += literal_len;
+                literal_len = 0;
+            }
+            position++;
+        }
+    }
+
+    if (literal_len > 0) {
+        output[out++] = (unsigned char)literal_len;
+        memcpy(output + out, stream + literal_start, literal_len);
+        out += literal_len;
+    }
+
+    Py_END_ALLOW_THREADS
+
+    PyMem_RawFree(chains);
+    PyBuffer_Release(&view);
+    if (_PyBytes_Resize(&res, out) < 0)
+        return NULL;
+    return res;
+}
+
+
+static PyMethodDef lz77_methods[] = {
+    {"encode", lz77_encode, METH_O, "Compress sprite data with GRF LZ77 compression."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef lz77_module = {
+    PyModuleDef_HEAD_INIT,
+    "_lz77",
+    "Native GRF sprite compression.",
+    -1,
+    lz77_methods,
+};
+
+
+PyMODINIT_FUNC PyInit__lz77(void)
+{
+    return PyModule_Create(&lz77_module);
+}
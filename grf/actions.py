@@ -1,11 +1,15 @@
 import datetime
+import functools
 import textwrap
 import struct
+import threading
 import pprint
 from abc import abstractmethod
 from typing import NamedTuple, Union, Optional
+from collections import OrderedDict
 from collections.abc import Iterable, Sequence
 
+import numpy as np
 from typeguard import typechecked
 
 
@@ -19,6 +23,8 @@ from .common import TRAIN, RV, SHIP, AIRCRAFT, STATION, RIVER, CANAL, BRIDGE, HO
 
 from .parser import Node, Expr, Value, Var, Temp, Perm, Call, parse_code, OP_INIT, SPRITE_FLAGS
 from .sprites import Action, Sound, FakeAction
+from .va2opt import optimize_code, count_adjusts, get_explicit_registers, is_transparent, reads_last_result, \
+                    get_value_bounds
 from .exceptions import FormatError
 
 
@@ -129,6 +135,11 @@ class ReferenceableAction:
     def __init__(self):
         self.ref_var = None
 
+    def get_merge_key(self):
+        # Content of the action without references (hashable), actions with the same key
+        # and the same references are interchangeable. None if action can't be merged.
+        return None
+
     def _py_ref_id(self, context):
         if self.ref_id is None:
             return ''
@@ -1376,6 +1387,23 @@ class CargoClass:
     # ALL_CARGO_CLASSES   bitmask(CC_SPECIAL) Note: This is already a bitmask, don't use the bitmask(..) function with this.
 
 
+_PACK_B = struct.Struct('<B').pack
+_PACK_SB = struct.Struct('<b').pack
+_PACK_W = struct.Struct('<H').pack
+_PACK_D = struct.Struct('<I').pack
+_PACK_8B = struct.Struct('<8B').pack
+
+# Integer property formats that are encoded with numpy: format -> (dtype, min value, max value)
+_NUMPY_INT_FORMATS = {
+    'B': ('<u1', 0, 0xff),
+    'b': ('<i1', -0x80, 0x7f),
+    'W': ('<u2', 0, 0xffff),
+    'D': ('<u4', 0, 0xffffffff),
+}
+# Properties of fewer ids are faster to encode value by value
+_NUMPY_MIN_COUNT = 16
+
+
 class DefineMultiple(Action):
     def __init__(self, *, feature, first_id, props, count=None):
         assert isinstance(feature, Feature)
@@ -1404,66 +1432,121 @@ class DefineMultiple(Action):
         assert isinstance(value, bytes), (type(value), value)
         return value
 
-    def _encode_value(self, context, value, fmt):
+    def _encode_b(self, context, value):
+        return _PACK_B(value)
+
+    def _encode_sb(self, context, value):
+        return _PACK_SB(value)
+
+    def _encode_w(self, context, value):
+        return _PACK_W(value)
+
+    def _encode_d(self, context, value):
+        return _PACK_D(value)
+
+    def _encode_s(self, context, value):
+        return self._encode_string(value)
+
+    def _encode_l(self, context, value):
+        return self._encode_label(value)
+
+    def _encode_b_ext(self, context, value):
+        return struct.pack('<BH', 255, value)
+
+    def _encode_n_b(self, context, value):
+        if isinstance(value, bytes):
+            if len(value) >= 256:
+                context.format_error(self, f'Too many bytes ({len(value)}) for property format n*B (max 255)')
+            return _PACK_B(len(value)) + value
+        elif isinstance(value, list):
+            if len(value) >= 256:
+                context.format_error(self, f'Too many items ({len(value)}) for property format n*B (max 255)')
+            fail = next((isinstance(x, int) and 0 <= x <= 255 for x in value), None)
+            if fail is not None:
+                context.format_error(self, f'Items should be integers in range(0, 256) for property format n*B (max 255), found {fail}')
+            return _PACK_B(len(value)) + bytes(value)
+        raise RuntimeError(f'Unsupported property format `n*B`')
+
+    def _encode_8_b(self, context, value):
+        if not isinstance(value, tuple):
+            context.format_error(self, f'8*B format value needs to be a tuple')
+        assert len(value) == 8, (len(value), value)
+        return _PACK_8B(*value)
+
+    def _encode_2_l(self, context, value):
+        if not isinstance(value, tuple):
+            context.format_error(self, f'2*L format value needs to be a tuple')
+        assert len(value) == 2, (len(value), value)
+        return self._encode_label(value[0]) + self._encode_label(value[1])
+
+    def _encode_n_l(self, context, value):
+        return bytes((len(value),)) + b''.join(map(self._encode_label, value))
+
+    def _encode_n_w(self, context, value):
+        return struct.pack(f'<H{len(value)}H', len(value), *value)
+
+    # Format -> encoder, resolved once per property instead of once per value
+    _ENCODERS = {
+        'B': _encode_b,
+        'b': _encode_sb,
+        'W': _encode_w,
+        'D': _encode_d,
+        'S': _encode_s,
+        'L': _encode_l,
+        'B*': _encode_b_ext,
+        'n*B': _encode_n_b,
+        '8*B': _encode_8_b,
+        '2*L': _encode_2_l,
+        'n*L': _encode_n_l,
+        'n*W': _encode_n_w,
+    }
+
+    def _get_encoder(self, fmt):
         if isinstance(fmt, Property):
-            return fmt.encode(value)
-        if fmt == 'B': return struct.pack('<B', value)
-        if fmt == 'b': return struct.pack('<b', value)
-        if fmt == 'W': return struct.pack('<H', value)
-        if fmt == 'D': return struct.pack('<I', value)
-        if fmt == 'S': return self._encode_string(value)
-        if fmt == 'L': return self._encode_label(value)
-        if fmt == 'B*': return struct.pack('<BH', 255, value)
-        if fmt == 'n*B':
-            if isinstance(value, bytes):
-                if len(value) >= 256:
-                    context.format_error(self, f'Too many bytes ({len(value)}) for property format n*B (max 255)')
-                return struct.pack('<B', len(value)) + value
-            elif isinstance(value, list):
-                if len(value) >= 256:
-                    context.format_error(self, f'Too many items ({len(value)}) for property format n*B (max 255)')
-                fail = next((isinstance(x, int) and 0 <= x <= 255 for x in value), None)
-                if fail is not None:
-                    context.format_error(self, f'Items should be integers in range(0, 256) for property format n*B (max 255), found {fail}')
-                return struct.pack('<B', len(value)) + bytes(value)
-        if fmt == '8*B':
-            if not isinstance(value, tuple):
-                context.format_error(self, f'8*B format value needs to be a tuple')
-            assert len(value) == 8, (len(value), value)
-            res = bytes()
-            for l in value:
-                res += struct.pack('<B', l)
-            return res
-        if fmt == '2*L':
-            if not isinstance(value, tuple):
-                context.format_error(self, f'2*L format value needs to be a tuple')
-            assert len(value) == 2, (len(value), value)
-            return self._encode_label(value[0]) + self._encode_label(value[1])
-        if fmt == 'n*L':
-            res = bytes((len(value),))
-            for l in value:
-                res += self._encode_label(l)
-            return res
-        if fmt == 'n*W':
-            res = struct.pack('<H', len(value))
-            for i in value:
-                res += struct.pack('<H', i)
-            return res
-        raise RuntimeError(f'Unsupported property format `{fmt}`')
+            return lambda action, context, value: fmt.encode(value)
+        res = self._ENCODERS.get(fmt)
+        if res is None:
+            def res(action, context, value):
+                raise RuntimeError(f'Unsupported property format `{fmt}`')
+        return res
+
+    def _encode_value(self, context, value, fmt):
+        return self._get_encoder(fmt)(self, context, value)
+
+    def _encode_int_column(self, value, fmt):
+        # Encodes all values of a property with a plain integer format at once,
+        # returns None if it can't be done so values are encoded one by one (reporting errors as usual).
+        if not isinstance(fmt, str) or self.count < _NUMPY_MIN_COUNT or not isinstance(value, (list, tuple)):
+            return None
+        dtype, low, high = _NUMPY_INT_FORMATS.get(fmt, (None, None, None))
+        if dtype is None or len(value) < self.count:
+            return None
+        try:
+            arr = np.array(value[:self.count])
+        except (ValueError, TypeError, OverflowError):
+            return None
+        if arr.ndim != 1 or arr.dtype.kind not in 'biu' or arr.min() < low or arr.max() > high:
+            return None
+        return arr.astype(dtype).tobytes()
 
     def get_data(self, context):
-        res = struct.pack('<BBBBBH',
-            0, self.feature.id, len(self.props), self.count, 255, self.first_id)
+        res = bytearray(struct.pack('<BBBBBH',
+            0, self.feature.id, len(self.props), self.count, 255, self.first_id))
         pdict = ACTION0_PROP_DICT[self.feature]
         for prop, value in self.props.items():
             code, fmt = pdict[prop]
-            res += bytes((code,))
+            res.append(code)
+            data = self._encode_int_column(value, fmt)
+            if data is not None:
+                res += data
+                continue
+            encode = self._get_encoder(fmt)
             for i in range(self.count):
                 try:
-                    res += self._encode_value(context, value[i], fmt)
+                    res += encode(self, context, value[i])
                 except Exception as e:
                     raise context.format_error(self, f'Error encoding value {value[i]} for property {prop} with format `{fmt}`: {e}')
-        return res
+        return bytes(res)
 
     def py(self, context):
         def value_func(k, v):
@@ -1728,6 +1811,49 @@ class CodeContext:
     def get_variable_register(self, name):
         return self._variables.get(name)
 
+    def mark_register_used(self, register):
+        # Keep register that is accessed explicitly from being used for temporary values
+        self._used_registers.add(register)
+
+
+# Maximum number of distinct switch programs kept parsed and compiled
+SWITCH_CODE_CACHE_SIZE = 4096
+
+# Compiled switch code by (feature, code, subroutine ids, optimization level), least recently used first
+_compiled_switch_code = OrderedDict()
+_compiled_switch_code_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=SWITCH_CODE_CACHE_SIZE)
+def _parse_switch_code(feature, code, optimization=0):
+    # Parsed AST is shared between all switches with the same code so it must not be modified
+    if optimization > 0:
+        return optimize_code(feature, _parse_switch_code(feature, code), optimization)
+    res = parse_code(feature, code)
+    if res is None:
+        raise RuntimeError('parser error')
+    return res
+
+
+def _compile_switch_code(ast, subroutines, fixed_registers=()):
+    context = CodeContext(subroutines=subroutines, register=0x80)
+    for r in fixed_registers:
+        context.mark_register_used(r)
+    code = ast[0].compile(context)[1]
+    for c in ast[1:]:
+        code += bytes((OP_INIT,))
+        code += c.compile(context)[1]
+    return code
+
+
+def clear_switch_code_cache():
+    """
+    @brief Forget all parsed and compiled switch code.
+    """
+    _parse_switch_code.cache_clear()
+    with _compiled_switch_code_lock:
+        _compiled_switch_code.clear()
+
 
 class Switch(Action, ReferenceableAction, ReferencingAction):
     # TODO Change archaic term "subrotine" to "function"
@@ -1776,39 +1902,80 @@ class Switch(Action, ReferenceableAction, ReferencingAction):
     @property
     def parsed_code(self):
         if self._parsed_code is None:
-            if self.related_scope:
-                feature = {
-                    TRAIN: TRAIN,
-                    RV: RV,
-                    SHIP: SHIP,
-                    AIRCRAFT: AIRCRAFT,
-                    BRIDGE: TOWN,
-                    HOUSE: TOWN,
-                    INDUSTRY_TILE: INDUSTRY,
-                    INDUSTRY: TOWN,
-                    AIRPORT: TOWN,
-                    OBJECT: TOWN,
-                    AIRPORT_TILE: AIRPORT,
-                }[self.feature]
-            else:
-                feature = self.feature
             try:
-                self._parsed_code = parse_code(feature, self.code)
-                if self._parsed_code is None:
-                    raise RuntimeError('parser error')
+                self._parsed_code = _parse_switch_code(self._get_code_feature(), self.code)
             except Exception as e:
                 print('Failed code: \n', self.code)
                 raise
         return self._parsed_code
 
+    def _get_code_feature(self, feature=None):
+        feature = self.feature if feature is None else feature
+        if not self.related_scope:
+            return feature
+        return {
+            TRAIN: TRAIN,
+            RV: RV,
+            SHIP: SHIP,
+            AIRCRAFT: AIRCRAFT,
+            BRIDGE: TOWN,
+            HOUSE: TOWN,
+            INDUSTRY_TILE: INDUSTRY,
+            INDUSTRY: TOWN,
+            AIRPORT: TOWN,
+            OBJECT: TOWN,
+            AIRPORT_TILE: AIRPORT,
+        }[feature]
+
+    # Code analysis for action graph optimizations, feature is only needed if it's not set yet
+
+    def is_transparent(self, feature=None):
+        code_feature = self._get_code_feature(feature)
+        return is_transparent(code_feature, _parse_switch_code(code_feature, self.code))
+
+    def reads_last_result(self, feature=None):
+        code_feature = self._get_code_feature(feature)
+        return reads_last_result(code_feature, _parse_switch_code(code_feature, self.code))
+
+    def get_value_bounds(self, feature=None):
+        code_feature = self._get_code_feature(feature)
+        return get_value_bounds(code_feature, _parse_switch_code(code_feature, self.code))
+
+    def _compile_code(self, optimization=0):
+        # Compiled code only depends on the code itself and ids of the called subroutines
+        # Returns compiled code and the number of bytes and adjusts saved by the optimization
+        subroutines = None
+        if self.subroutines is not None:
+            subroutines = tuple((k, get_ref_id(v)) for k, v in self.subroutines.items())
+        feature = self._get_code_feature()
+        key = (feature, self.code, subroutines, optimization)
+        with _compiled_switch_code_lock:
+            res = _compiled_switch_code.get(key)
+            if res is not None:
+                _compiled_switch_code.move_to_end(key)
+                return res
+
+        code = _compile_switch_code(self.parsed_code, self.subroutines)
+        res = (code, 0, 0)
+        if optimization > 0:
+            ast = _parse_switch_code(feature, self.code, optimization)
+            optimized = _compile_switch_code(ast, self.subroutines, get_explicit_registers(ast))
+            saved_ops = count_adjusts(code) - count_adjusts(optimized)
+            # Estimates aren't perfect, never make code longer
+            if len(optimized) < len(code) or len(optimized) == len(code) and saved_ops > 0:
+                res = (optimized, len(code) - len(optimized), saved_ops)
+
+        with _compiled_switch_code_lock:
+            _compiled_switch_code[key] = res
+            if len(_compiled_switch_code) > SWITCH_CODE_CACHE_SIZE:
+                _compiled_switch_code.popitem(last=False)
+        return res
+
     def get_data(self, context):
-        context = CodeContext(subroutines=self.subroutines, register=0x80)
         res = bytes((0x02, self.feature.id, self.ref_id, 0x8a if self.related_scope else 0x89))
-        ast = self.parsed_code
-        code = ast[0].compile(context)[1]
-        for c in ast[1:]:
-            code += bytes((OP_INIT,))
-            code += c.compile(context)[1]
+        code, saved_bytes, saved_ops = self._compile_code(context.code_optimization)
+        context.code_bytes_saved += saved_bytes
+        context.code_ops_saved += saved_ops
         res += code[:-5]
         res += bytes((code[-5] & ~0x20,))  # mark the end of a chain
         res += code[-4:]
@@ -1828,6 +1995,32 @@ class Switch(Action, ReferenceableAction, ReferencingAction):
         res += struct.pack('<H', get_ref_id(self.default))
         return res
 
+    def get_merge_key(self):
+        subroutines = None if self.subroutines is None else tuple(self.subroutines.keys())
+        return (
+            self.__class__.__name__,
+            self.related_scope,
+            self.code,
+            subroutines,
+            tuple((r.low, r.high) for r in self._ranges),
+        )
+
+    def get_cache_key(self):
+        # Parsing and compiling code is expensive, everything else is cheap
+        subroutines = None
+        if self.subroutines is not None:
+            subroutines = tuple((k, get_ref_id(v)) for k, v in self.subroutines.items())
+        return (
+            self.__class__.__name__,
+            self.feature.id,
+            self.ref_id,
+            self.related_scope,
+            self.code,
+            subroutines,
+            tuple((get_ref_id(r.ref), r.low, r.high) for r in self._ranges),
+            get_ref_id(self.default),
+        )
+
     def py(self, context):
         if '\n' not in self.code:
             code_str = repr(self.code)
@@ -1884,6 +2077,16 @@ class RandomSwitch(Action, ReferenceableAction, ReferencingAction):
     def set_refs(self, refs):
         self.groups = refs
 
+    def get_merge_key(self):
+        return (
+            self.__class__.__name__,
+            self.scope,
+            self.count,
+            self.triggers,
+            self.cmp_all,
+            self.lowest_bit,
+        )
+
     def get_data(self, context):
         atype = {'self': 0x80, 'parent': 0x83, 'relative': 0x84}[self.scope]
         res = bytes((0x02, self.feature.id, self.ref_id, atype))
@@ -0,0 +1,243 @@
+"""
+Static estimate of the in-game cost of action chains.
+
+Walks every chain that starts in `Action3`/`Map` through all reachable switches and random switches
+and calculates the maximum and the average number of evaluated switches, operations and expensive
+variable reads (60+x variables, e.g. var 0x61 that reads another vehicle of the consist) for every
+callback the chain handles. Average assumes every branch of a switch is equally likely.
+
+Switches that only look at the current callback are evaluated for each callback, other switches
+can go to any of their branches. Callback 0 is the graphics (non-callback) resolution.
+Works on the resolved action list (see `BaseNewGRF.resolve_refs`).
+"""
+from .actions import Switch, RandomSwitch, Action3, ReferenceableAction, get_ref_id
+from .common import VEHICLE_FEATURES
+from .parser import OP_TSTO, OP_PSTO
+from .va2eval import Interpreter, CONSTANT_VARS
+
+
+CALLBACK_VAR = 0x0C
+# Callback ids of this many values and more in one range aren't reported individually
+MAX_CALLBACK_RANGE = 16
+
+
+def is_expensive_var(var, param=None):
+    """
+    @brief Check whether reading the variable is expensive for OpenTTD.
+    @param var Variable number.
+    @param param Parameter byte of the variable (variable number for indirect 0x7B reads).
+    @return True for 60+x variables except registers, procedure calls and GRF parameters.
+    """
+    if var == 0x7b:
+        return param is not None and is_expensive_var(param)
+    return 0x60 <= var < 0x7b
+
+
+class ChainCost:
+    """Cost of a chain for one callback, metrics are tuples (maximum, average)."""
+
+    def __init__(self, name, feature, callback, nodes, ops, expensive):
+        self.name = name
+        self.feature = feature
+        self.callback = callback
+        self.nodes = nodes
+        self.ops = ops
+        self.expensive = expensive
+
+    def __repr__(self):
+        return f'ChainCost({self.name!r}, callback=0x{self.callback:02x}, nodes={self.nodes}, ops={self.ops}, expensive={self.expensive})'
+
+
+class _Node:
+    # Decoded switch with the cost of its own code
+    def __init__(self, interpreter, action):
+        self.action = action
+        self.ops = self.expensive = 0
+        self.calls = []
+        self.by_callback = False
+        self.ranges = ()
+        if isinstance(action, RandomSwitch):
+            _, groups = interpreter.decode(action)
+            self.branches = self._unique(interpreter.get_ref(action, g) for g in groups)
+            return
+        related, adjusts, self.ranges, default = interpreter.decode(action)
+        self.by_callback = not related
+        for op, var, param, *_ in adjusts:
+            self.ops += 1
+            self.expensive += is_expensive_var(var, param)
+            if var == 0x7e:
+                kind, called = interpreter.get_ref(action, param)
+                if kind == 'action':
+                    self.calls.append(called)
+            if var not in CONSTANT_VARS and var != CALLBACK_VAR or op in (OP_TSTO, OP_PSTO):
+                self.by_callback = False
+        self.branches = []
+        if self.ranges:
+            self.branches = self._unique(interpreter.get_ref(action, r[0]) for r in self.ranges)
+            self.branches += self._unique([interpreter.get_ref(action, default)], self.branches)
+        self.refs = {r[0]: interpreter.get_ref(action, r[0]) for r in self.ranges}
+        self.default = interpreter.get_ref(action, default)
+
+    @staticmethod
+    def _unique(refs, seen=()):
+        res = []
+        keys = set(id(r[1]) if r[0] == 'action' else r for r in seen)
+        for r in refs:
+            key = id(r[1]) if r[0] == 'action' else r
+            if key not in keys:
+                keys.add(key)
+                res.append(r)
+        return res
+
+
+class Analyzer:
+    def __init__(self, code_optimization=0):
+        """
+        @brief Create an analyzer.
+        @param code_optimization Optimization level the switch code is compiled with.
+        """
+        self._refs = {}
+        self._interpreter = Interpreter(code_optimization=code_optimization, refs=self._refs)
+        self._nodes = {}
+
+    def _get_node(self, action):
+        res = self._nodes.get(id(action))
+        if res is None or res.action is not action:
+            res = self._nodes[id(action)] = _Node(self._interpreter, action)
+        return res
+
+    def _get_branches(self, node, callback):
+        if not node.by_callback or not node.ranges:
+            return node.branches
+        value = self._interpreter.compute(node.action, {CALLBACK_VAR: callback})
+        for ref_id, low, high in node.ranges:
+            if low <= value <= high:
+                return [node.refs[ref_id]]
+        return [node.default]
+
+    def chain_cost(self, action, callback):
+        """
+        @brief Calculate the cost of the chain for one callback.
+        @param action First action of the chain.
+        @param callback Callback id, 0 for graphics.
+        @return Tuple of (maximum, average) tuples for evaluated switches, operations and expensive variable reads.
+        """
+        zero = ((0, 0), (0, 0), (0, 0))
+        costs = {}
+        stack = [(action, False)]
+        while stack:
+            a, expanded = stack.pop()
+            if id(a) in costs:
+                continue
+            node = self._get_node(a)
+            children = [r[1] for r in self._get_branches(node, callback) if r[0] == 'action'] + node.calls
+            deps = [c for c in children if isinstance(c, (Switch, RandomSwitch)) and id(c) not in costs]
+            if deps and not expanded:
+                stack.append((a, True))
+                stack.extend((c, False) for c in deps)
+                continue
+
+            own = [1, node.ops, node.expensive]
+            res = [[x, x] for x in own]
+            for c in node.calls:
+                for m, (cmax, cavg) in zip(res, costs.get(id(c), zero)):
+                    m[0] += cmax
+                    m[1] += cavg
+            branches = self._get_branches(node, callback)
+            if branches:
+                branch_costs = [costs.get(id(r[1]), zero) if r[0] == 'action' else zero for r in branches]
+                for i, m in enumerate(res):
+                    m[0] += max(bc[i][0] for bc in branch_costs)
+                    m[1] += sum(bc[i][1] for bc in branch_costs) / len(branch_costs)
+            costs[id(a)] = tuple(map(tuple, res))
+        return costs[id(action)]
+
+    def get_callbacks(self, action):
+        """
+        @brief Find callbacks that the chain handles separately.
+        @param action First action of the chain.
+        @return Sorted list of callback ids including 0 for graphics.
+        """
+        res = {0}
+        visited = set()
+        stack = [action]
+        while stack:
+            a = stack.pop()
+            if id(a) in visited or not isinstance(a, (Switch, RandomSwitch)):
+                continue
+            visited.add(id(a))
+            node = self._get_node(a)
+            if node.by_callback and len(node.action._ranges) == len(node.ranges):
+                for r in node.action._ranges:
+                    if 0 <= r.low and r.high - r.low < MAX_CALLBACK_RANGE:
+                        res.update(range(r.low, r.high + 1))
+            stack.extend(r[1] for r in node.branches if r[0] == 'action')
+            stack.extend(node.calls)
+        return sorted(res)
+
+    def analyze(self, sprites):
+        """
+        @brief Calculate the cost of every chain in the resolved action list.
+        @param sprites Resolved list of actions.
+        @return List of ChainCost, one for every chain and callback.
+        """
+        res = []
+        self._refs.clear()
+        for s in sprites:
+            if isinstance(s, ReferenceableAction) and s.ref_id is not None:
+                # Direct references point to the last action defined with the id
+                self._refs[s.ref_id] = s
+            if not isinstance(s, Action3):
+                continue
+            ids = s.ids
+            ids_str = f'0x{ids[0]:02x}' if len(ids) == 1 else f'0x{ids[0]:02x}..+{len(ids)}'
+            entries = [('default', s.default)]
+            for cargo, ref in s.maps.items():
+                if cargo == 0xff and s.feature in VEHICLE_FEATURES:
+                    entries.append(('purchase', ref))
+                else:
+                    entries.append((f'cargo {cargo}', ref))
+            for entry, ref in entries:
+                kind, action = self._interpreter.get_ref(None, get_ref_id(ref), ref)
+                if kind != 'action' or not isinstance(action, (Switch, RandomSwitch)):
+                    continue
+                name = f'{s.feature.constant} {ids_str} {entry}'
+                for cb in self.get_callbacks(action):
+                    nodes, ops, expensive = self.chain_cost(action, cb)
+                    res.append(ChainCost(name, s.feature, cb, nodes, ops, expensive))
+        return res
+
+
+def analyze(sprites, code_optimization=0):
+    """
+    @brief Calculate the cost of every chain in the resolved action list, see `Analyzer.analyze`.
+    @param sprites Resolved list of actions.
+    @param code_optimization Optimization level the switch code is compiled with.
+    @return List of ChainCost.
+    """
+    return Analyzer(code_optimization).analyze(sprites)
+
+
+def format_report(costs, limit=None):
+    """
+    @brief Format the cost report, most expensive chains go first.
+    @param costs List of ChainCost.
+    @param limit Maximum number of chains to include, None for all.
+    @return List of lines.
+    """
+    # Callback names are only known for features that have them in the library
+    from .lib.callback import CALLBACKS
+
+    costs = sorted(costs, key=lambda c: (c.ops[0], c.expensive[0], c.nodes[0]), reverse=True)
+    if limit is not None:
+        costs = costs[:limit]
+    res = [f'{"Chain":<32} {"Callback":<28} {"Switches":>12} {"Operations":>12} {"Expensive":>12}']
+    for c in costs:
+        if c.callback == 0:
+            cb_name = 'graphics'
+        else:
+            cb_name = CALLBACKS.get(c.feature, {}).get(c.callback, {}).get('name', '')
+            cb_name = f'0x{c.callback:02x} {cb_name}'.rstrip()
+        metrics = ' '.join(f'{m[0]:>5} /{m[1]:>5.1f}' for m in (c.nodes, c.ops, c.expensive))
+        res.append(f'{c.name:<32} {cb_name:<28} {metrics}')
+    return res
@@ -1,8 +1,17 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import hashlib
 import json
+import mmap
+import os
+import struct
 import sys
 import pickle
+import threading
+import urllib.request
+
+import numpy as np
 
 
 class SpriteCache:
@@ -68,6 +77,20 @@ class SpriteCache:
         self._old_keys = self._new_keys
         self._new_keys = set()
 
+    def prefetch(self, keys):
+        """
+        @brief Prepare entries that will be checked with is_cached (nothing to do for local cache).
+        @param keys Iterable of 16-character hexadecimal strings.
+        """
+        pass
+
+    def keep(self, keys):
+        """
+        @brief Mark cached entries as used so that save doesn't remove them.
+        @param keys Iterable of 16-character hexadecimal strings.
+        """
+        self._new_keys.update(k for k in keys if k in self._index)
+
     @staticmethod
     def hexdigest(hash_data):
         """
@@ -82,7 +105,7 @@ class SpriteCache:
             indent=None,
             separators=(',', ':'),
         ).encode('utf-8')
-        return hashlib.md5(s).hexdigest()[:16]
+        return hashlib.blake2b(s, digest_size=8).hexdigest()
 
     def is_cached(self, hash_key):
         """
@@ -121,3 +144,879 @@ class SpriteCache:
         with open(self.path / str(hash_key), 'wb') as f:
             f.write(data)
         self._index[hash_key] = True
+
+
+class PackedSpriteCache(SpriteCache):
+    """
+    @class PackedSpriteCache
+    @brief A sprite cache that keeps all entries in a single append-only data file.
+
+    Data file (sprites.pack) starts with a header followed by raw sprite data, entries are located
+    by the binary index file (sprites.idx) and read through mmap. Both files share a random generation
+    id so that an index is never used with the wrong data file. Stale entries are removed from the index
+    on save and the data file is compacted once they take more space than live ones.
+    """
+    DATA_MAGIC = b'GRFPACK\x00'
+    INDEX_MAGIC = b'GRFPIDX\x00'
+    VERSION = 1
+    DATA_HEADER = struct.Struct('<8sQ')  # magic, generation
+    INDEX_HEADER = struct.Struct('<8sIQI')  # magic, version, generation, entry count
+    INDEX_ENTRY = struct.Struct('<8sQI')  # key, offset, length
+
+    def __init__(self, path):
+        """
+        @brief Initialize the PackedSpriteCache.
+        @param path Path to the cache directory.
+        """
+        super().__init__(path)
+        self.data_path = self.path / 'sprites.pack'
+        self.index_path = self.path / 'sprites.idx'
+        self._generation = None
+        self._file = None
+        self._mmap = None
+        self._mmap_size = 0
+
+    def _read_index(self):
+        data = self.index_path.read_bytes()
+        magic, version, generation, count = self.INDEX_HEADER.unpack_from(data)
+        if magic != self.INDEX_MAGIC or version != self.VERSION:
+            raise ValueError('unknown index format')
+        if len(data) != self.INDEX_HEADER.size + count * self.INDEX_ENTRY.size:
+            raise ValueError('index is truncated')
+        index = {}
+        for key, offset, length in self.INDEX_ENTRY.iter_unpack(data[self.INDEX_HEADER.size:]):
+            index[key.hex()] = (offset, length)
+        return generation, index
+
+    def _write_index(self):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, self.VERSION, self._generation, len(self._index)))
+            for k, (offset, length) in self._index.items():
+                f.write(self.INDEX_ENTRY.pack(bytes.fromhex(k), offset, length))
+        os.replace(tmp_path, self.index_path)
+
+    def _create_data(self, path):
+        self._generation = int.from_bytes(os.urandom(8), 'little')
+        f = open(path, 'w+b')
+        f.write(self.DATA_HEADER.pack(self.DATA_MAGIC, self._generation))
+        return f
+
+    def _open_data(self):
+        self._file = open(self.data_path, 'r+b')
+        magic, generation = self.DATA_HEADER.unpack(self._file.read(self.DATA_HEADER.size))
+        if magic != self.DATA_MAGIC:
+            raise ValueError('unknown data file format')
+        self._generation = generation
+        self._map_data()
+
+    def _map_data(self):
+        self._file.seek(0, os.SEEK_END)
+        self._mmap_size = self._file.tell()
+        self._mmap = mmap.mmap(self._file.fileno(), self._mmap_size, access=mmap.ACCESS_READ)
+
+    def _close_data(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def load(self, clean_build):
+        """
+        @brief Load the cache index and map the data file.
+        @param clean_build If True, drop all cached data and start fresh.
+        """
+        self._close_data()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index = {}
+        if not clean_build and self.data_path.exists():
+            try:
+                self._open_data()
+                if self.index_path.exists():
+                    generation, index = self._read_index()
+                    if generation != self._generation:
+                        raise ValueError('index doesn\'t match the data file')
+                    self._index = {k: v for k, v in index.items() if v[0] + v[1] <= self._mmap_size}
+            except Exception as e:
+                print(f'WARNING: Error loading sprite cache, starting with empty cache: {e}')
+                self._close_data()
+                self._index = {}
+
+        if self._file is None:
+            self._file = self._create_data(self.data_path)
+            self._map_data()
+        self._old_keys = set(self._index.keys())
+        self._new_keys = set()
+
+    def save(self):
+        """
+        @brief Save the cache index, dropping unused entries and compacting the data file if needed.
+        """
+        for k in self._old_keys - self._new_keys:
+            self._index.pop(k, None)
+        if self._file is None:
+            return
+        self._file.flush()
+        live_size = sum(length for _, length in self._index.values())
+        stale_size = self._file.seek(0, os.SEEK_END) - self.DATA_HEADER.size - live_size
+        if stale_size > live_size:
+            self.compact()
+        else:
+            self._write_index()
+        self._old_keys = self._new_keys
+        self._new_keys = set()
+
+    def compact(self):
+        """
+        @brief Rewrite the data file keeping only the entries present in the index.
+        """
+        self._file.flush()
+        if self._mmap_size < self._file.seek(0, os.SEEK_END):
+            self._mmap.close()
+            self._map_data()
+
+        tmp_path = self.data_path.with_suffix('.tmp')
+        new_index = {}
+        with self._create_data(tmp_path) as f:
+            offset = self.DATA_HEADER.size
+            for k, (old_offset, length) in sorted(self._index.items(), key=lambda x: x[1][0]):
+                f.write(self._mmap[old_offset: old_offset + length])
+                new_index[k] = (offset, length)
+                offset += length
+        self._close_data()
+        os.replace(tmp_path, self.data_path)
+        self._index = new_index
+        self._write_index()
+        self._open_data()
+
+    def get(self, hash_key):
+        """
+        @brief Retrieve cached data for a given hash key.
+        @param hash_key 16-character hexadecimal string.
+        @return Cached data as bytes, or None if not found.
+        """
+        assert isinstance(hash_key, str) and len(hash_key) == 16, hash_key
+        entry = self._index.get(hash_key)
+        if entry is None:
+            return None
+
+        self._new_keys.add(hash_key)
+        offset, length = entry
+        if offset + length <= self._mmap_size:
+            return self._mmap[offset: offset + length]
+        # Added after the file was mapped
+        self._file.flush()
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def set(self, hash_key, data):
+        """
+        @brief Append data to the cache under the given hash key.
+        @param hash_key 16-character hexadecimal string.
+        @param data Data to store (bytes).
+        """
+        assert isinstance(hash_key, str) and len(hash_key) == 16, hash_key
+        self._new_keys.add(hash_key)
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self._index[hash_key] = (offset, len(data))
+
+
+SPRITE_CACHE_BACKENDS = {
+    'files': SpriteCache,
+    'packed': PackedSpriteCache,
+}
+
+
+class FileDigestCache:
+    """
+    @class FileDigestCache
+    @brief Persistent table of resource file content digests.
+
+    Digest of the file is only recomputed when its size or modification time changes so checking
+    unchanged files is as cheap as checking their modification time.
+    """
+    def __init__(self, path):
+        """
+        @brief Initialize the FileDigestCache.
+        @param path Path to the cache directory.
+        """
+        self.path = Path(path)
+        self.index_path = self.path / 'file_digests.json'
+        self._index = {}
+        self._used = {}
+
+    def load(self, clean_build):
+        """
+        @brief Load the digest table.
+        @param clean_build If True, ignore stored digests and hash all files again.
+        """
+        self._index = {}
+        self._used = {}
+        if clean_build or not self.index_path.exists():
+            return
+        try:
+            self._index = json.load(open(self.index_path))
+        except Exception as e:
+            print(f'WARNING: Error loading file digests: {e}')
+
+    def save(self):
+        """
+        @brief Save digests of the files used since load.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        json.dump(self._used, open(self.index_path, 'w'), indent=4)
+
+    def get(self, path):
+        """
+        @brief Get the content digest of a file.
+        @param path Path to the file.
+        @return 32-character hexadecimal string.
+        """
+        path = str(path)
+        st = os.stat(path)
+        entry = self._index.get(path)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+            entry = self._index[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        self._used[path] = entry
+        return entry[2]
+
+
+
+class PixelCache:
+    """
+    @class PixelCache
+    @brief Persistent cache of decoded image pixels stored as memory-mapped NumPy (.npy) files.
+
+    Arrays are keyed by the content digest of the source file, so touching or renaming a file doesn't
+    invalidate them. Digests are only recomputed when file size or modification time changes.
+    Arrays are mapped read-only, regions of them can be used without reading the whole file.
+    Arrays that can't be removed yet (mapped files can't be removed on Windows) are removed by a later save.
+    """
+    def __init__(self, path):
+        """
+        @brief Initialize the PixelCache.
+        @param path Path to the cache directory, arrays are stored in its `pixels` subdirectory.
+        """
+        self.path = Path(path) / 'pixels'
+        self.index_path = self.path / 'index.json'
+        self._index = {}  # path -> [size, mtime_ns, digest]
+        self._stale = set()  # digests of the arrays to remove
+        self._lock = threading.Lock()
+
+    def load(self, clean_build):
+        """
+        @brief Load the index of the cached files.
+        @param clean_build If True, remove all cached arrays.
+        """
+        self._index = {}
+        self._stale = set()
+        if clean_build:
+            self._stale = {p.stem for p in self.path.glob('*.npy')}
+            self._remove_stale()
+            return
+        if not self.index_path.exists():
+            return
+        try:
+            data = json.load(open(self.index_path))
+            self._index = data['files']
+            self._stale = set(data['stale'])
+        except Exception as e:
+            print(f'WARNING: Error loading pixel cache index: {e}')
+
+    def _remove_stale(self):
+        # Arrays that are still mapped (e.g. by the image memory cache) stay stale
+        removed = set()
+        for digest in self._stale:
+            try:
+                self._entry_path(digest).unlink(missing_ok=True)
+            except OSError:
+                continue
+            removed.add(digest)
+        self._stale -= removed
+
+    def save(self):
+        """
+        @brief Save the index and remove arrays of the files that have changed since they were cached.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            index = {}
+            for path, entry in self._index.items():
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                    index[path] = entry
+            used = {e[2] for e in index.values()}
+            self._stale -= used
+            self._remove_stale()
+            data = {'files': index, 'stale': sorted(self._stale)}
+        json.dump(data, open(self.index_path, 'w'), indent=4)
+
+    def _entry_path(self, digest):
+        return self.path / f'{digest}.npy'
+
+    def _get_digest(self, path):
+        st = os.stat(path)
+        with self._lock:
+            entry = self._index.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            if entry is not None and entry[2] != digest:
+                self._stale.add(entry[2])
+            self._index[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def get(self, path):
+        """
+        @brief Map cached pixels of a file.
+        @param path Path to the source file.
+        @return Read-only numpy array or None if the file content isn't cached.
+        """
+        entry_path = self._entry_path(self._get_digest(os.path.abspath(path)))
+        if not entry_path.exists():
+            return None
+        try:
+            return np.asarray(np.load(entry_path, mmap_mode='r', allow_pickle=False))
+        except (OSError, ValueError) as e:
+            print(f'WARNING: Error loading cached pixels of {path}: {e}')
+            return None
+
+    def set(self, path, pixels):
+        """
+        @brief Store decoded pixels of a file.
+        @param path Path to the source file (its content should be the one the pixels were decoded from).
+        @param pixels Numpy array.
+        @return Read-only memory-mapped copy of the stored array, or pixels if they can't be stored.
+        """
+        entry_path = self._entry_path(self._get_digest(os.path.abspath(path)))
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Other processes can be writing the same file, only complete files are renamed into place
+        tmp_path = entry_path.with_name(f'{entry_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, pixels, allow_pickle=False)
+        try:
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            # Broken entry is still mapped somewhere, keep using the decoded pixels
+            tmp_path.unlink(missing_ok=True)
+            return pixels
+        return np.asarray(np.load(entry_path, mmap_mode='r', allow_pickle=False))
+
+
+def _check_key(hash_key):
+    if not isinstance(hash_key, str) or len(hash_key) != 16 or not all(c in '0123456789abcdef' for c in hash_key):
+        raise ValueError(f'Invalid sprite cache key: {hash_key!r}')
+
+
+class DirectoryCacheStore:
+    """
+    @class DirectoryCacheStore
+    @brief Shared sprite cache store in a directory (e.g. on a network drive).
+
+    Entries are stored as separate files in subdirectories named by the first two characters of the key.
+    """
+    def __init__(self, path):
+        """
+        @brief Initialize the DirectoryCacheStore.
+        @param path Path to the shared cache directory.
+        """
+        self.path = Path(path)
+
+    def _entry_path(self, hash_key):
+        _check_key(hash_key)
+        return self.path / hash_key[:2] / hash_key
+
+    def fetch(self, keys):
+        """
+        @brief Get data for several keys.
+        @param keys Iterable of 16-character hexadecimal strings.
+        @return Dict of key -> data for keys present in the store.
+        """
+        res = {}
+        for k in keys:
+            try:
+                res[k] = self._entry_path(k).read_bytes()
+            except FileNotFoundError:
+                pass
+        return res
+
+    def store(self, hash_key, data):
+        """
+        @brief Add data to the store.
+        @param hash_key 16-character hexadecimal string.
+        @param data Data to store (bytes).
+        """
+        path = self._entry_path(hash_key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{hash_key}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+
+class HTTPCacheStore:
+    """
+    @class HTTPCacheStore
+    @brief Shared sprite cache store on an HTTP server (see grf.cache_server).
+
+    Keys are fetched in batches with `POST <url>/fetch` (body is concatenated binary keys, response is
+    a sequence of key, uint32 length, data records for found entries) and stored with `PUT <url>/sprites/<key>`.
+    """
+    RECORD_HEADER = struct.Struct('<8sI')
+
+    def __init__(self, url, timeout=30):
+        """
+        @brief Initialize the HTTPCacheStore.
+        @param url Base URL of the cache server.
+        @param timeout Timeout for HTTP requests in seconds.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    @classmethod
+    def encode_records(cls, entries):
+        return b''.join(cls.RECORD_HEADER.pack(bytes.fromhex(k), len(data)) + data for k, data in entries.items())
+
+    @classmethod
+    def decode_records(cls, data):
+        res = {}
+        pos = 0
+        while pos < len(data):
+            key, length = cls.RECORD_HEADER.unpack_from(data, pos)
+            pos += cls.RECORD_HEADER.size
+            if pos + length > len(data):
+                raise ValueError('Truncated response from sprite cache server')
+            res[key.hex()] = data[pos: pos + length]
+            pos += length
+        return res
+
+    def fetch(self, keys):
+        """
+        @brief Get data for several keys.
+        @param keys Iterable of 16-character hexadecimal strings.
+        @return Dict of key -> data for keys present in the store.
+        """
+        body = b''.join(bytes.fromhex(k) for k in keys)
+        request = urllib.request.Request(f'{self.url}/fetch', data=body, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return self.decode_records(response.read())
+
+    def store(self, hash_key, data):
+        """
+        @brief Add data to the store.
+        @param hash_key 16-character hexadecimal string.
+        @param data Data to store (bytes).
+        """
+        _check_key(hash_key)
+        request = urllib.request.Request(f'{self.url}/sprites/{hash_key}', data=bytes(data), method='PUT')
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+def make_cache_store(location):
+    """
+    @brief Create a shared cache store for the location.
+    @param location URL of the cache server (http:// or https://) or path to a shared directory.
+    @return Store object.
+    """
+    location = str(location)
+    if location.startswith(('http://', 'https://')):
+        return HTTPCacheStore(location)
+    return DirectoryCacheStore(location)
+
+
+class RemoteSpriteCache:
+    """
+    @class RemoteSpriteCache
+    @brief Read-through sprite cache that combines a local cache with a shared store.
+
+    Sprites missing in the local cache are fetched from the store in batches by prefetch and saved locally
+    when used. Newly encoded sprites are uploaded to the store in a background thread. Store errors are
+    reported as warnings and never fail the build.
+    """
+    FETCH_BATCH_SIZE = 512
+
+    hexdigest = staticmethod(SpriteCache.hexdigest)
+
+    def __init__(self, local, store, upload=True):
+        """
+        @brief Initialize the RemoteSpriteCache.
+        @param local Local cache (SpriteCache or PackedSpriteCache).
+        @param store Shared store (see make_cache_store).
+        @param upload Whether to upload newly encoded sprites to the store.
+        """
+        self.local = local
+        self.store = store
+        self.upload = upload
+        self._fetched = {}
+        self._uploads = []
+        self._executor = None
+        self._store_failed = False
+        self._clean_build = False
+
+    def _warn(self, message):
+        # TODO use build warnings system
+        if not self._store_failed:
+            print(f'WARNING: Shared sprite cache: {message}')
+        self._store_failed = True
+
+    def load(self, clean_build):
+        """
+        @brief Load the local cache.
+        @param clean_build If True, don't use any cached data (neither local nor shared).
+        """
+        self.local.load(clean_build=clean_build)
+        self._clean_build = clean_build
+        self._fetched = {}
+        self._store_failed = False
+
+    def prefetch(self, keys):
+        """
+        @brief Fetch sprites missing in the local cache from the store.
+        @param keys Keys that will be checked with is_cached.
+        """
+        if self._clean_build:
+            return
+        missing = [k for k in dict.fromkeys(keys) if not self.local.is_cached(k)]
+        for i in range(0, len(missing), self.FETCH_BATCH_SIZE):
+            try:
+                self._fetched.update(self.store.fetch(missing[i: i + self.FETCH_BATCH_SIZE]))
+            except Exception as e:
+                self._warn(f'fetch failed: {e}')
+                return
+
+    def save(self):
+        """
+        @brief Wait for uploads to finish and save the local cache.
+        """
+        if self._executor is not None:
+            for k, future in self._uploads:
+                try:
+                    future.result()
+                except Exception as e:
+                    self._warn(f'upload of {k} failed: {e}')
+            self._executor.shutdown()
+            self._executor = None
+        self._uploads = []
+        self._fetched = {}
+        self.local.save()
+
+    def keep(self, keys):
+        """
+        @brief Mark local cache entries as used so that save doesn't remove them.
+        @param keys Iterable of 16-character hexadecimal strings.
+        """
+        self.local.keep(keys)
+
+    def is_cached(self, hash_key):
+        """
+        @brief Check if a hash key is present in the local cache or was fetched from the store.
+        @param hash_key 16-character hexadecimal string.
+        @return True if the key is cached, False otherwise.
+        """
+        return self.local.is_cached(hash_key) or hash_key in self._fetched
+
+    def get(self, hash_key):
+        """
+        @brief Retrieve cached data, saving fetched entries into the local cache.
+        @param hash_key 16-character hexadecimal string.
+        @return Cached data as bytes, or None if not found.
+        """
+        data = self._fetched.pop(hash_key, None)
+        if data is not None:
+            self.local.set(hash_key, data)
+            return data
+        return self.local.get(hash_key)
+
+    def set(self, hash_key, data):
+        """
+        @brief Store data in the local cache and schedule its upload to the store.
+        @param hash_key 16-character hexadecimal string.
+        @param data Data to store (bytes).
+        """
+        self.local.set(hash_key, data)
+        if not self.upload or self._store_failed:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=4)
+        self._uploads.append((hash_key, self._executor.submit(self.store.store, hash_key, data)))
+
+
+class MemoryCache:
+    """
+    @class MemoryCache
+    @brief In-process LRU cache limited by the total size of its entries.
+
+    Keeps the statistics of hits and misses, `reset_stats` starts counting anew (e.g. for every build).
+    """
+    def __init__(self, max_bytes):
+        """
+        @brief Initialize the MemoryCache.
+        @param max_bytes Maximum total size of the entries, least recently used ones are dropped when it's exceeded.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        @brief Retrieve a value and mark it as the most recently used.
+        @param key Hashable key.
+        @return Value or None if it's not in the cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """
+        @brief Store a value, dropping the least recently used ones if the cache is full.
+        @param key Hashable key.
+        @param value Value to store.
+        @param size Size of the value in bytes, values larger than the whole cache aren't stored.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        """
+        @brief Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def reset_stats(self):
+        """
+        @brief Reset the hit and miss counters.
+        """
+        self.hits = self.misses = 0
+
+
+class MemorySpriteCache:
+    """
+    @class MemorySpriteCache
+    @brief Sprite cache that keeps recently used sprite data in memory in front of another sprite cache.
+
+    Memory part outlives builds so sprites used again by the next build aren't read from the disk.
+    """
+    hexdigest = staticmethod(SpriteCache.hexdigest)
+
+    def __init__(self, cache, memory):
+        """
+        @brief Initialize the MemorySpriteCache.
+        @param cache Underlying sprite cache (SpriteCache, PackedSpriteCache or RemoteSpriteCache).
+        @param memory MemoryCache to keep the data in.
+        """
+        self.cache = cache
+        self.memory = memory
+
+    def load(self, clean_build):
+        """
+        @brief Load the underlying cache.
+        @param clean_build If True, don't use any cached data (memory cache is cleared too).
+        """
+        self.cache.load(clean_build=clean_build)
+        if clean_build:
+            self.memory.clear()
+
+    def save(self):
+        """
+        @brief Save the underlying cache.
+        """
+        self.cache.save()
+
+    def prefetch(self, keys):
+        """
+        @brief Prefetch entries that aren't in memory in the underlying cache.
+        @param keys Keys that will be checked with is_cached.
+        """
+        self.cache.prefetch(k for k in keys if k not in self.memory)
+
+    def keep(self, keys):
+        """
+        @brief Mark entries of the underlying cache as used so that save doesn't remove them.
+        @param keys Iterable of 16-character hexadecimal strings.
+        """
+        self.cache.keep(keys)
+
+    def is_cached(self, hash_key):
+        """
+        @brief Check if a hash key is present in memory or in the underlying cache.
+        @param hash_key 16-character hexadecimal string.
+        @return True if the key is cached, False otherwise.
+        """
+        return hash_key in self.memory or self.cache.is_cached(hash_key)
+
+    def get(self, hash_key):
+        """
+        @brief Retrieve cached data from memory or from the underlying cache.
+        @param hash_key 16-character hexadecimal string.
+        @return Cached data as bytes, or None if not found.
+        """
+        data = self.memory.get(hash_key)
+        if data is not None:
+            # Keep the entry on disk too, it could've been dropped there by a build that didn't use it
+            if self.cache.is_cached(hash_key):
+                self.cache.keep((hash_key,))
+            else:
+                self.cache.set(hash_key, data)
+            return data
+        data = self.cache.get(hash_key)
+        if data is not None:
+            self.memory.set(hash_key, data, len(data))
+        return data
+
+    def set(self, hash_key, data):
+        """
+        @brief Store data in the underlying cache and in memory.
+        @param hash_key 16-character hexadecimal string.
+        @param data Data to store (bytes).
+        """
+        self.cache.set(hash_key, data)
+        self.memory.set(hash_key, data, len(data))
+
+
+class ActionCache:
+    """
+    @class ActionCache
+    @brief Cache of encoded pseudo-sprite (action) data keyed by Action.get_cache_key.
+
+    Always kept in memory, optionally saved to the cache directory (actions.bin) to be used by the next builds.
+    Data is tied to the version of the code that encodes actions so any change there invalidates it.
+    """
+    MAGIC = b'GRFACTN\x00'
+    RECORD_HEADER = struct.Struct('<16sI')
+    _code_version = None
+
+    def __init__(self, path=None):
+        """
+        @brief Initialize the ActionCache.
+        @param path Path to the cache directory, None to only keep the cache in memory.
+        """
+        self.data_path = None if path is None else Path(path) / 'actions.bin'
+        self._index = {}
+        self._used = set()
+        self._loaded = False
+
+    @classmethod
+    def get_code_version(cls):
+        if cls._code_version is None:
+            h = hashlib.blake2b(digest_size=16)
+            base = Path(__file__).parent
+            # Modules that switch code encoding depends on, including the optimizer and the variable tables it folds with
+            for name in ('actions.py', 'parser.py', 'va2opt.py', 'va2vars.py', 'common.py'):
+                h.update((base / name).read_bytes())
+            cls._code_version = h.digest()
+        return cls._code_version
+
+    @staticmethod
+    def digest(key):
+        """
+        @brief Compute the digest of the action cache key.
+        @param key Key returned by Action.get_cache_key.
+        @return 16-byte digest.
+        """
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+    def load(self, clean_build):
+        """
+        @brief Prepare the cache for the build, loads the saved cache on the first use.
+        @param clean_build If True, forget all cached data.
+        """
+        self._used = set()
+        if clean_build:
+            self._index = {}
+            self._loaded = True
+            return
+        if self._loaded or self.data_path is None or not self.data_path.exists():
+            self._loaded = True
+            return
+        self._loaded = True
+        try:
+            data = self.data_path.read_bytes()
+            header_size = len(self.MAGIC) + 16
+            if data[:len(self.MAGIC)] != self.MAGIC or data[len(self.MAGIC):header_size] != self.get_code_version():
+                return
+            pos = header_size
+            while pos < len(data):
+                digest, length = self.RECORD_HEADER.unpack_from(data, pos)
+                pos += self.RECORD_HEADER.size
+                self._index[digest] = data[pos: pos + length]
+                pos += length
+        except Exception as e:
+            print(f'WARNING: Error loading action cache: {e}')
+            self._index = {}
+
+    def save(self):
+        """
+        @brief Drop entries not used in the last build and save the cache if it has a path.
+        """
+        self._index = {k: v for k, v in self._index.items() if k in self._used}
+        if self.data_path is None:
+            return
+        self.data_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.data_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC + self.get_code_version())
+            for digest, data in self._index.items():
+                f.write(self.RECORD_HEADER.pack(digest, len(data)))
+                f.write(data)
+        os.replace(tmp_path, self.data_path)
+
+    def get(self, digest):
+        """
+        @brief Retrieve cached action data.
+        @param digest Digest of the action key.
+        @return Cached data as bytes, or None if not found.
+        """
+        data = self._index.get(digest)
+        if data is not None:
+            self._used.add(digest)
+        return data
+
+    def set(self, digest, data):
+        """
+        @brief Store action data in the cache.
+        @param digest Digest of the action key.
+        @param data Encoded action data (bytes).
+        """
+        self._index[digest] = data
+        self._used.add(digest)
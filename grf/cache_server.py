@@ -0,0 +1,114 @@
+"""
+Reference server for the shared sprite cache (see HTTPCacheStore in cache.py).
+
+Usage: python -m grf.cache_server [--host HOST] [--port PORT] PATH
+"""
+import argparse
+import re
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .cache import DirectoryCacheStore, HTTPCacheStore
+
+
+MAX_ENTRY_SIZE = 64 << 20
+MAX_FETCH_KEYS = 4096
+SPRITE_PATH_RE = re.compile(r'^/sprites/([0-9a-f]{16})$')
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    store = None  # DirectoryCacheStore, set by make_server
+
+    def _read_body(self, max_size):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.send_error(411)
+            return None
+        # int() would also accept signs, whitespace and underscores
+        if not length.isascii() or not length.isdigit():
+            self.send_error(400)
+            return None
+        length = int(length)
+        if length > max_size:
+            self.send_error(413)
+            return None
+        return self.rfile.read(length)
+
+    def _reply(self, code, data=b''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != '/fetch':
+            self.send_error(404)
+            return
+        body = self._read_body(MAX_FETCH_KEYS * 8)
+        if body is None:
+            return
+        if len(body) % 8 != 0:
+            self.send_error(400)
+            return
+        keys = [body[i: i + 8].hex() for i in range(0, len(body), 8)]
+        self._reply(200, HTTPCacheStore.encode_records(self.store.fetch(keys)))
+
+    def do_GET(self):
+        m = SPRITE_PATH_RE.match(self.path)
+        if m is None:
+            self.send_error(404)
+            return
+        data = self.store.fetch([m.group(1)]).get(m.group(1))
+        if data is None:
+            self.send_error(404)
+            return
+        self._reply(200, data)
+
+    def do_PUT(self):
+        m = SPRITE_PATH_RE.match(self.path)
+        if m is None:
+            self.send_error(404)
+            return
+        body = self._read_body(MAX_ENTRY_SIZE)
+        if body is None:
+            return
+        self.store.store(m.group(1), body)
+        self._reply(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(path, host='127.0.0.1', port=0):
+    """
+    @brief Create a sprite cache server storing entries in a directory.
+    @param path Directory to store the cache in.
+    @param host Address to listen on.
+    @param port Port to listen on, 0 to choose a free one.
+    @return ThreadingHTTPServer instance, call serve_forever() to run it.
+    """
+    handler = type('Handler', (CacheRequestHandler,), {'store': DirectoryCacheStore(path)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared sprite cache server')
+    parser.add_argument('path', help='Directory to store the cache in')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8125, help='Port to listen on, 0 to choose a free one (default: 8125)')
+    args = parser.parse_args()
+
+    server = make_server(args.path, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f'Serving sprite cache from {args.path} on http://{host}:{port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -469,6 +469,16 @@ class DummyWriteContext:
 
     def __init__(self):
         self.timer = self.Timer()
+        self.compression = 'lz77'
+        self.code_optimization = 0
+        self.code_bytes_saved = 0
+        self.code_ops_saved = 0
+
+    def find_encoded_sprite(self, key):
+        return None
+
+    def add_encoded_sprite(self, key, data, encode_time):
+        pass
 
     def failure(self, obj, message):
         return RuntimeError(message)
@@ -1,17 +1,22 @@
 import functools
 import heapq
 import inspect
+import io
+import itertools
 import json
+import math
+import multiprocessing
 import os
-import shutil
 import struct
 import time
 import textwrap
 import tempfile
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 from PIL import Image, ImageDraw
-import nml.spriteencoder
 import numpy as np
 
 from .actions import Ref, CB, Range, ReferenceableAction, ReferencingAction, get_ref_id, pformat, PyComment, SpriteRef, \
@@ -21,16 +26,26 @@ from .actions import Ref, CB, Range, ReferenceableAction, ReferencingAction, get
                      ModifySprites, If, SetDescription, ReplaceOldSprites, ErrorMessage, Comment, \
                      ComputeParameters, Label, SoundEffects, ImportSound, Translations, SetProperties
 from .parser import Node, Expr, Value, Var, Temp, Perm, Call, parse_code, OP_INIT, SPRITE_FLAGS, GenericVar
+from .va2opt import OPTIMIZATION_LEVELS
+from .analyze import analyze, format_report as format_cost_report
 from .common import Feature, hex_str, utoi32, FeatureMeta, to_bytes, GLOBAL_VAR
 from .common import INDUSTRY_TILE, INDUSTRY, byte_size_format
 from .colour import PIL_PALETTE
-from .cache import SpriteCache
+from .cache import SpriteCache, FileDigestCache, RemoteSpriteCache, ActionCache, MemoryCache, MemorySpriteCache, PixelCache, \
+                    SPRITE_CACHE_BACKENDS, make_cache_store
+from . import lz77
 from .sprites import Action, Sprite, Sound, ResourceAction, FakeAction, Resource, \
-                     PaletteRemap, AlternativeSprites, ResourceFile, LoadedResourceFile, \
-                     SingleResourceAction, ZoomDebugRecolourSprite, Uncacheable
+                     PaletteRemap, AlternativeSprites, ResourceFile, LoadedResourceFile, CodeFile, \
+                     SingleResourceAction, ZoomDebugRecolourSprite, Uncacheable, SPRITE_COMPRESSION_MODES, \
+                     set_image_memory_cache, set_pixel_cache
 from .strings import StringManager, StringRef
 
 
+# Encoded sprite data kept in memory between encoding and writing resources, data over it is read from the sprite cache
+# again or, for the uncacheable sprites, from a temporary file
+KEPT_SPRITE_DATA_BYTES = 256 * 1024 * 1024
+
+
 class SpriteSheet:
     def __init__(self, sprites=None):
         self._sprites = list(sprites) if sprites else []
@@ -118,6 +133,8 @@ class WriteContext:
             self.composing_time = 0
             self.compression_time = 0
             self.custom_time = defaultdict(int)
+            self.num_skipped = 0  # sprites with the same pixels as already encoded ones
+            self.skipped_time = 0  # time it would've taken to encode them
             self.time = time.time()
 
         def start(self):
@@ -151,18 +168,53 @@ class WriteContext:
             for cat, time in self.custom_time.items():
                 func(f'   {cat}: {time:.02f}')
             func(f'   Graphics compression: {self.compression_time:.02f}')
+            if self.num_skipped:
+                func(f'   Skipped encoding of {self.num_skipped} duplicate sprites, saved: {self.skipped_time:.02f}')
+
+        def get_stats(self):
+            return (
+                self.loading_time,
+                self.conversion_time,
+                self.composing_time,
+                self.compression_time,
+                dict(self.custom_time),
+                self.num_skipped,
+                self.skipped_time,
+            )
 
+        def add_stats(self, stats):
+            loading, conversion, composing, compression, custom, num_skipped, skipped_time = stats
+            self.loading_time += loading
+            self.conversion_time += conversion
+            self.composing_time += composing
+            self.compression_time += compression
+            self.num_skipped += num_skipped
+            self.skipped_time += skipped_time
+            for cat, time in custom.items():
+                self.custom_time[cat] += time
 
-    def __init__(self):
-        self._nml = nml.spriteencoder.SpriteEncoder(True, False, None)
+
+    MAX_ENCODED_SPRITES_SIZE = 256 << 20
+
+    def __init__(self, compression='lz77', code_optimization=0):
         self.print_handlers = []
+        self.compression = compression  # default compression mode for real sprites
+        self.code_optimization = code_optimization  # optimization level of switch code
         self.reset()
 
     def reset(self):
+        self._encoded_sprites = {}
+        self._encoded_sprites_size = 0
         self.num_sprites = 0
         self.num_cached = 0
         self.num_uncacheable = 0
         self.num_duplicate = 0
+        self.num_actions_cached = 0
+        self.num_actions_encoded = 0  # only counts cacheable actions
+        self.num_actions_merged = 0
+        self.switch_hops_eliminated = defaultdict(int)  # feature -> count
+        self.code_bytes_saved = 0  # by switch code optimization
+        self.code_ops_saved = 0
         self.messages = []
         self.timer = self.Timer(self)
 
@@ -190,9 +242,25 @@ class WriteContext:
     def start_timer(self):
         return self.timer.start()
 
+    def find_encoded_sprite(self, key):
+        entry = self._encoded_sprites.get(key)
+        if entry is None:
+            return None
+        data, encode_time = entry
+        self.timer.num_skipped += 1
+        self.timer.skipped_time += encode_time
+        return data
+
+    def add_encoded_sprite(self, key, data, encode_time):
+        # Limit memory used to keep encoded sprites
+        if self._encoded_sprites_size + len(data) > self.MAX_ENCODED_SPRITES_SIZE:
+            return
+        self._encoded_sprites[key] = (data, encode_time)
+        self._encoded_sprites_size += len(data)
+
     def sprite_compress(self, raw_data):
         t0 = time.time()
-        res = self._nml.sprite_compress(raw_data)
+        res = lz77.encode(raw_data)
         self.timer.compression_time += time.time() - t0
         return res
 
@@ -210,21 +278,161 @@ class WriteContext:
         if wcount + scount > 0:
             self.print(f'Total warnings: {wcount + scount}')
         self.print(f'Total {self.num_sprites} sprites, cached {self.num_cached}, uncacheable {self.num_uncacheable}. Optimized {self.num_duplicate} duplicates.')
+        if self.num_actions_cached + self.num_actions_encoded > 0:
+            self.print(f'Action cache: {self.num_actions_cached} hits, {self.num_actions_encoded} misses.')
+        if self.num_actions_merged > 0:
+            self.print(f'Merged {self.num_actions_merged} identical actions.')
+        if self.switch_hops_eliminated:
+            hops_str = ', '.join(f'{f.constant} {n}' for f, n in sorted(self.switch_hops_eliminated.items(), key=lambda x: x[0].id))
+            self.print(f'Flattened switches, eliminated evaluations: {hops_str}.')
+        if self.code_optimization > 0:
+            self.print(f'Switch code optimization saved {self.code_bytes_saved} bytes, {self.code_ops_saved} operations.')
+
+
+# Resources to encode in the worker processes, inherited from the main process by fork.
+_encode_worker_resources = None
+_encode_worker_compression = None
+
+
+def _init_encode_worker(resources, compression):
+    global _encode_worker_resources, _encode_worker_compression
+    _encode_worker_resources = resources
+    _encode_worker_compression = compression
+
+
+def _encode_resources_chunk(start, end):
+    resources = _encode_worker_resources[start:end]
+    context = WriteContext(compression=_encode_worker_compression)
+
+    # Unload files after their last use in the chunk to keep memory usage in check
+    last_use = {}
+    for i, s in enumerate(resources):
+        for f in s.get_resource_files():
+            if isinstance(f, LoadedResourceFile):
+                last_use[id(f)] = (i, f)
+    unload_files = defaultdict(list)
+    for i, f in last_use.values():
+        unload_files[i].append(f)
+
+    res = []
+    for i, s in enumerate(resources):
+        res.append(s.get_real_data(context))
+        for f in unload_files[i]:
+            f.unload()
+
+    # Objects can't be passed back to the main process, keep only their description.
+    messages = [(mt, code, repr(obj), message) for mt, code, obj, message in context.messages]
+    return res, context.timer.get_stats(), messages
+
+
+class _FileUsers:
+    # Resource files with the same path and resource actions that use them
+    def __init__(self):
+        self.files = {}
+        self.actions = {}  # used as an ordered set
+        self.is_code = False
+
+
+class _SpilledData:
+    # Temporary file for the encoded data that doesn't fit into KEPT_SPRITE_DATA_BYTES, created on first use
+    def __init__(self):
+        self._file = None
+
+    def add(self, data):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        return functools.partial(self._read, offset, len(data))
+
+    def _read(self, offset, size):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _BuildState:
+    # Data of the previous build kept in memory for BaseNewGRF.rebuild
+    def __init__(self, sprites, action_data, resource_order, resource_data, sprite_map, fingerprints, sprite_cache, debug_zoom_levels, options):
+        self.sprites = sprites
+        self.action_data = action_data  # encoded actions, None for resource actions
+        self.resource_order = resource_order  # resource actions in the order of sprite ids
+        self.resource_data = resource_data  # resource action -> tuple of encoded resources
+        self.sprite_map = sprite_map
+        self.fingerprints = fingerprints
+        self.sprite_cache = sprite_cache
+        self.debug_zoom_levels = debug_zoom_levels
+        self.options = options
+        self._file_users = None
+
+    def get_file_users(self):
+        # Resolved path -> _FileUsers, built on the first rebuild
+        if self._file_users is None:
+            res = defaultdict(_FileUsers)
+            resolved = {}
+            for sl in self.resource_order:
+                for f in sl.get_resource_files():
+                    if f.path is None:
+                        continue
+                    path = resolved.get(f.path)
+                    if path is None:
+                        path = resolved[f.path] = Path(f.path).resolve()
+                    users = res[path]
+                    users.files[id(f)] = f
+                    users.actions[sl] = None
+                    users.is_code = users.is_code or isinstance(f, CodeFile)
+            self._file_users = dict(res)
+        return self._file_users
 
 
 class BaseNewGRF:
-    def __init__(self, *, strings=None, id_map_file=None, sprite_cache_path='.cache', fast_sprite_enumeration=False):
+    def __init__(self, *, strings=None, id_map_file=None, sprite_cache_path='.cache', fast_sprite_enumeration=False, compression='lz77', sprite_cache_backend='files', file_fingerprint='mtime', shared_sprite_cache=None, max_loaded_bytes=None, persistent_action_cache=False, code_optimization=0, merge_actions=False, flatten_switches=False, cost_report=False, sprite_memory_cache_size=None, image_memory_cache_size=None, pixel_cache=False):
+        if compression not in SPRITE_COMPRESSION_MODES:
+            raise ValueError(f'Invalid value for compression: {compression}, expected one of {SPRITE_COMPRESSION_MODES}')
+        if sprite_cache_backend not in SPRITE_CACHE_BACKENDS:
+            raise ValueError(f'Invalid value for sprite_cache_backend: {sprite_cache_backend}, expected one of {tuple(SPRITE_CACHE_BACKENDS)}')
+        if file_fingerprint not in ('mtime', 'content'):
+            raise ValueError(f'Invalid value for file_fingerprint: {file_fingerprint}, expected \'mtime\' or \'content\'')
+        if code_optimization not in OPTIMIZATION_LEVELS:
+            raise ValueError(f'Invalid value for code_optimization: {code_optimization}, expected one of {OPTIMIZATION_LEVELS}')
         self.generators = []
         self._next_sound_id = 73
         self._sounds = {}
         self.strings = StringManager() if strings is None else strings
-        self._context = WriteContext()
+        self._context = WriteContext(compression=compression)
         self._context.add_print_handler(print)
         self._id_map = IDMap(id_map_file)
         self.sprite_cache_path = sprite_cache_path
+        self.sprite_cache_backend = sprite_cache_backend
+        # How to detect changes in resource files: by modification time or by content
+        self.file_fingerprint = file_fingerprint
+        self._file_digests = None
+        # URL of the cache server or a shared directory, works best with file_fingerprint='content'
+        self.shared_sprite_cache = shared_sprite_cache
         self.fast_sprite_enumeration = fast_sprite_enumeration
+        # Memory budget for loaded images, None to use the old enumeration that doesn't track memory
+        self.max_loaded_bytes = max_loaded_bytes
+        self._action_cache = ActionCache(sprite_cache_path if persistent_action_cache else None)
+        # Optimization level of switch code: 0 - compile as written, 1 - optimize
+        self.code_optimization = code_optimization
+        # Whether to merge identical switches before resolving references (see merge_identical_actions)
+        self.merge_actions = merge_actions
+        # Whether to skip switches that don't change the result (see flatten_switch_chains)
+        self.flatten_switches = flatten_switches
+        # Whether to print the estimated in-game cost of callback chains after building (see grf.analyze)
+        self.cost_report = cost_report
+        # In-memory caches of encoded sprites and decoded images that are kept between builds, None if disabled
+        self._sprite_memory_cache = None if sprite_memory_cache_size is None else MemoryCache(sprite_memory_cache_size)
+        self._image_memory_cache = None if image_memory_cache_size is None else MemoryCache(image_memory_cache_size)
+        self.pixel_cache = pixel_cache
         self._parameters = {}
         self._labels = set()
+        # Data of the last build for incremental rebuilds (see rebuild)
+        self._build = None
 
     def reserve_ids(self, feature, ids):
         self._id_map.reserve_ids(feature, ids)
@@ -286,6 +494,20 @@ class BaseNewGRF:
         for s in sprites:
             self._add(self.generators, s)
 
+    def _get_action_data(self, s):
+        key = s.get_cache_key() if isinstance(s, Action) else None
+        if key is None:
+            return s.get_data(self._context)
+        digest = self._action_cache.digest((key, self._context.code_optimization))
+        data = self._action_cache.get(digest)
+        if data is not None:
+            self._context.num_actions_cached += 1
+            return data
+        data = s.get_data(self._context)
+        self._action_cache.set(digest, data)
+        self._context.num_actions_encoded += 1
+        return data
+
     def _write_pseudo_sprite(self, f, data, grf_type=0xff):
         f.write(struct.pack('<IB', len(data), grf_type))
         res = f.tell()
@@ -356,51 +578,340 @@ class BaseNewGRF:
                 res.append(g)
         return res
 
+    def flatten_switch_chains(self, sprites):
+        # Removes switch evaluations that don't change the result:
+        # - references to switches without side effects that always lead to the same action
+        #   or callback result are replaced with references to that action or result,
+        # - ranges that lead to another switch with the same code are replaced with its ranges,
+        # - ranges that lead to a switch with different code are merged into one table by combining
+        #   values of both switches if both are known to be small enough.
+        # Switches that aren't in the sprite list are modified in place, only ones with automatically
+        # assigned ids are skipped or inlined.
+        forwards = {}  # id(switch) -> what switch always leads to
+        visited = set()
+        hops = defaultdict(int)  # feature -> number of eliminated switch evaluations
+
+        def target_key(r):
+            if isinstance(r, ReferenceableAction):
+                return ('action', id(r))
+            if isinstance(r, Ref):
+                # Direct references depend on the position of the action
+                return ('ref', r.value) if r.is_callback else None
+            if isinstance(r, int):
+                return ('ref', r | 0x8000)
+            return ('obj', id(r))
+
+        def reads_last_result(r, feature):
+            return isinstance(r, Switch) and r.reads_last_result(feature)
+
+        def bypass(r, callback_allowed):
+            if not isinstance(r, ReferenceableAction):
+                return r
+            t = forwards.get(id(r))
+            if t is None or not callback_allowed and not isinstance(t, ReferenceableAction):
+                return r
+            return t
+
+        def is_inlineable(s, c, feature):
+            # Switch without ranges returns the value as a callback result so it can't be inlined
+            return (
+                isinstance(c, Switch) and c.ref_id is None and c.subroutines is None and c._ranges and
+                c.related_scope == s.related_scope and c.feature in (None, feature) and
+                c.is_transparent(feature)
+            )
+
+        def num_ranges(ranges):
+            # Ranges over zero are encoded as two
+            return sum(2 if r.low < 0 <= r.high else 1 for r in ranges)
+
+        def clip_ranges(ranges, default, low, high, offset=0):
+            # Ranges of the switch limited to low..high, values that don't match any go to default
+            res = []
+            for r in ranges:
+                rlow, rhigh = max(r.low, low), min(r.high, high)
+                if rlow <= rhigh:
+                    res.append(Range(rlow + offset, rhigh + offset, r.ref))
+            value = low
+            for rlow, rhigh in sorted((r.low - offset, r.high - offset) for r in res):
+                if rlow > value:
+                    res.append(Range(value + offset, rlow - 1 + offset, default))
+                value = max(value, rhigh + 1)
+            if value <= high:
+                res.append(Range(value + offset, high + offset, default))
+            return res
+
+        def compact_ranges(s):
+            # Joins consecutive ranges that are adjacent and lead to the same place,
+            # ranges at the end that lead to default can be left to the default
+            # (but not all of them as switch without ranges returns the value).
+            res = []
+            for r in s._ranges:
+                if res and res[-1].high + 1 == r.low and target_key(res[-1].ref) == target_key(r.ref):
+                    res[-1] = Range(res[-1].low, r.high, r.ref)
+                else:
+                    res.append(r)
+            default_key = target_key(s.default)
+            while len(res) > 1 and default_key is not None and target_key(res[-1].ref) == default_key:
+                res.pop()
+            s._ranges = res
+
+        def inline_same_code(s, feature):
+            # Switch with the same code evaluates to the same value, its table can be used directly
+            ranges = []
+            inlined = 0
+            for r in s._ranges:
+                c = r.ref
+                if isinstance(c, Switch) and c.code == s.code and is_inlineable(s, c, feature):
+                    ranges.extend(clip_ranges(c._ranges, c.default, r.low, r.high))
+                    inlined += 1
+                else:
+                    ranges.append(r)
+            if inlined == 0 or num_ranges(ranges) > 255:
+                return 0
+            s._ranges = ranges
+            return inlined
+
+        def inline_combined(s, feature):
+            # Switch on a different value is merged by switching on (value * (max_child_value + 1) + child_value)
+            if '\n' in s.code.strip():
+                return 0
+            bounds = s.get_value_bounds(feature)
+            if bounds is None:
+                return 0
+            child = None
+            for r in s._ranges:
+                c = r.ref
+                if isinstance(c, Switch) and '\n' not in c.code.strip() and is_inlineable(s, c, feature):
+                    child_bounds = c.get_value_bounds(feature)
+                    if child_bounds is not None:
+                        child = c
+                        break
+            if child is None:
+                return 0
+            mult = child_bounds[1] + 1
+            if (bounds[1] + 1) * mult > 0x80000000:
+                return 0
+            ranges = []
+            inlined = 0
+            for r in s._ranges:
+                low, high = max(r.low, bounds[0]), min(r.high, bounds[1])
+                if low > high:
+                    continue
+                c = r.ref
+                if isinstance(c, Switch) and c.code == child.code and is_inlineable(s, c, feature):
+                    if (high - low + 1) * (len(c._ranges) * 2 + 1) > 255:
+                        return 0
+                    for value in range(low, high + 1):
+                        ranges.extend(clip_ranges(c._ranges, c.default, 0, mult - 1, value * mult))
+                    inlined += 1
+                else:
+                    ranges.append(Range(low * mult, high * mult + mult - 1, r.ref))
+            if inlined == 0 or num_ranges(ranges) > 255:
+                return 0
+            # Switches after this one see the new value as the last computed result
+            if any(reads_last_result(r.ref, feature) for r in ranges) or reads_last_result(s.default, feature):
+                return 0
+            s.code = f'({s.code.strip()}) * {mult} + ({child.code.strip()})'
+            s._parsed_code = None
+            s._ranges = ranges
+            return inlined
+
+        def flatten(a, feature):
+            if isinstance(a, Switch):
+                if a.subroutines is not None:
+                    for k, v in a.subroutines.items():
+                        t = bypass(v, False)
+                        if t is not v:
+                            a.subroutines[k] = t
+                            hops[feature] += 1
+                for r in a._ranges:
+                    t = bypass(r.ref, True)
+                    if t is not r.ref:
+                        r.ref = t
+                        hops[feature] += 1
+                t = bypass(a.default, True)
+                if t is not a.default:
+                    a.default = t
+                    hops[feature] += 1
+            elif isinstance(a, ReferencingAction):
+                refs = list(a.get_refs())
+                new_refs = [bypass(r, False) for r in refs]
+                changed = sum(x is not y for x, y in zip(refs, new_refs))
+                if changed:
+                    a.set_refs(new_refs)
+                    hops[feature] += changed
+
+            if not isinstance(a, Switch) or a.subroutines is not None or not a.is_transparent(feature):
+                return
+
+            if a._ranges:
+                hops[feature] += inline_same_code(a, feature)
+                hops[feature] += inline_combined(a, feature)
+                compact_ranges(a)
+
+            if a.ref_id is not None or not a._ranges:
+                return
+            keys = set(target_key(r.ref) for r in a._ranges)
+            keys.add(target_key(a.default))
+            if len(keys) != 1 or None in keys:
+                return
+            # Next switch would see the result of the previous one instead of this one
+            if reads_last_result(a.default, feature):
+                return
+            forwards[id(a)] = a.default
+
+        for s in sprites:
+            if not isinstance(s, ReferencingAction) or id(s) in visited:
+                continue
+            # Post-order traversal with explicit stack, feature is inherited from the referencing action
+            stack = [(s, s.feature, False)]
+            while stack:
+                a, feature, expanded = stack.pop()
+                if not expanded:
+                    if id(a) in visited:
+                        continue
+                    visited.add(id(a))
+                    stack.append((a, feature, True))
+                    if isinstance(a, ReferencingAction):
+                        for r in a.get_refs():
+                            if isinstance(r, ReferenceableAction) and id(r) not in visited:
+                                stack.append((r, feature if r.feature is None else r.feature, False))
+                    continue
+                if feature is not None:
+                    flatten(a, feature)
+
+        for feature, count in hops.items():
+            if count > 0:
+                self._context.switch_hops_eliminated[feature] += count
+        return sprites
+
+    def merge_identical_actions(self, sprites):
+        # Replaces references to actions that are identical to already seen ones (including everything
+        # they reference) with references to those. Only actions that aren't in the sprite list
+        # themselves and have automatically assigned ids are merged.
+        listed = set(map(id, sprites))
+        canonical = {}  # id(action) -> action to use instead
+        merged = {}  # (merge key, feature, references) -> action
+        visited = set()
+        num_merged = 0
+
+        def ref_key(r):
+            if isinstance(r, ReferenceableAction):
+                return ('action', id(canonical.get(id(r), r)))
+            if isinstance(r, Ref):
+                # Direct references depend on the position of the action
+                return ('ref', r.value) if r.is_callback else None
+            if isinstance(r, int):
+                return ('int', r)
+            return ('obj', id(r))
+
+        for s in sprites:
+            if not isinstance(s, ReferencingAction) or id(s) in visited:
+                continue
+            visited.add(id(s))
+            # Post-order traversal with explicit stack, feature is inherited from the referencing action
+            stack = [(s, s.feature, False)]
+            while stack:
+                a, feature, expanded = stack.pop()
+                if not expanded:
+                    stack.append((a, feature, True))
+                    if isinstance(a, ReferencingAction):
+                        for r in a.get_refs():
+                            if isinstance(r, ReferenceableAction) and id(r) not in visited:
+                                visited.add(id(r))
+                                stack.append((r, feature if r.feature is None else r.feature, False))
+                    continue
+
+                if isinstance(a, ReferencingAction):
+                    refs = list(a.get_refs())
+                    new_refs = [canonical.get(id(r), r) if isinstance(r, ReferenceableAction) else r for r in refs]
+                    if any(x is not y for x, y in zip(refs, new_refs)):
+                        a.set_refs(new_refs)
+                        refs = new_refs
+                else:
+                    refs = []
+
+                if id(a) in listed or a.ref_id is not None or feature is None:
+                    continue
+                key = a.get_merge_key()
+                if key is None:
+                    continue
+                ref_keys = tuple(map(ref_key, refs))
+                if None in ref_keys:
+                    continue
+                key = (key, feature, ref_keys)
+                first = merged.get(key)
+                if first is None:
+                    merged[key] = a
+                else:
+                    canonical[id(a)] = first
+                    num_merged += 1
+
+        self._context.num_actions_merged += num_merged
+        return sprites
+
     def resolve_refs(self, sprites):
+        """
+        @brief Assigns ids to referenceable actions and inserts unlisted referenced actions before their first use.
+        @param sprites List of sprites and actions.
+        @return New list of sprites with all referenced actions included.
+
+        Action graph is traversed with explicit stacks so the depth of reference chains is only limited
+        by available ids, edges are kept in insertion-ordered dicts so each one is processed once.
+        """
         refids = {}
         actions = {}
-        ordered_refs = defaultdict(list)
+        ordered_refs = defaultdict(dict)
         unordered_refs = defaultdict(list)
         ref_count = defaultdict(int)
 
-        def resolve(s, i):
-            # Action can reference other actions, resolve all the references
-            if isinstance(s, ReferencingAction):
-                for r in s.get_refs():
-                    if isinstance(r, Ref):
-                        if r.is_callback:
-                            continue
-                        robj = refids.get(r.ref_id)
-                        if robj is None:
-                            print (f'WARNING Unresolved direct reference {r} in action {s.py(None)}')
-                            continue
-                        r = robj
-                        ref_count[id(r)] += 1
+        def resolve_next_ref(s, refs):
+            # Action can reference other actions, resolve references until one that wasn't seen before
+            # and return it so it's resolved first, remaining references stay in the iterator
+            for r in refs:
+                if isinstance(r, Ref):
+                    if r.is_callback:
                         continue
-
-                    if not isinstance(r, ReferenceableAction):
-                        if isinstance(r, Sound):
-                            self._add_sound(r)
+                    robj = refids.get(r.ref_id)
+                    if robj is None:
+                        print (f'WARNING Unresolved direct reference {r} in action {s.py(None)}')
                         continue
+                    r = robj
+                    ref_count[id(r)] += 1
+                    continue
 
-                    if r is s:
-                        raise RuntimeError(f'Action {s} references itself')
+                if not isinstance(r, ReferenceableAction):
+                    if isinstance(r, Sound):
+                        self._add_sound(r)
+                    continue
 
-                    assert isinstance(r, ReferenceableAction)
+                if r is s:
+                    raise RuntimeError(f'Action {s} references itself')
 
-                    ref_count[id(r)] += 1
-                    if id(r) not in actions:
-                        actions[id(r)] = (r, None)
-                        unordered_refs[id(s)].append(id(r))
-                        resolve(r, None)
-                    else:
-                        if id(r) not in ordered_refs[id(s)]:
-                            ordered_refs[id(s)].append(id(r))
-
-            prev_i = actions.get(id(s), (None, None))[1]
-            if prev_i is not None and i is not None and prev_i != i:
-                raise RuntimeError(f'Action {s} was added more than once (positions {prev_i} and {i})')
-            actions[id(s)] = (s, i)
+                ref_count[id(r)] += 1
+                if id(r) not in actions:
+                    actions[id(r)] = (r, None)
+                    unordered_refs[id(s)].append(id(r))
+                    return r
+                ordered_refs[id(s)][id(r)] = None
+            return None
+
+        def get_refs(s):
+            return iter(s.get_refs()) if isinstance(s, ReferencingAction) else iter(())
+
+        def resolve(s, i):
+            stack = [(s, i, get_refs(s))]
+            while stack:
+                a, ai, refs = stack[-1]
+                r = resolve_next_ref(a, refs)
+                if r is not None:
+                    stack.append((r, None, get_refs(r)))
+                    continue
+                stack.pop()
+                prev_i = actions.get(id(a), (None, None))[1]
+                if prev_i is not None and ai is not None and prev_i != ai:
+                    raise RuntimeError(f'Action {a} was added more than once (positions {prev_i} and {ai})')
+                actions[id(a)] = (a, ai)
 
         for i, s in enumerate(sprites):
             if not isinstance(s, (ReferencingAction, ReferenceableAction)):
@@ -415,13 +926,13 @@ class BaseNewGRF:
                     refids[s.ref_id] = s
 
         ids = list(range(-255, 0))
+        free_ids = set(ids)
         reserved_ids = set()
         linked_refs = {}
         visited = set()
-        min_ids = len(ids)
 
-        def dfs(aid, linked, feature):
-            nonlocal min_ids
+        def enter(aid, linked, feature, stack):
+            # Pre-order part of the traversal: checks feature, assigns id and schedules references
             a, ai = actions[aid]
             if a.feature is not None and a.feature != feature:
                 raise RuntimeError(f'Mixed features {a.feature} and {feature} in action {a}')
@@ -435,7 +946,7 @@ class BaseNewGRF:
                     try:
                         while a.ref_id is None or a.ref_id in reserved_ids:
                             a.ref_id = -heapq.heappop(ids)
-                        min_ids = min(min_ids, len(ids))
+                            free_ids.discard(-a.ref_id)
                     except IndexError:
                         raise RuntimeError(f'Ran out of ids while trying to reference action {a}')
                 else:
@@ -445,13 +956,12 @@ class BaseNewGRF:
                 # Node is already ordered, prepend unordered nodes to it
                 linked = linked_refs[aid] = []
 
-            for x in ordered_refs[aid]:
-                dfs(x, linked, feature)
+            children = itertools.chain(ordered_refs[aid], unordered_refs[aid])
+            stack.append((a, linked, children))
 
-            for x in unordered_refs[aid]:
-                dfs(x, linked, feature)
-
-            # Apppend node to the ordered parent node (or itself)
+        def leave(a, linked):
+            # Post-order part of the traversal: appends node to the ordered parent node (or itself)
+            # and returns ids of actions that are no longer referenced to the pool
             linked.append(a)
 
             if isinstance(a, ReferencingAction):
@@ -462,26 +972,29 @@ class BaseNewGRF:
                         if ref_count[rid] == 0:
                             raise RuntimeError('Reference counting error')
                         ref_count[rid] -= 1
-                        # If this action is longer referenced return id to the pool
                         if ref_count[rid] == 0:
-                            if -r.ref_id not in ids:
+                            if -r.ref_id not in free_ids:
                                 heapq.heappush(ids, -r.ref_id)
+                                free_ids.add(-r.ref_id)
                             reserved_ids.discard(r.ref_id)
 
+        def dfs(aid, feature):
+            stack = []
+            enter(aid, None, feature, stack)
+            while stack:
+                a, linked, children = stack[-1]
+                x = next(children, None)
+                if x is not None:
+                    enter(x, linked, feature, stack)
+                    continue
+                stack.pop()
+                leave(a, linked)
+
         roots = [(r, v[0].feature) for r, v in actions.items() if ref_count[r] <= 0]
 
-        # print('SPRITES', sprites)
-        # print('ACTIONS', actions)
-        # print('OREF', ordered_refs)
-        # print('UREF', unordered_refs)
-        # print('roots', roots)
         for r, f in roots:
             assert f is not None
-            dfs(r, None, f)
-
-        # print('LREF', linked_refs)
-
-        # print('IDS used', 255 - min_ids)
+            dfs(r, f)
 
         # Construct the full list of actions with resolved ids and order
         res = []
@@ -573,35 +1086,214 @@ class BaseNewGRF:
 
         return res
 
+    def _enumerate_sprites_budgeted(self, sprites, sprite_map, cached_sprites):
+        # Sprites using the same files are put next to each other, then files are loaded when
+        # needed and, when memory budget is exceeded, the ones that are needed latest are unloaded.
+        next_sprite_id = 1
+        ordered_sprites = []
+        unordered_sprites = []
+        file_index = {}
+        for s in sprites:
+            if not isinstance(s, ResourceAction):
+                continue
+            loaded_resources = {}
+            for f in s.get_resource_files():
+                assert isinstance(f, ResourceFile), type(f)
+                if isinstance(f, LoadedResourceFile):
+                    loaded_resources[id(f)] = f
+                    file_index.setdefault(id(f), len(file_index))
+            if loaded_resources:
+                key = sorted(file_index[fid] for fid in loaded_resources)
+                unordered_sprites.append((key, s, list(loaded_resources.values())))
+                continue
+            s.sprite_id = next_sprite_id
+            next_sprite_id += 1
+            ordered_sprites.append((s, ()))
+
+        unordered_sprites.sort(key=lambda x: x[0])
+        for _, s, files in unordered_sprites:
+            s.sprite_id = next_sprite_id
+            next_sprite_id += 1
+            # Files are only needed for sprites that have to be encoded
+            if all(sprite_map[r] in cached_sprites for r in s.get_resources()):
+                files = ()
+            ordered_sprites.append((s, files))
+
+        uses = defaultdict(list)
+        sizes = {}
+        for i, (s, files) in enumerate(ordered_sprites):
+            for f in files:
+                uses[id(f)].append(i)
+                if id(f) not in sizes:
+                    sizes[id(f)] = f.get_loaded_size()
+
+        load_files = defaultdict(list)
+        unload_files = defaultdict(list)
+        use_count = defaultdict(int)
+        loaded = {}
+        loaded_size = 0
+        next_use = {}
+        next_use_queue = []  # (-next use position, file id), may contain outdated entries
+        for i, (s, files) in enumerate(ordered_sprites):
+            if not files:
+                continue
+            new_files = [f for f in files if id(f) not in loaded]
+            new_size = sum(sizes[id(f)] for f in new_files)
+            current = set(id(f) for f in files)
+            while loaded_size + new_size > self.max_loaded_bytes and next_use_queue:
+                pos, fid = heapq.heappop(next_use_queue)
+                if fid not in loaded or fid in current or next_use[fid] != -pos:
+                    continue
+                unload_files[i - 1].append(loaded.pop(fid))
+                loaded_size -= sizes[fid]
+
+            for f in new_files:
+                loaded[id(f)] = f
+                load_files[i].append(f)
+            loaded_size += new_size
+
+            for f in files:
+                fid = id(f)
+                use_count[fid] += 1
+                if use_count[fid] < len(uses[fid]):
+                    next_use[fid] = uses[fid][use_count[fid]]
+                    heapq.heappush(next_use_queue, (-next_use[fid], fid))
+                else:
+                    unload_files[i].append(loaded.pop(fid))
+                    loaded_size -= sizes[fid]
+
+        res = []
+        for i, (s, _) in enumerate(ordered_sprites):
+            res.append((s, load_files.get(i), unload_files.get(i)))
+
+        return res
+
     def get_sprite_fingerprint(self, s):
         if not isinstance(s, Sprite):
             return None
 
         try:
-            fingerprint = s.get_fingerprint()
+            fingerprint = s.get_fingerprint_digest()
         except Uncacheable:
             return None
 
+        # Sprites from the same files share the digest of their file data
         files = s.get_resource_files()
-        files_data = []
-        for f in files:
-            fmod = None
-            if f.path is not None:
-                path = str(f.path)
-                fmod = self._file_mod_date.get(path)
-                if fmod is None:
-                    fmod = self._file_mod_date[path] = os.path.getmtime(path)
-            files_data.append((f.get_fingerprint(), fmod))
-
-        return {
+        files_digest = self._files_digest.get(files)
+        if files_digest is None:
+            files_data = []
+            for f in files:
+                ffp = f.get_fingerprint()
+                fver = None
+                if f.path is not None:
+                    path = str(f.path)
+                    fver = self._file_versions.get(path)
+                    if fver is None:
+                        if self._file_digests is not None:
+                            fver = self._file_digests.get(path)
+                        else:
+                            fver = os.path.getmtime(path)
+                        self._file_versions[path] = fver
+                if self._file_digests is not None:
+                    # Content is what matters, files can be moved or checked out elsewhere
+                    ffp = {k: v for k, v in ffp.items() if k != 'path'}
+                files_data.append((ffp, fver))
+            files_digest = self._files_digest[files] = SpriteCache.hexdigest(files_data)
+
+        res = {
             'data': fingerprint,
-            'files': files_data,
+            'files': files_digest,
         }
+        # Sprites compressed with a non-default mode are cached separately
+        compression = s.compression or self._context.compression
+        if compression != 'lz77':
+            res['compression'] = compression
+        return res
+
+    def _encode_resources_parallel(self, sprite_order, sprite_map, cached_sprites, fingerprints, jobs):
+        # Encode every resource that is not in the cache, in the order they're written so that
+        # each worker mostly deals with the same set of loaded files. Sprites with the same fingerprint
+        # are only encoded once, the rest will get the data from the sprite cache.
+        resources = []
+        seen = set()
+        for sl, _, _ in sprite_order:
+            if not isinstance(sl, ResourceAction):
+                continue
+            for s in sl.get_resources():
+                s = sprite_map[s]
+                key = fingerprints.get(s) or s
+                if s in cached_sprites or key in seen:
+                    continue
+                seen.add(key)
+                resources.append(s)
+
+        if len(resources) < 2:
+            return {}
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            # TODO use build warnings system
+            self._context.print(f'WARNING: Parallel encoding is not supported on this platform, using a single process')
+            return {}
+
+        if threading.active_count() > 1:
+            # Forked child only gets the calling thread, locks held by the others (e.g. in watch mode) stay locked
+            # TODO use build warnings system
+            self._context.print(f'WARNING: Parallel encoding is not supported with multiple threads running, using a single process')
+            return {}
+
+        # Several chunks per process to even out the load
+        chunk_size = max(1, math.ceil(len(resources) / (jobs * 4)))
+        chunks = [(i, min(i + chunk_size, len(resources))) for i in range(0, len(resources), chunk_size)]
+
+        res = {}
+        with ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_encode_worker,
+                initargs=(resources, self._context.compression)) as executor:
+            futures = [executor.submit(_encode_resources_chunk, start, end) for start, end in chunks]
+            for (start, end), future in zip(chunks, futures):
+                data, stats, messages = future.result()
+                for s, d in zip(resources[start:end], data):
+                    res[s] = d
+                self._context.timer.add_stats(stats)
+                self._context.messages.extend(messages)
+        return res
+
+    def _encode_resource(self, s, encoded):
+        data = encoded.get(s)
+        if data is None:
+            data = s.get_real_data(self._context)
+        return data
+
+    def _get_resource_data(self, s, fp, sprite_cache, encoded):
+        if fp is not None:
+            # Do get istead of checking cached as it could've been added on this run
+            data = sprite_cache.get(fp)
+            if data is None:
+                data = self._encode_resource(s, encoded)
+                sprite_cache.set(fp, data)
+            else:
+                self._context.num_cached += 1
+        else:
+            data = self._encode_resource(s, encoded)
+            self._context.num_uncacheable += 1
+
+        self._context.num_sprites += 1
+        return data
 
-    def _do_write(self, filename, t, sprite_cache, debug_zoom_levels=False):
+    def _do_write(self, f, t, sprite_cache, spilled, debug_zoom_levels=False, jobs=1, keep_build=False):
         t.start(f'Evaluating sprite generators')
         sprites = self.generate_sprites()
 
+        if self.flatten_switches:
+            t.log(f'Flattening switch chains')
+            sprites = self.flatten_switch_chains(sprites)
+
+        if self.merge_actions:
+            t.log(f'Merging identical actions')
+            sprites = self.merge_identical_actions(sprites)
+
         t.log(f'Resolving action references')
         sprites = self.resolve_refs(sprites)
 
@@ -627,8 +1319,10 @@ class BaseNewGRF:
 
         # Calculate sprite fingerprints and check cache
         cached_sprites = set()
-        self._file_mod_date = {}
+        self._file_versions = {}
+        self._files_digest = {}
         fingerprints = {}
+        real_sprites = []
         for a in sprites:
             if not isinstance(a, ResourceAction):
                 continue
@@ -637,143 +1331,416 @@ class BaseNewGRF:
                     s.prepare_files()
                     continue
                 s = sprite_map[s]
+                real_sprites.append(s)
+                if s in fingerprints:
+                    continue
                 fpdict = self.get_sprite_fingerprint(s)
-                if fpdict is not None:
-                    fp = sprite_cache.hexdigest(fpdict)
-                    fingerprints[s] = fp
-                    if sprite_cache.is_cached(fp):
-                        cached_sprites.add(s)
-                        continue
-                s.prepare_files()
+                fingerprints[s] = None if fpdict is None else sprite_cache.hexdigest(fpdict)
 
-        t.log(f'Enumerating sprites')
-        sprite_order = self._enumerate_sprites(sprites)
+        sprite_cache.prefetch(fp for fp in fingerprints.values() if fp is not None)
+        for s in real_sprites:
+            fp = fingerprints[s]
+            if fp is not None and sprite_cache.is_cached(fp):
+                cached_sprites.add(s)
+                continue
+            s.prepare_files()
 
-        t.log(f'Writing actions')
-        with open(filename, 'wb') as f:
-            f.write(b'\x00\x00GRF\x82\x0d\x0a\x1a\x0a')  # file header
-            data_offset_pos = f.tell()
-            f.write(b'\x00\x00\x00\x00')  # data offset (overwritten later)
-            f.write(b'\x00')  # compression(1)
-            # f.write(b'\x04\x00\x00\x00')  # num(4)
-            # f.write(b'\xFF')  # grf_type(1)
-            # f.write(b'\xb0\x01\x00\x00')  # num + 0xff -> recoloursprites() (257 each)
-            self._write_pseudo_sprite(f, b'\x02\x00\x00\x00')
-
-            # Using dict of lists as each sprite can be used multiple times
-            resource_references = defaultdict(list)
-            for s in sprites:
-                if isinstance(s, ResourceAction):
-                    resource_references[s.sprite_id].append(self._write_pseudo_sprite(f, s.get_data(self._context), grf_type=0xfd))
-                else:
-                    self._write_pseudo_sprite(f, s.get_data(self._context), grf_type=0xff)
+        t.log(f'Enumerating sprites')
+        if self.max_loaded_bytes is None:
+            sprite_order = self._enumerate_sprites(sprites)
+        else:
+            sprite_order = self._enumerate_sprites_budgeted(sprites, sprite_map, cached_sprites)
 
-            data_offset = f.tell() - data_offset_pos
-            f.write(b'\x00\x00\x00\x00')
+        encoded = {}
+        if jobs > 1:
+            t.log(f'Encoding sprites ({jobs} processes)')
+            encoded = self._encode_resources_parallel(sprite_order, sprite_map, cached_sprites, fingerprints, jobs)
 
-            t.log(f'Writing resources')
+        t.log(f'Encoding resources')
 
-            def get_sprite_data(s):
-                sprite_data = None
+        def read_cached(s, fp):
+            d = sprite_cache.get(fp)
+            if d is None:
+                # Cache entry is broken, encode again, files were unloaded after encoding
                 s = sprite_map[s]
-                if isinstance(s, Sprite) and s in fingerprints:
-                    # Do get istead of checking cached as it could've been added on this run
-                    data = sprite_cache.get(fingerprints[s])
-                    if data is None:
-                        data = s.get_real_data(self._context)
-                        sprite_cache.set(fingerprints[s], data)
-                    else:
-                        self._context.num_cached += 1
-                else:
-                    data = s.get_real_data(self._context)
-                    self._context.num_uncacheable += 1
-
-                self._context.num_sprites += 1
-                return data
-
-            renumerate_sprites = {}
-            data_hashes = {}
-            written_resources = set()
-            for sl, load_files, unload_files in sprite_order:
-                if load_files:
-                    timer = self._context.start_timer()
-                    for rf in load_files:
-                        rf.load()
-                    timer.count_loading()
-
-                if isinstance(sl, ResourceAction):
-                    if sl in written_resources:
-                        continue
-
-                    data = []
-                    sprites = sl.get_resources()
-                    for s in sprites:
-                        d = get_sprite_data(s)
-                        data.append(d)
-
-                    h = hash(tuple(data))
-                    sid = data_hashes.get(h)
-                    if sid is not None:
-                        # Don't duplicate sprite, just change the reference.
-                        renumerate_sprites[sl.sprite_id] = sid
-                        self._context.num_duplicate += len(sprites)
-                    else:
-                        # Unique sprite, write it and add to index.
-                        for d in data:
-                            f.write(struct.pack('<II', sl.sprite_id, len(d)))
-                            f.write(d)
-                        data_hashes[h] = sl.sprite_id
-
-                    written_resources.add(sl)
-
-
-                if unload_files:
-                    for rf in unload_files:
+                s.prepare_files()
+                files = [rf for rf in s.get_resource_files() if isinstance(rf, LoadedResourceFile)]
+                for rf in files:
+                    rf.load()
+                try:
+                    d = self._encode_resource(s, encoded)
+                finally:
+                    for rf in files:
                         rf.unload()
+            return d
+
+        # Data encoded in parallel is released after its last use, after that it's either in the parts or in the cache
+        remaining_uses = defaultdict(int)
+        if encoded:
+            for sl in dict.fromkeys(sl for sl, _, _ in sprite_order if isinstance(sl, ResourceAction)):
+                for s in sl.get_resources():
+                    s = sprite_map[s]
+                    if s in encoded:
+                        remaining_uses[s] += 1
+
+        def get_sprite_data(s):
+            s = sprite_map[s]
+            fp = fingerprints.get(s) if isinstance(s, Sprite) else None
+            data = self._get_resource_data(s, fp, sprite_cache, encoded)
+            if s in remaining_uses:
+                remaining_uses[s] -= 1
+                if remaining_uses[s] == 0:
+                    del remaining_uses[s]
+                    encoded.pop(s, None)
+            return data, fp
+
+        # Encode all resources before writing anything so that duplicates are known in advance
+        # and the file can be written sequentially. Encoded data is kept in memory up to
+        # KEPT_SPRITE_DATA_BYTES, the rest is read from the cache again when writing or, if the sprite
+        # isn't cacheable, from a temporary file. With keep_build all data stays in memory for rebuild.
+        renumerate_sprites = {}
+        data_hashes = {}
+        written_resources = set()
+        resource_plan = []
+        resource_data = {}
+        kept_bytes = 0
+        for sl, load_files, unload_files in sprite_order:
+            # Resources encoded in parallel don't need the files loaded in the main process
+            if load_files and not encoded:
+                timer = self._context.start_timer()
+                for rf in load_files:
+                    rf.load()
+                timer.count_loading()
+
+            if isinstance(sl, ResourceAction) and sl not in written_resources:
+                data = []
+                fps = []
+                resources = sl.get_resources()
+                for s in resources:
+                    d, fp = get_sprite_data(s)
+                    data.append(d)
+                    fps.append(fp)
+
+                data = tuple(data)
+                if keep_build:
+                    resource_data[sl] = data
+                h = hash(data)
+                sid = data_hashes.get(h)
+                if sid is not None:
+                    # Don't duplicate sprite, just change the reference.
+                    renumerate_sprites[sl.sprite_id] = sid
+                    self._context.num_duplicate += len(resources)
+                else:
+                    # Unique sprite, write it and add to index.
+                    parts = []
+                    for s, d, fp in zip(resources, data, fps):
+                        if not keep_build:
+                            if kept_bytes + len(d) <= KEPT_SPRITE_DATA_BYTES:
+                                kept_bytes += len(d)
+                            elif fp is not None:
+                                d = functools.partial(read_cached, s, fp)
+                            else:
+                                d = spilled.add(d)
+                        parts.append(d)
+                    resource_plan.append((sl.sprite_id, parts))
+                    data_hashes[h] = sl.sprite_id
+
+                written_resources.add(sl)
+
+            if unload_files:
+                for rf in unload_files:
+                    rf.unload()
 
-            f.write(b'\x00\x00\x00\x00')
-            file_size = f.tell()
+        t.log(f'Writing actions')
+        action_data = [None if isinstance(s, ResourceAction) else self._get_action_data(s) for s in sprites]
+        pseudo = self._write_actions(sprites, action_data, renumerate_sprites)
 
-            f.seek(data_offset_pos)
-            f.write(struct.pack('<I', data_offset))
+        file_size = self._write_grf_file(f, t, pseudo, resource_plan)
 
-            for k, v in renumerate_sprites.items():
-                for ofs in resource_references[k]:
-                    f.seek(ofs)
-                    f.write(struct.pack('<I', v))
+        if keep_build:
+            self._build = _BuildState(
+                sprites, action_data, [sl for sl, _, _ in sprite_order], resource_data,
+                sprite_map, fingerprints, sprite_cache, debug_zoom_levels, self._get_build_options(),
+            )
 
         self._id_map.save()
         t.stop()
         self._context.print_report()
+        self._print_memory_cache_report()
+        if self.cost_report:
+            self._context.print('Estimated cost of action chains (maximum / average):')
+            for line in format_cost_report(analyze(sprites, self.code_optimization)):
+                self._context.print(line)
         self._context.print(f'Generated grf size {byte_size_format(file_size)}, build time {t.get_total():.02f} sec')
 
         return sprites
 
-    def write(self, filename, clean_build=False, debug_zoom_levels=False):
-        self._context.reset()
-        t = Timer(self._context)
-        sprite_cache = SpriteCache(self.sprite_cache_path)
-        sprite_cache.load(clean_build=clean_build)
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.close()
+    def _write_actions(self, sprites, action_data, renumerate_sprites):
+        # Pseudo-sprite section of the file, action_data has encoded data of all actions except resource ones
+        pseudo = io.BytesIO()
+        self._write_pseudo_sprite(pseudo, b'\x02\x00\x00\x00')
+        for s, data in zip(sprites, action_data):
+            if isinstance(s, ResourceAction):
+                data = s.get_data(self._context)
+                sid = renumerate_sprites.get(s.sprite_id)
+                if sid is not None:
+                    data = struct.pack('<I', sid) + data[4:]
+                self._write_pseudo_sprite(pseudo, data, grf_type=0xfd)
+            else:
+                self._write_pseudo_sprite(pseudo, data, grf_type=0xff)
+        return pseudo.getvalue()
+
+    def _write_grf_file(self, f, t, pseudo, resource_plan):
+        # Parts of the resource plan are either encoded data or functions that read it
+        f.write(b'\x00\x00GRF\x82\x0d\x0a\x1a\x0a')  # file header
+        f.write(struct.pack('<I', len(pseudo) + 5))  # data offset
+        f.write(b'\x00')  # compression(1)
+        f.write(pseudo)
+        f.write(b'\x00\x00\x00\x00')
+        file_size = len(pseudo) + 19
+
+        t.log(f'Writing resources')
+        for sprite_id, parts in resource_plan:
+            for d in parts:
+                if callable(d):
+                    d = d()
+                f.write(struct.pack('<II', sprite_id, len(d)))
+                f.write(d)
+                file_size += 8 + len(d)
+
+        f.write(b'\x00\x00\x00\x00')
+        file_size += 4
+        return file_size
+
+    def _write_to(self, filename, func):
+        if hasattr(filename, 'write'):
+            return func(filename)
+        # Replace the file only when it's fully written
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix=f'.{basename}.', suffix='.tmp', delete=False)
         try:
-            sprites = self._do_write(tmp.name, t, sprite_cache, debug_zoom_levels=debug_zoom_levels)
-            shutil.move(tmp.name, filename)
-        except Exception as e:
+            with tmp:
+                res = func(tmp)
+            os.replace(tmp.name, filename)
+        except BaseException:
             os.unlink(tmp.name)
             raise
-        finally:
-            sprite_cache.save()
+        return res
 
+    def _get_watched_files(self, sprites):
         watched = set()
         for s in sprites:
             if isinstance(s, ResourceAction):
                 for f in s.get_resource_files():
                     assert isinstance(f, ResourceFile)
                     watched.add(f.path)
-
         return watched
 
+    def write(self, filename, clean_build=False, debug_zoom_levels=False, jobs=1, keep_build=False):
+        # filename can also be a writable binary file object, file is written sequentially so it doesn't need to support seek
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError(f'Number of jobs should be positive, got {jobs}')
+        self._context.reset()
+        self._context.code_optimization = self.code_optimization
+        t = Timer(self._context)
+        sprite_cache = SPRITE_CACHE_BACKENDS[self.sprite_cache_backend](self.sprite_cache_path)
+        if self.shared_sprite_cache is not None:
+            sprite_cache = RemoteSpriteCache(sprite_cache, make_cache_store(self.shared_sprite_cache))
+        if self._sprite_memory_cache is not None:
+            sprite_cache = MemorySpriteCache(sprite_cache, self._sprite_memory_cache)
+        sprite_cache.load(clean_build=clean_build)
+        self._action_cache.load(clean_build=clean_build)
+        self._file_digests = None
+        if self.file_fingerprint == 'content':
+            self._file_digests = FileDigestCache(self.sprite_cache_path)
+            self._file_digests.load(clean_build=clean_build)
+        self._reset_memory_cache_stats()
+        prev_file_caches = self._set_file_caches(clean_build)
+        self._build = None
+        spilled = _SpilledData()
+        try:
+            sprites = self._write_to(filename, lambda f: self._do_write(
+                f, t, sprite_cache, spilled, debug_zoom_levels=debug_zoom_levels, jobs=jobs, keep_build=keep_build))
+        finally:
+            spilled.close()
+            self._restore_file_caches(prev_file_caches)
+            sprite_cache.save()
+            self._action_cache.save()
+            if self._file_digests is not None:
+                self._file_digests.save()
+
+        return self._get_watched_files(sprites)
+
+    def take_state(self, other):
+        """
+        @brief Take over in-memory state of another object built by the same project, e.g. after reloading its code.
+        @param other BaseNewGRF object that was used for building before.
+
+        Print handlers and the in-memory caches of actions, sprites and images are kept, the kept build
+        (see `rebuild`) isn't as the actions can be different.
+        """
+        self._context.print_handlers = other._context.print_handlers
+        if self._action_cache.data_path == other._action_cache.data_path:
+            self._action_cache = other._action_cache
+        for attr in ('_sprite_memory_cache', '_image_memory_cache'):
+            cache, other_cache = getattr(self, attr), getattr(other, attr)
+            if cache is not None and other_cache is not None:
+                other_cache.max_bytes = cache.max_bytes
+                setattr(self, attr, other_cache)
+
+    def _set_file_caches(self, clean_build=False):
+        # Caches ImageFile.load uses during the build, returns the previous ones for _restore_file_caches
+        if clean_build and self._image_memory_cache is not None:
+            self._image_memory_cache.clear()
+        pixel_cache = None
+        if self.pixel_cache:
+            pixel_cache = PixelCache(self.sprite_cache_path)
+            pixel_cache.load(clean_build=clean_build)
+        return set_image_memory_cache(self._image_memory_cache), set_pixel_cache(pixel_cache)
+
+    def _restore_file_caches(self, prev):
+        set_image_memory_cache(prev[0])
+        pixel_cache = set_pixel_cache(prev[1])
+        if pixel_cache is not None:
+            pixel_cache.save()
+
+    def _reset_memory_cache_stats(self):
+        for cache in (self._sprite_memory_cache, self._image_memory_cache):
+            if cache is not None:
+                cache.reset_stats()
+
+    def _print_memory_cache_report(self):
+        for name, cache in (('sprites', self._sprite_memory_cache), ('images', self._image_memory_cache)):
+            if cache is None or cache.hits + cache.misses == 0:
+                continue
+            rate = cache.hits / (cache.hits + cache.misses)
+            self._context.print(f'Memory cache of {name}: {cache.hits} hits, {cache.misses} misses ({rate:.0%}), '
+                                f'{byte_size_format(cache.size)} of {byte_size_format(cache.max_bytes)} used.')
+
+    def _get_build_options(self):
+        # Options that affect the action data, rebuild can't reuse actions encoded with different ones
+        return (self.code_optimization, self.merge_actions, self.flatten_switches, self._context.compression)
+
+    def rebuild(self, filename, changed_files, jobs=1):
+        """
+        @brief Update the file after resource files have changed, only sprites that use them are encoded again.
+        @param filename Path to the grf file or a writable binary file object.
+        @param changed_files Paths of the changed files.
+        @param jobs Number of processes to use for sprite encoding.
+        @return Set of paths of the resource files, same as `write`.
+
+        Reuses actions and encoded sprites of the previous `write` with `keep_build=True` and assumes that
+        actions don't depend on the content of the resource files. Falls back to the full build (that
+        keeps the data for the next rebuild) if there is no such build, options have changed or some
+        of the files are code or aren't used by the sprites of the previous build.
+        """
+        build = self._build
+        changed = [Path(p).resolve() for p in changed_files]
+        file_users = None if build is None else build.get_file_users()
+        if build is None or build.options != self._get_build_options() or \
+                any(p not in file_users or file_users[p].is_code for p in changed):
+            debug_zoom_levels = build is not None and build.debug_zoom_levels
+            return self.write(filename, debug_zoom_levels=debug_zoom_levels, jobs=jobs, keep_build=True)
+
+        self._build = None
+        self._context.reset()
+        self._context.code_optimization = self.code_optimization
+        t = Timer(self._context)
+        files = {}
+        actions = {}
+        for p in changed:
+            users = file_users[p]
+            files.update(users.files)
+            actions.update(dict.fromkeys(users.actions))
+        t.start(f'Re-encoding {len(actions)} changed resource actions')
+
+        sprite_cache = build.sprite_cache
+        sprite_map = build.sprite_map
+        fingerprints = build.fingerprints
+        self._reset_memory_cache_stats()
+        prev_file_caches = self._set_file_caches()
+        try:
+            for f in files.values():
+                if isinstance(f, LoadedResourceFile):
+                    f.unload()
+
+            self._file_versions = {}
+            self._files_digest = {}
+            resources = []
+            for sl in actions:
+                for s in sl.get_resources():
+                    s = sprite_map[s]
+                    resources.append(s)
+                    if isinstance(s, Sprite):
+                        fpdict = self.get_sprite_fingerprint(s)
+                        fingerprints[s] = None if fpdict is None else sprite_cache.hexdigest(fpdict)
+
+            sprite_cache.prefetch(fingerprints[s] for s in resources if fingerprints.get(s) is not None)
+            cached_sprites = set()
+            for s in resources:
+                fp = fingerprints.get(s)
+                if fp is not None and sprite_cache.is_cached(fp):
+                    cached_sprites.add(s)
+                    continue
+                s.prepare_files()
+
+            encoded = {}
+            if jobs > 1:
+                encoded = self._encode_resources_parallel(
+                    [(sl, None, None) for sl in actions], sprite_map, cached_sprites, fingerprints, jobs)
+
+            for sl in actions:
+                data = []
+                for s in sl.get_resources():
+                    s = sprite_map[s]
+                    fp = fingerprints.get(s) if isinstance(s, Sprite) else None
+                    data.append(self._get_resource_data(s, fp, sprite_cache, encoded))
+                build.resource_data[sl] = tuple(data)
+
+            for sl in actions:
+                for f in sl.get_resource_files():
+                    if isinstance(f, LoadedResourceFile):
+                        f.unload()
+
+            # Changed sprites can become or stop being duplicates, encoded data is in memory so it's cheap to redo
+            t.log(f'Writing actions')
+            renumerate_sprites = {}
+            data_hashes = {}
+            written_resources = set()
+            resource_plan = []
+            for sl in build.resource_order:
+                if sl in written_resources:
+                    continue
+                written_resources.add(sl)
+                data = build.resource_data[sl]
+                h = hash(data)
+                sid = data_hashes.get(h)
+                if sid is not None:
+                    renumerate_sprites[sl.sprite_id] = sid
+                    self._context.num_duplicate += len(data)
+                else:
+                    resource_plan.append((sl.sprite_id, data))
+                    data_hashes[h] = sl.sprite_id
+
+            pseudo = self._write_actions(build.sprites, build.action_data, renumerate_sprites)
+            file_size = self._write_to(filename, lambda f: self._write_grf_file(f, t, pseudo, resource_plan))
+            t.stop()
+            # Only keep the build if it was fully updated
+            self._build = build
+        finally:
+            self._restore_file_caches(prev_file_caches)
+            sprite_cache.keep(fp for fp in fingerprints.values() if fp is not None)
+            sprite_cache.save()
+            if self._file_digests is not None:
+                self._file_digests.save()
+
+        self._context.print_report()
+        self._print_memory_cache_report()
+        self._context.print(f'Generated grf size {byte_size_format(file_size)}, build time {t.get_total():.02f} sec')
+        return self._get_watched_files(build.sprites)
+
     def wrap(self, func):
         def wrapper(*args, **kw):
             obj = func(*args, **kw)
@@ -894,8 +1861,8 @@ class NewGRF(BaseNewGRF):
     BLITTER_BPP_8 = b'8'
     BLITTER_BPP_32 = b'3'
 
-    def __init__(self, *, grfid, name, description, version=None, min_compatible_version=None, format_version=8, url=None, strings=None, id_map_file=None, sprite_cache_path='.cache', preferred_blitter=None, fast_sprite_enumeration=False):
-        super().__init__(strings=strings, id_map_file=id_map_file, sprite_cache_path=sprite_cache_path, fast_sprite_enumeration=fast_sprite_enumeration)
+    def __init__(self, *, grfid, name, description, version=None, min_compatible_version=None, format_version=8, url=None, strings=None, id_map_file=None, sprite_cache_path='.cache', preferred_blitter=None, fast_sprite_enumeration=False, compression='lz77', sprite_cache_backend='files', file_fingerprint='mtime', shared_sprite_cache=None, max_loaded_bytes=None, persistent_action_cache=False, code_optimization=0, merge_actions=False, flatten_switches=False, cost_report=False, sprite_memory_cache_size=None, image_memory_cache_size=None, pixel_cache=False):
+        super().__init__(strings=strings, id_map_file=id_map_file, sprite_cache_path=sprite_cache_path, fast_sprite_enumeration=fast_sprite_enumeration, compression=compression, sprite_cache_backend=sprite_cache_backend, file_fingerprint=file_fingerprint, shared_sprite_cache=shared_sprite_cache, max_loaded_bytes=max_loaded_bytes, persistent_action_cache=persistent_action_cache, code_optimization=code_optimization, merge_actions=merge_actions, flatten_switches=flatten_switches, cost_report=cost_report, sprite_memory_cache_size=sprite_memory_cache_size, image_memory_cache_size=image_memory_cache_size, pixel_cache=pixel_cache)
 
         if isinstance(grfid, str):
             grfid = grfid.encode('utf-8')
@@ -0,0 +1,76 @@
+"""
+LZ77 compression of real sprite data.
+
+Uses the native `grf._lz77` extension if it was built, it produces exactly the same output as nml encoder
+but much faster. Otherwise falls back to `nml.lz77` (which may itself be native if nml_lz77 is installed).
+"""
+import nml.lz77
+
+try:
+    from ._lz77 import encode as _native_encode
+except ImportError:
+    _native_encode = None
+
+
+if _native_encode is not None:
+    BACKEND = 'grf-native'
+elif nml.lz77.is_native:
+    BACKEND = 'nml-native'
+else:
+    BACKEND = 'nml'
+
+
+def nml_encode(data):
+    """
+    @brief Compress data with the nml encoder.
+    @param data Contiguous numpy array of uint8.
+    @return Compressed data.
+    """
+    return nml.lz77.encode(data)
+
+
+def encode(data):
+    """
+    @brief Compress data with the fastest available encoder.
+    @param data Contiguous numpy array of uint8 or any other object supporting buffer protocol.
+    @return Compressed data.
+    """
+    if _native_encode is not None:
+        return _native_encode(data)
+    return nml.lz77.encode(data)
+
+
+def decode(data, size=None):
+    """
+    @brief Decompress LZ77 data, checking that it can be decoded by OpenTTD.
+    @param data Compressed data.
+    @param size Expected size of the decompressed data (optional).
+    @return Decompressed data as bytes.
+    """
+    res = bytearray()
+    pos = 0
+    while pos < len(data):
+        code = data[pos]
+        pos += 1
+        if code < 0x80:
+            length = code or 0x80
+            if pos + length > len(data):
+                raise ValueError('Corrupt sprite data: literal is out of bounds')
+            res += data[pos: pos + length]
+            pos += length
+        else:
+            if pos >= len(data):
+                raise ValueError('Corrupt sprite data: truncated back-reference')
+            offset = ((code & 7) << 8) | data[pos]
+            pos += 1
+            length = 16 - ((code >> 3) & 0xf)
+            if offset == 0 or offset > len(res):
+                raise ValueError(f'Corrupt sprite data: back-reference offset {offset} is out of bounds')
+            if length > offset:
+                # OpenTTD copies with memcpy-like semantics so overlapping copies aren't reliable
+                raise ValueError(f'Corrupt sprite data: back-reference length {length} overlaps offset {offset}')
+            start = len(res) - offset
+            res += res[start: start + length]
+    if size is not None and len(res) != size:
+        raise ValueError(f'Corrupt sprite data: expected {size} bytes, got {len(res)}')
+    return bytes(res)
@@ -1,5 +1,7 @@
+import copy
 import struct
 import tempfile
+import threading
 
 from .ply import lex, yacc
 
@@ -91,6 +93,72 @@ OPERATORS = {
 DEFAULT_INDENT_STR = '    '
 
 
+def _signed(value):
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def eval_op(op, a, b):
+    """
+    @brief Evaluate VarAction2 operation the same way OpenTTD does (for dword sized switches).
+    @param op Operation (OP_* constant).
+    @param a Accumulator value.
+    @param b Operand value.
+    @return Result as unsigned 32-bit integer.
+    """
+    a &= 0xffffffff
+    b &= 0xffffffff
+    sa, sb = _signed(a), _signed(b)
+    if op == OP_ADD:
+        res = a + b
+    elif op == OP_SUB:
+        res = a - b
+    elif op == OP_MIN:
+        res = min(sa, sb)
+    elif op == OP_MAX:
+        res = max(sa, sb)
+    elif op == OP_MINU:
+        res = min(a, b)
+    elif op == OP_MAXU:
+        res = max(a, b)
+    elif op == OP_DIV:
+        # Division by zero returns the first argument, division rounds towards zero as in C
+        res = sa if sb == 0 else abs(sa) // abs(sb) * (1 if (sa < 0) == (sb < 0) else -1)
+    elif op == OP_MOD:
+        res = sa if sb == 0 else sa - sb * (abs(sa) // abs(sb) * (1 if (sa < 0) == (sb < 0) else -1))
+    elif op == OP_DIVU:
+        res = a if b == 0 else a // b
+    elif op == OP_MODU:
+        res = a if b == 0 else a % b
+    elif op == OP_MUL:
+        res = a * b
+    elif op == OP_AND:
+        res = a & b
+    elif op == OP_OR:
+        res = a | b
+    elif op == OP_XOR:
+        res = a ^ b
+    elif op in (OP_TSTO, OP_PSTO):
+        res = a
+    elif op == OP_INIT:
+        res = b
+    elif op == OP_ROT:
+        b &= 0x1f
+        res = (a >> b) | (a << (32 - b))
+    elif op == OP_CMP:
+        res = 0 if sa < sb else 1 if sa == sb else 2
+    elif op == OP_CMPU:
+        res = 0 if a < b else 1 if a == b else 2
+    elif op == OP_SHL:
+        res = a << (b & 0x1f)
+    elif op == OP_SHRU:
+        res = a >> (b & 0x1f)
+    elif op == OP_SHR:
+        res = sa >> (b & 0x1f)
+    else:
+        raise ValueError(f'Unknown operation {op}')
+    return res & 0xffffffff
+
+
 def hex_str(s):
     if isinstance(s, (bytes, memoryview)):
         return ':'.join('{:02x}'.format(b) for b in s)
@@ -224,6 +292,7 @@ class Expr(Node):
 
     def const_eval(self):
         # TODO support eval on const arguments (possibly on init)
+        # Level 0 code is compiled as written, constants are folded by grf.va2opt
         return None
 
 
@@ -235,7 +304,7 @@ class AssignVariable(Node):
         self.expression = expression
 
     def format(self, parent_priority=0):
-        return f'{self.variable} = {self.expresion.format()}'
+        return f'{self.variable} = {self.expression.format()}'
 
     def compile(self, context, shift=0, and_mask=0xffffffff):
         is_value, code = self.expression.compile(context, shift, and_mask)
@@ -770,21 +839,70 @@ def p_error(t):
     print(f'T={t}')
 
 
-lexer = lex.lex()
-parser = yacc.yacc(debug=False)
+# Lexer and parser templates, each CodeParser gets its own copies with separate state
+_lexer = lex.lex()
+_parser = yacc.yacc(debug=False)
 
-def parse_code(feature, code):
-    parser.grf_feature = feature
-    res = parser.parse(code, lexer=lexer)
-    if res is None:
-        stack_state_str = ' '.join([symbol.type for symbol in parser.symstack][1:])
 
-        print('Syntax error in input! Parser State:{} {}'
-              .format(parser.state,
-                      stack_state_str))
+class CodeParser:
+    """
+    @brief Parser of switch code.
+
+    Parsing state (lexer position, parser stacks, feature of the code) is kept per instance
+    so different instances can be used from different threads at the same time.
+    Parsing tables are shared between instances.
+    """
+
+    def __init__(self):
+        self.lexer = _lexer.clone()
+        self.parser = copy.copy(_parser)
+        self.parser.grf_feature = None
+
+    def parse(self, feature, code):
+        """
+        @brief Parse switch code.
+        @param feature Feature that the code is evaluated for (to resolve variable names).
+        @param code Code string.
+        @return List of parsed expressions (AST nodes) or None on syntax error.
+        """
+        self.parser.grf_feature = feature
+        self.lexer.lineno = 1
+        res = self.parser.parse(code, lexer=self.lexer)
+        if res is None:
+            stack_state_str = ' '.join([symbol.type for symbol in self.parser.symstack][1:])
+
+            print('Syntax error in input! Parser State:{} {}'
+                  .format(self.parser.state,
+                          stack_state_str))
+        return res
+
+
+_thread_local = threading.local()
+
+
+def get_code_parser():
+    """
+    @brief Get parser instance of the current thread.
+    @return CodeParser object.
+    """
+    res = getattr(_thread_local, 'parser', None)
+    if res is None:
+        res = _thread_local.parser = CodeParser()
     return res
 
 
+def parse_code(feature, code, parser=None):
+    """
+    @brief Parse switch code, safe to call from multiple threads.
+    @param feature Feature that the code is evaluated for.
+    @param code Code string.
+    @param parser CodeParser to use, parser of the current thread by default.
+    @return List of parsed expressions (AST nodes) or None on syntax error.
+    """
+    if parser is None:
+        parser = get_code_parser()
+    return parser.parse(feature, code)
+
 SPRITE_FLAGS = {
     'dodraw': (None, 0x01, 1, None),
     'add': (None, 0x02, 1, Temp),
@@ -0,0 +1,200 @@
+"""
+Reloading of the project Python code for the watch mode.
+
+Project modules are the ones loaded from the directory of the main script (or its subdirectories),
+except grf itself. When some of them change, they are reloaded together with the project modules
+that import them (in the order of dependencies) and the main script is executed again to create
+the new NewGRF object, `grf.main` only hands it over instead of parsing the command line.
+Installed packages are never project modules, even if they're in the project directory (e.g. in
+a virtual environment there).
+Everything else (numpy, PIL, grf and its module-level caches) stays loaded in the process.
+"""
+import ast
+import importlib
+import runpy
+import site
+import sys
+import types
+from pathlib import Path
+
+from . import utils
+
+
+GRF_PATH = Path(__file__).resolve().parent
+PACKAGE_DIRS = {'site-packages', 'dist-packages'}
+
+
+def _get_environment_paths():
+    # Directories of the Python installation and installed packages
+    paths = {sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix}
+    if hasattr(site, 'getsitepackages'):
+        paths.update(site.getsitepackages())
+    if site.ENABLE_USER_SITE:
+        paths.add(site.getusersitepackages())
+    return {Path(p).resolve() for p in paths}
+
+
+def _get_module_path(module):
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    try:
+        return Path(path).resolve()
+    except (OSError, RuntimeError):
+        return None
+
+
+class CodeReloader:
+    def __init__(self, script, grf_obj, root=None):
+        """
+        @brief Create a reloader.
+        @param script Path to the main script that calls `grf.main`.
+        @param grf_obj NewGRF object created by the script.
+        @param root Directory with the project modules, directory of the script by default.
+        """
+        self.script = Path(script).resolve()
+        self.root = self.script.parent if root is None else Path(root).resolve()
+        self.grf = grf_obj
+        # Environment can't be excluded if the project is inside of it
+        self._environment_paths = [p for p in _get_environment_paths() if not self.root.is_relative_to(p)]
+
+    def _is_project_path(self, path):
+        if path is None or path.suffix != '.py' or not path.is_relative_to(self.root) or path.is_relative_to(GRF_PATH):
+            return False
+        if PACKAGE_DIRS.intersection(path.relative_to(self.root).parts):
+            return False
+        return not any(path.is_relative_to(p) for p in self._environment_paths)
+
+    def get_modules(self):
+        """
+        @brief Find loaded project modules.
+        @return Dict of module name -> resolved path of its file.
+        """
+        res = {}
+        for name, module in list(sys.modules.items()):
+            # Main script can also be there under another name (e.g. __mp_main__ by multiprocessing)
+            if not isinstance(module, types.ModuleType) or module.__name__ != name:
+                continue
+            path = _get_module_path(module)
+            if self._is_project_path(path) and path != self.script:
+                res[name] = path
+        return res
+
+    def get_files(self):
+        """
+        @brief Get files to watch for code changes.
+        @return Set of paths of the main script and the project modules.
+        """
+        return {self.script} | set(self.get_modules().values())
+
+    def is_code_change(self, changed_files):
+        """
+        @brief Check whether any of the changed files is project code.
+        @param changed_files Paths of the changed files.
+        @return True if the code needs to be reloaded.
+        """
+        files = self.get_files()
+        return any(Path(p).resolve() in files for p in changed_files)
+
+    def get_dependencies(self, modules):
+        """
+        @brief Find which project modules import each other (from their source, so it includes values imported with `from ... import`).
+        @param modules Project modules, see `get_modules`.
+        @return Dict of module name -> set of names of the project modules it imports.
+        """
+        res = {}
+        for name, path in modules.items():
+            deps = res.setdefault(name, set())
+            try:
+                tree = ast.parse(path.read_bytes(), filename=str(path))
+            except (OSError, SyntaxError, ValueError):
+                # Reload will report the error
+                continue
+            package = name if path.name == '__init__.py' else name.rpartition('.')[0]
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    imported = [a.name for a in node.names]
+                elif isinstance(node, ast.ImportFrom):
+                    base = node.module or ''
+                    if node.level > 0:
+                        parts = package.split('.')
+                        parent = '.'.join(parts[:len(parts) - node.level + 1])
+                        base = f'{parent}.{base}' if base else parent
+                    # Imported names can be submodules
+                    imported = [base] + [f'{base}.{a.name}' for a in node.names]
+                else:
+                    continue
+                deps.update(m for m in imported if m in modules and m != name)
+            # Package depends on its submodules
+            parent = name.rpartition('.')[0]
+            if parent in modules:
+                res.setdefault(parent, set()).add(name)
+        return res
+
+    def get_reload_order(self, changed_files):
+        """
+        @brief Find modules to reload after the files have changed.
+        @param changed_files Paths of the changed files.
+        @return List of module names, dependencies go first.
+        """
+        modules = self.get_modules()
+        changed = {Path(p).resolve() for p in changed_files}
+        deps = self.get_dependencies(modules)
+        dependents = {}
+        for name, module_deps in deps.items():
+            for d in module_deps:
+                dependents.setdefault(d, set()).add(name)
+
+        affected = set()
+        stack = [name for name, path in modules.items() if path in changed]
+        while stack:
+            name = stack.pop()
+            if name in affected:
+                continue
+            affected.add(name)
+            stack.extend(dependents.get(name, ()))
+
+        # Depth-first topological order, modules in cycles are reloaded in the order they're found
+        res = []
+        visited = set()
+        for name in sorted(affected):
+            stack = [(name, False)]
+            while stack:
+                n, expanded = stack.pop()
+                if expanded:
+                    res.append(n)
+                    continue
+                if n in visited:
+                    continue
+                visited.add(n)
+                stack.append((n, True))
+                stack.extend((d, False) for d in sorted(deps.get(n, ()), reverse=True) if d in affected)
+        return res
+
+    def reload(self, changed_files):
+        """
+        @brief Reload changed project modules and the modules that use them, then run the main script again.
+        @param changed_files Paths of the changed files.
+        @return New NewGRF object, it takes over in-memory state of the previous one (see `BaseNewGRF.take_state`).
+        """
+        importlib.invalidate_caches()
+        for name in self.get_reload_order(changed_files):
+            importlib.reload(sys.modules[name])
+
+        created = []
+
+        def capture(g, grf_file):
+            created.append((g, grf_file))
+
+        prev_hook = utils.main_hook
+        utils.main_hook = capture
+        try:
+            runpy.run_path(str(self.script), run_name='__main__')
+        finally:
+            utils.main_hook = prev_hook
+        if not created:
+            raise RuntimeError(f'{self.script} didn\'t call grf.main')
+        g, _ = created[-1]
+        g.take_state(self.grf)
+        self.grf = g
+        return g
@@ -1,3 +1,4 @@
+import hashlib
 import math
 import os
 import struct
@@ -11,6 +12,7 @@ from .common import ZOOM_NORMAL, ZOOM_4X, ZOOM_2X, ZOOM_OUT_2X, ZOOM_OUT_4X, ZOO
 from .colour import PALETTE, PIL_PALETTE, ALL_COLOURS, SAFE_COLOURS, WIN_TO_DOS, DEFAULT_BRIGHTNESS, WATER_COLOURS, NP_PALETTE
 from .colour import srgb_to_oklab, oklab_blend, oklab_find_best_colour, srgb_find_best_colour, openttd_adjust_brightness
 from . import colour
+from .cache import SpriteCache
 
 
 _remap_cache = {}
@@ -148,6 +150,15 @@ class Action:
     def get_data(self, context):
         raise NotImplementedError
 
+    def get_cache_key(self):
+        """
+        @brief Get the key to cache the encoded action data (see ActionCache).
+
+        Should only be implemented by actions that are expensive to encode and whose key is cheap to build.
+        @return Tuple of plain values (int, str, bool, None, tuples) that fully determines get_data result, or None if not cacheable.
+        """
+        return None
+
 
 class FakeAction:
     """
@@ -263,6 +274,13 @@ class LoadedResourceFile(ResourceFile):
     def unload(self):
         raise NotImplementedError
 
+    def get_loaded_size(self):
+        """
+        @brief Estimate memory used by the file when it's loaded.
+        @return Size in bytes, 0 if unknown.
+        """
+        return 0
+
 
 class Resource:
     """
@@ -356,12 +374,18 @@ class Uncacheable(Exception):
     pass
 
 
+SPRITE_COMPRESSION_MODES = ('auto', 'lz77', 'tile')
+
+
 class Sprite(Resource):
     """
     @brief Base class for all sprites (image, mask, etc).
     """
-    def __init__(self, w, h, *, xofs=0, yofs=0, zoom=ZOOM_NORMAL, bpp=None, crop=True, name=None):
+    _fingerprint_digest = None  # memoized by get_fingerprint_digest, False if uncacheable
+
+    def __init__(self, w, h, *, xofs=0, yofs=0, zoom=ZOOM_NORMAL, bpp=None, crop=True, name=None, compression=None):
         assert bpp in (None, BPP_8, BPP_24, BPP_32)
+        assert compression is None or compression in SPRITE_COMPRESSION_MODES, compression
         super().__init__()
         self.w = w
         self.h = h
@@ -370,6 +394,7 @@ class Sprite(Resource):
         self.zoom = zoom
         self.bpp = bpp
         self.crop = crop
+        self.compression = compression  # None means using NewGRF default
         self._name = name
 
     def __repr__(self):
@@ -388,6 +413,26 @@ class Sprite(Resource):
     def get_fingerprint(self):
         raise NotImplementedError
 
+    def get_fingerprint_digest(self):
+        """
+        @brief Get the digest of the sprite fingerprint, it's computed only once per sprite.
+
+        Wrapper sprites should use digests of the wrapped sprites in their fingerprints so the whole
+        tree isn't serialized again at every level. Sprite shouldn't be changed after the digest is computed.
+        @return 16-character hexadecimal string.
+        @raises Uncacheable if the sprite can't be cached.
+        """
+        digest = self._fingerprint_digest
+        if digest is None:
+            try:
+                digest = SpriteCache.hexdigest(self.get_fingerprint())
+            except Uncacheable:
+                digest = False
+            self._fingerprint_digest = digest
+        if digest is False:
+            raise Uncacheable
+        return digest
+
     def get_image(self):
         raise NotImplementedError
 
@@ -517,7 +562,8 @@ class Sprite(Resource):
             else:
                 stack.append(rgb.reshape(wh, 3))
                 stack.append(alpha.reshape(wh, 1))
-        if mask is not None and (bpp == 0 or np.any(mask)):
+        has_mask = mask is not None and (bpp == 0 or np.any(mask))
+        if has_mask:
             info_byte |= 0x4
             bpp += 1
             stack.append(mask.reshape((wh, 1)))
@@ -529,16 +575,110 @@ class Sprite(Resource):
 
         timer.count_composing()
 
-        data = context.sprite_compress(np.ascontiguousarray(raw_data))
-        return struct.pack(
-            '<BBHHhh',
-            info_byte,
-            self.zoom,
-            h,
-            w,
-            xofs,
-            yofs,
-        ) + data
+        compression = self.compression or context.compression
+        raw_data = np.ascontiguousarray(raw_data)
+
+        # Identical sprites (e.g. shared between liveries or alternative sprites) are compressed only once
+        dedup_key = (compression, info_byte, self.zoom, w, h, xofs, yofs, hashlib.blake2b(raw_data, digest_size=16).digest())
+        data = context.find_encoded_sprite(dedup_key)
+        if data is not None:
+            return data
+        start_time = time.time()
+
+        if compression != 'lz77':
+            # Pixels that OpenTTD would consider fully transparent can be skipped in tile compression
+            opaque = None
+            if alpha is not None:
+                opaque = (alpha != 0)
+                if has_mask:
+                    opaque |= (mask != 0)
+            elif rgb is None:
+                opaque = (mask != 0)
+
+            if compression == 'tile' or (opaque is not None and not opaque.all()):
+                if opaque is None:
+                    opaque = np.ones((h, w), dtype=bool)
+                data = struct.pack(
+                    '<BBHHhh',
+                    info_byte | 0x08,
+                    self.zoom,
+                    h,
+                    w,
+                    xofs,
+                    yofs,
+                ) + self._compress_tiles(context, w, h, bpp, raw_data, opaque)
+
+        if compression != 'tile':
+            lz77_data = struct.pack(
+                '<BBHHhh',
+                info_byte,
+                self.zoom,
+                h,
+                w,
+                xofs,
+                yofs,
+            ) + context.sprite_compress(raw_data)
+            # In auto mode use tile compression only if it's smaller
+            if data is None or len(lz77_data) <= len(data):
+                data = lz77_data
+
+        context.add_encoded_sprite(dedup_key, data, time.time() - start_time)
+        return data
+
+    def _compress_tiles(self, context, w, h, bpp, raw_data, opaque):
+        # Tile (chunked) compression: each row is a list of opaque pixel runs,
+        # see DecodeSingleSprite in OpenTTD src/spriteloader/grf.cpp
+        timer = context.start_timer()
+
+        pixels = raw_data.reshape(h, w * bpp)
+        long_format = (w > 256)
+        max_length = 0x7fff if long_format else 0x7f
+        last_flag = 0x8000 if long_format else 0x80
+        chunk_fmt = '<HH' if long_format else '<BB'
+
+        # Find all runs of opaque pixels in one go, padding rows to separate them
+        padded = np.zeros((h, w + 2), dtype=np.int8)
+        padded[:, 1:-1] = opaque
+        edges = np.diff(padded, axis=1)
+        run_rows, run_starts = np.nonzero(edges == 1)
+        run_ends = np.nonzero(edges == -1)[1]
+
+        row_runs = [[] for _ in range(h)]
+        for y, start, end in zip(run_rows.tolist(), run_starts.tolist(), run_ends.tolist()):
+            runs = row_runs[y]
+            while end - start > max_length:
+                runs.append((start, start + max_length))
+                start += max_length
+            runs.append((start, end))
+
+        rows = []
+        for y, runs in enumerate(row_runs):
+            if not runs:
+                # Every row needs at least one chunk
+                rows.append(struct.pack(chunk_fmt, last_flag, 0))
+                continue
+            row = bytearray()
+            row_pixels = pixels[y]
+            for i, (start, end) in enumerate(runs):
+                flags = last_flag if i == len(runs) - 1 else 0
+                row += struct.pack(chunk_fmt, (end - start) | flags, start)
+                row += row_pixels[start * bpp: end * bpp].tobytes()
+            rows.append(row)
+
+        rows_size = sum(map(len, rows))
+        offset_fmt = 'H'
+        if 2 * h + rows_size > 0xffff:
+            offset_fmt = 'I'
+        offset = struct.calcsize(offset_fmt) * h
+        offsets = []
+        for row in rows:
+            offsets.append(offset)
+            offset += len(row)
+        decompressed = struct.pack(f'<{h}{offset_fmt}', *offsets) + b''.join(rows)
+
+        timer.count_composing()
+
+        return struct.pack('<I', len(decompressed)) + context.sprite_compress(np.frombuffer(decompressed, dtype=np.uint8))
 
     def get_resource_files(self):
         return (THIS_FILE,)
@@ -707,6 +847,7 @@ class WithMask(Sprite):
             bpp=self.sprite.bpp,
             crop=self.sprite.crop and self.mask.crop,
             name=name,
+            compression=self.sprite.compression,
         )
 
     def get_data_layers(self, context):
@@ -747,8 +888,8 @@ class WithMask(Sprite):
     def get_fingerprint(self):
         return {
             'class': self.__class__.__name__,
-            'sprite': self.sprite.get_fingerprint(),
-            'mask': self.mask.get_fingerprint(),
+            'sprite': self.sprite.get_fingerprint_digest(),
+            'mask': self.mask.get_fingerprint_digest(),
             'mode': self.mode,
         }
 
@@ -805,6 +946,38 @@ class ImageSprite(Sprite):
         return self._image
 
 
+# In-memory cache of decoded images shared by all ImageFile objects, see set_image_memory_cache
+_image_memory_cache = None
+
+
+def set_image_memory_cache(cache):
+    """
+    @brief Set the cache that ImageFile.load uses to keep decoded images between builds.
+    @param cache MemoryCache or None to disable.
+    @return Previous cache.
+    """
+    global _image_memory_cache
+    res = _image_memory_cache
+    _image_memory_cache = cache
+    return res
+
+
+# Cache of decoded pixels in memory-mapped files used by ImageFile.load, see set_pixel_cache
+_pixel_cache = None
+
+
+def set_pixel_cache(cache):
+    """
+    @brief Set the cache that ImageFile.load uses to map decoded pixels of RGB and RGBA images instead of decoding them.
+    @param cache PixelCache or None to disable.
+    @return Previous cache.
+    """
+    global _pixel_cache
+    res = _pixel_cache
+    _pixel_cache = cache
+    return res
+
+
 class ImageFile(LoadedResourceFile):
     """
     @brief LoadedResourceFile for image files (PNG, etc).
@@ -813,41 +986,93 @@ class ImageFile(LoadedResourceFile):
         self.path = path
         self.colourkey = colourkey
         self._image = None
+        self._pixels = None  # (array, bpp) mapped from the pixel cache, _image is created from it on demand
+        self._loaded_size = None
+        self._shared = False  # image is from the memory cache, other files can use it
 
     def prepare(self, **kw):
         pass
 
     def load(self):
-        if self._image is not None:
+        if self._image is not None or self._pixels is not None:
             return
-        img = Image.open(self.path)
-        if img.mode == 'P':
-            self._image = (img, BPP_8)
-        elif img.mode == 'RGB':
-            self._image = (img, BPP_24)
+        cache = _image_memory_cache
+        if cache is not None:
+            st = os.stat(self.path)
+            key = (os.path.abspath(self.path), st.st_size, st.st_mtime_ns)
+            entry = cache.get(key)
+            if entry is not None:
+                self._image, self._pixels = entry
+                self._shared = True
+                return
+        pixel_cache = _pixel_cache
+        pixels = None if pixel_cache is None else pixel_cache.get(self.path)
+        if pixels is not None:
+            self._pixels = (pixels, BPP_32 if pixels.shape[2] == 4 else BPP_24)
+            size = pixels.nbytes
         else:
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            self._image = (img, BPP_32)
+            img = Image.open(self.path)
+            if img.mode == 'P':
+                self._image = (img, BPP_8)
+            elif img.mode == 'RGB':
+                self._image = (img, BPP_24)
+            else:
+                if img.mode != 'RGBA':
+                    img = img.convert('RGBA')
+                self._image = (img, BPP_32)
+            if pixel_cache is not None and img.mode != 'P':
+                self._pixels = (pixel_cache.set(self.path, np.asarray(img)), self._image[1])
+                img.close()
+                self._image = None
+            elif cache is not None:
+                # Read the pixels now so that the image doesn't need the file anymore
+                img.load()
+            size = img.width * img.height * len(img.getbands())
+        if cache is not None:
+            cache.set(key, (self._image, self._pixels), size)
+            self._shared = True
 
     def unload(self):
-        if self._image is not None:
+        if self._image is not None and not self._shared:
             self._image[0].close()
-            self._image = None
+        self._image = None
+        self._pixels = None
+        self._shared = False
+
+    def get_loaded_size(self):
+        if self._loaded_size is None:
+            # Only reads the image header
+            with Image.open(self.path) as img:
+                w, h = img.size
+                bytes_per_pixel = {'P': 1, 'RGB': 3}.get(img.mode, 4)
+            self._loaded_size = w * h * bytes_per_pixel
+        return self._loaded_size
 
     def get_image(self):
         self.load()
+        if self._image is None:
+            pixels, bpp = self._pixels
+            # Image of the whole file is only needed when a sprite isn't cut with get_pixels
+            self._image = (Image.fromarray(pixels, 'RGBA' if bpp == BPP_32 else 'RGB'), bpp)
         return self._image
 
+    def get_pixels(self):
+        """
+        @brief Get the pixels mapped from the pixel cache (see set_pixel_cache).
+        @return Tuple (read-only numpy array of shape (height, width, channels), bpp) or None if the image isn't mapped.
+        """
+        self.load()
+        return self._pixels
+
 
 class FileSprite(CacheableSprite):
     """
     @brief Sprite representing a subregion of an image file.
     """
-    def __init__(self, file, x, y, w, h, *, xofs=0, yofs=0, zoom=ZOOM_NORMAL, bpp=None, crop=True, name=None, **kw):
+    def __init__(self, file, x, y, w, h, *, xofs=0, yofs=0, zoom=ZOOM_NORMAL, bpp=None, crop=True, name=None, compression=None, **kw):
         assert(isinstance(file, ImageFile))
         assert(file.colourkey is None or bpp != BPP_8)
-        super().__init__(w, h, xofs=xofs, yofs=yofs, bpp=bpp, zoom=zoom, crop=crop, name=name)
+        super().__init__(w, h, xofs=xofs, yofs=yofs, bpp=bpp, zoom=zoom, crop=crop, name=name, compression=compression)
         self.x = x
         self.y = y
         self.file = file
@@ -860,17 +1085,51 @@ class FileSprite(CacheableSprite):
     def prepare_files(self):
         self.file.prepare(**self.kw)
 
+    def _check_area(self, size):
+        if self.w is None or self.h is None and self.x == 0 and self.y == 0:
+            self.w, self.h = size
+        if self.x < 0 or self.y < 0 or self.x + self.w > size[0] or self.y + self.h > size[1]:
+            raise RuntimeError(f"Sprite {self.name} area ({self.x}..{self.x + self.w}, {self.y}..{self.y + self.h}) is outside image borders (0..{size[0]}, 0..{size[1]})")
+
+    def _get_mapped_pixels(self):
+        # Region of the file pixels mapped from the pixel cache, None if file isn't mapped
+        if self.kw:
+            return None
+        pixels = self.file.get_pixels()
+        if pixels is None:
+            return None
+        pixels, bpp = pixels
+        self._check_area((pixels.shape[1], pixels.shape[0]))
+        return pixels[self.y: self.y + self.h, self.x: self.x + self.w], bpp
+
     def get_image(self):
+        pixels = self._get_mapped_pixels()
+        if pixels is not None:
+            region, bpp = pixels
+            return Image.fromarray(np.ascontiguousarray(region), 'RGBA' if bpp == BPP_32 else 'RGB'), bpp
         img, bpp = self.file.get_image(**self.kw)
-        if self.w is None or self.h is None and self.x == 0 and self.y == 0:
-            self.w, self.h = img.size
-        if self.x < 0 or self.y < 0 or self.x + self.w > img.size[0] or self.y + self.h > img.size[1]:
-            raise RuntimeError(f"Sprite {self.name} area ({self.x}..{self.x + self.w}, {self.y}..{self.y + self.h}) is outside image borders (0..{img.size[0]}, 0..{img.size[1]})")
+        self._check_area(img.size)
         img = img.crop((self.x, self.y, self.x + self.w, self.y + self.h))
         return img, bpp
 
+    def _get_mapped_data_layers(self, context):
+        timer = context.start_timer()
+        pixels = self._get_mapped_pixels()
+        timer.count_loading()
+        if pixels is None or self.bpp is not None and pixels[1] != self.bpp:
+            return None
+        region, bpp = pixels
+        h, w = region.shape[:2]
+        if bpp == BPP_32:
+            return w, h, region[:, :, :3], region[:, :, 3], None
+        return w, h, region, None, None
+
     def get_data_layers(self, context):
-        w, h, rgb, alpha, mask = super().get_data_layers(context)
+        # Layers are sliced from the mapped pixels without a copy unless they need a conversion
+        layers = self._get_mapped_data_layers(context)
+        if layers is None:
+            layers = super().get_data_layers(context)
+        w, h, rgb, alpha, mask = layers
         if self.file.colourkey is not None:
             is_key = np.all(np.equal(rgb, self.file.colourkey), axis=2)
             if np.any(is_key):
@@ -954,7 +1213,7 @@ class SpriteWrapper(Sprite):
         except StopIteration:
             raise ValueError('SpriteWrapper got no sprites to wrap')
 
-        super().__init__(w=f.w, h=f.h, xofs=f.xofs, yofs=f.yofs, zoom=f.zoom, bpp=f.bpp, crop=f.crop)
+        super().__init__(w=f.w, h=f.h, xofs=f.xofs, yofs=f.yofs, zoom=f.zoom, bpp=f.bpp, crop=f.crop, compression=f.compression)
 
     def _iter_sprites(self):
         if isinstance(self.sprites, dict):
@@ -980,15 +1239,14 @@ class SpriteWrapper(Sprite):
                 if s is None:
                     sf[k] = None
                 else:
-                    f = s.get_fingerprint()
-                    sf[k] = s.get_fingerprint()
+                    sf[k] = s.get_fingerprint_digest()
         else:
             sf = []
             for s in self.sprites:
                 if s is None:
                     sf.append(None)
                     continue
-                sf.append(s.get_fingerprint())
+                sf.append(s.get_fingerprint_digest())
         res['sprites'] = sf
         return res
 
@@ -1064,7 +1322,7 @@ class ZoomDebugRecolourSprite(Sprite):
 
     def __init__(self, sprite):
         self.sprite = sprite
-        super().__init__(w=sprite.w, h=sprite.h, xofs=sprite.xofs, yofs=sprite.yofs, zoom=sprite.zoom, bpp=sprite.bpp)
+        super().__init__(w=sprite.w, h=sprite.h, xofs=sprite.xofs, yofs=sprite.yofs, zoom=sprite.zoom, bpp=sprite.bpp, compression=sprite.compression)
 
     def get_data_layers(self, context):
         w, h, ni, na, nm = self.sprite.get_data_layers(context)
@@ -1087,5 +1345,5 @@ class ZoomDebugRecolourSprite(Sprite):
     def get_fingerprint(self):
         return {
             'class': self.__class__.__name__,
-            'sprite': self.sprite.get_fingerprint(),
+            'sprite': self.sprite.get_fingerprint_digest(),
         }
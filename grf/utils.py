@@ -1,14 +1,15 @@
 import argparse
 import asyncio
-import time
 import os
 import subprocess
 import signal
+import sys
 import traceback
 from concurrent.futures.thread import ThreadPoolExecutor
 from pathlib import Path
 
 from .grf import BaseNewGRF
+from .va2opt import OPTIMIZATION_LEVELS
 
 OPENTTD = '/home/dp/Projects/OpenTTD/build-release/openttd'
 
@@ -80,19 +81,34 @@ async def admin_logging(queue, admin_addr):
 
 def build_func(g, grf_file, args):
     print(f'Building {grf_file}')
+    if args is not None and args.shared_cache is not None:
+        g.shared_sprite_cache = args.shared_cache
+    if args is not None and args.optimize is not None:
+        g.code_optimization = args.optimize
+    if args is not None and args.cost_report:
+        g.cost_report = True
     g.write(
         grf_file,
         clean_build=False if args is None else args.clean,
         debug_zoom_levels=False if args is None else args.debug_zoom_levels,
+        jobs=1 if args is None else args.jobs,
     )
 
 
-async def async_compile(g, grf_file, queue, admin_addr):
+async def async_compile(g, grf_file, queue, admin_addr, changed_files=None, incremental=False, reload_func=None):
     loop = asyncio.get_running_loop()
     executor = ThreadPoolExecutor(max_workers=1)
 
     def compile_func(g, grf_file):
-        watched = g.write(grf_file)
+        # Code changes replace the grf object, it needs a full build
+        new_g = None if reload_func is None else reload_func(changed_files)
+        if new_g is not None:
+            g = new_g
+            watched = g.write(grf_file, keep_build=incremental)
+        elif incremental and changed_files:
+            watched = g.rebuild(grf_file, changed_files)
+        else:
+            watched = g.write(grf_file, keep_build=incremental)
         queue.put_nowait(None)
         g._context.print(f'Reloading newgrfs.')
         return watched
@@ -116,6 +132,28 @@ def watch_func(g, grf_file, args):
     import watchdog.events
     import watchdog.observers
 
+    if args.optimize is not None:
+        g.code_optimization = args.optimize
+
+    reloader = None
+    if args.reload_code:
+        from .reload import CodeReloader
+        script = getattr(sys.modules['__main__'], '__file__', None)
+        if script is None:
+            print(f'Main script file is unknown, code reload unavailable')
+        else:
+            reloader = CodeReloader(script, g)
+
+    def reload_func(changed_files):
+        nonlocal g
+        if reloader is None or not changed_files or not reloader.is_code_change(changed_files):
+            return None
+        g._context.print(f'Reloading code')
+        g = reloader.reload(changed_files)
+        if args.optimize is not None:
+            g.code_optimization = args.optimize
+        return g
+
     admin_addr = None
     if args.live_reload is not None:
         s = args.live_reload
@@ -133,18 +171,30 @@ def watch_func(g, grf_file, args):
         print(f'No admin port specified, live reload unavailable')
 
     class FileChangeHandler(watchdog.events.FileSystemEventHandler):
-        def __init__(self, file_list):
-            self.file_list = file_list
-            self.modified = set()
-
-        def reset(self):
-            self.modified = set()
+        # Called from the observer thread, passes changes of the watched files to the event loop
+        def __init__(self, loop, notify):
+            self.loop = loop
+            self.notify = notify
+            self.file_list = None
 
-        def on_modified(self, event):
+        def _check(self, path):
             if self.file_list is None:
                 return
-            if Path(event.src_path).resolve() in self.file_list:
-                self.modified.add(event.src_path)
+            if Path(path).resolve() in self.file_list:
+                self.loop.call_soon_threadsafe(self.notify, path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                self._check(event.src_path)
+
+        def on_created(self, event):
+            if not event.is_directory:
+                self._check(event.src_path)
+
+        def on_moved(self, event):
+            # Editors often save by renaming a temporary file
+            if not event.is_directory:
+                self._check(event.dest_path)
 
     queue = None
 
@@ -157,42 +207,71 @@ def watch_func(g, grf_file, args):
     g._context.add_print_handler(print_func)
 
     async def run_compile():
-        event_handler = FileChangeHandler(None)
+        modified = set()
+        changed = asyncio.Event()
+
+        def notify(path):
+            modified.add(path)
+            changed.set()
+
+        async def wait_for_changes():
+            await changed.wait()
+            # Files are often written in several steps, wait until they stop changing
+            while True:
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), args.debounce / 1000)
+                except asyncio.TimeoutError:
+                    break
+
+        event_handler = FileChangeHandler(asyncio.get_running_loop(), notify)
         observer = watchdog.observers.Observer()
+        watched_dirs = set()
         observer.start()
         nonlocal queue
         try:
+            build_all = True
             while True:
-                time.sleep(1)
-                if event_handler.modified or event_handler.file_list is None:
-                    time.sleep(1)
-                    modified_files = ', '.join(event_handler.modified)
-                    event_handler.reset()
-                    queue = asyncio.Queue()
-                    if not modified_files:
-                        g._context.print(f"Building {grf_file}")
-                    else:
-                        g._context.print(f"{modified_files} has been modified, rebuilding {grf_file}")
-                    prev_watched = event_handler.file_list
-                    watched_files = await async_compile(g, grf_file, queue, admin_addr)
-                    if watched_files is None:
-                        if prev_watched is None:
-                            g._context.print(f'Grf build failed, retrying in 10 seconds...')
-                            time.sleep(10)
-                    else:
-                        event_handler.file_list = {Path(f).resolve() for f in watched_files}
-                        if prev_watched != watched_files:
-                            g._context.print(f'Watching {len(watched_files)} files for changes...')
-                        for file_path in watched_files:
-                            if prev_watched is not None and file_path in prev_watched:
-                                continue
-                            observer.schedule(event_handler, os.path.dirname(file_path), recursive=False)
-
-        except KeyboardInterrupt:
+                # Changes made during the build are collected and trigger one more build after it
+                if not build_all:
+                    await wait_for_changes()
+                changed_files = set(modified)
+                modified.clear()
+                queue = asyncio.Queue()
+                if not changed_files:
+                    g._context.print(f"Building {grf_file}")
+                else:
+                    g._context.print(f"{', '.join(sorted(changed_files))} has been modified, rebuilding {grf_file}")
+                prev_watched = event_handler.file_list
+                watched_files = await async_compile(g, grf_file, queue, admin_addr,
+                                                    changed_files=changed_files, incremental=not args.full_rebuild,
+                                                    reload_func=reload_func)
+                build_all = False
+                if watched_files is not None and reloader is not None:
+                    watched_files = set(watched_files) | reloader.get_files()
+                if watched_files is None:
+                    if prev_watched is None:
+                        g._context.print(f'Grf build failed, retrying in 10 seconds...')
+                        await asyncio.sleep(10)
+                        build_all = True
+                else:
+                    event_handler.file_list = {Path(f).resolve() for f in watched_files}
+                    if prev_watched != event_handler.file_list:
+                        g._context.print(f'Watching {len(watched_files)} files for changes...')
+                    for file_path in watched_files:
+                        dir_path = os.path.dirname(os.path.abspath(file_path))
+                        if dir_path in watched_dirs:
+                            continue
+                        watched_dirs.add(dir_path)
+                        observer.schedule(event_handler, dir_path, recursive=False)
+        finally:
             observer.stop()
-        observer.join()
+            observer.join()
 
-    asyncio.run(run_compile())
+    try:
+        asyncio.run(run_compile())
+    except KeyboardInterrupt:
+        pass
     # process.send_signal(signal.SIGKILL)
 
 
@@ -202,9 +281,15 @@ def init_id_map_func(g, grf_file, args):
     print(f'Created id_map.json')
 
 
+# Called by main instead of running a command when the script is executed again after reloading the code (see grf.reload)
+main_hook = None
+
+
 def main(g, grf_file, commands=None):
     assert isinstance(g, BaseNewGRF)
     assert isinstance(grf_file, str)
+    if main_hook is not None:
+        return main_hook(g, grf_file)
     parser = argparse.ArgumentParser(description=getattr(g, 'name', None))
 
     # Create subparsers for different commands
@@ -214,6 +299,10 @@ def main(g, grf_file, commands=None):
     build_parser = subparsers.add_parser('build', help='Build newgrf')
     build_parser.add_argument('--clean', action='store_true', help='Clean build (don''t use sprite cache)')
     build_parser.add_argument('--debug-zoom-levels', action='store_true', help='Recolor sprites according to their zoom level: 4x - red, 2x - blue, 1x - green, out-2x - cyan, out-4x - yellow, out-8x - magenta')
+    build_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to use for sprite encoding')
+    build_parser.add_argument('--shared-cache', type=str, help='URL of the sprite cache server or path to a shared cache directory')
+    build_parser.add_argument('-O', '--optimize', type=int, choices=OPTIMIZATION_LEVELS, help='Optimization level of switch code: 0 - none, 1 - fold constants, remove dead code and common subexpressions (default: as set in the NewGRF)')
+    build_parser.add_argument('--cost-report', action='store_true', help='Print estimated in-game cost of every callback chain (switches, operations and expensive variable reads)')
     # create_parser.add_argument('--size', type=int, required=True, help='Size of the item')
     build_parser.set_defaults(func=build_func)
 
@@ -221,6 +310,10 @@ def main(g, grf_file, commands=None):
     watch_parser = subparsers.add_parser('watch', help='Build newgrf and rebuild if any files changed')
     watch_parser.set_defaults(func=watch_func)
     watch_parser.add_argument('--live-reload', type=str, help='Admin port to connect in a form password@address:port')
+    watch_parser.add_argument('-O', '--optimize', type=int, choices=OPTIMIZATION_LEVELS, help='Optimization level of switch code: 0 - none, 1 - fold constants, remove dead code and common subexpressions (default: as set in the NewGRF)')
+    watch_parser.add_argument('--full-rebuild', action='store_true', help='Build everything on every change instead of encoding only the sprites that use the changed files')
+    watch_parser.add_argument('--reload-code', action='store_true', help='Reload changed Python modules of the project and run the script again in the same process instead of only watching resource files')
+    watch_parser.add_argument('--debounce', type=int, default=50, help='Milliseconds without further changes to wait before rebuilding (default: 50)')
 
     watch_parser = subparsers.add_parser('init_id_map', help='Initialize the automatic id index (id_map.json)')
     watch_parser.set_defaults(func=init_id_map_func)
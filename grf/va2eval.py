@@ -0,0 +1,317 @@
+"""
+Interpreter of VarAction2 and RandomAction2 chains.
+
+Resolves actions the same way OpenTTD does: switches are executed from their encoded data (so it also
+checks the switch code compiler and optimizer) against supplied variable values and references are
+followed until a callback result or a non-switch action (sprite set, layout, etc.) is reached.
+Counts evaluated switches, operations and variable reads, e.g. to measure the cost of a callback.
+
+Encoded data refers to other actions by id so they need to be assigned first (see `BaseNewGRF.resolve_refs`).
+
+Variables are passed as a dict with the following keys:
+- variable number, e.g. `0x42`,
+- tuple of variable number and parameter for 60+x variables, e.g. `(0x61, 0x42)`,
+- variable name of the feature, e.g. `'current_callback'`, value is put into the bits of its variable.
+"""
+import struct
+from collections import Counter
+
+from .actions import Ref, Switch, RandomSwitch, Action3, ReferenceableAction, get_ref_id
+from .common import DummyWriteContext, VEHICLE_FEATURES
+from .parser import eval_op, OP_ADD, OP_DIV, OP_MOD, OP_TSTO, OP_PSTO
+from .va2vars import VA2_VARS
+
+
+CALLBACK_FAILED = 0xffff
+
+# Variables that don't read anything from the game
+CONSTANT_VARS = {0x1a}
+
+
+class EvalResult:
+    """Result of the chain evaluation with the cost of getting it."""
+
+    def __init__(self):
+        # Callback result or the last action in the chain
+        self.result = None
+        self.is_callback = False
+        # Switches and random switches in the order they were evaluated, including called ones
+        self.path = []
+        self.num_ops = 0
+        self.num_var_reads = 0
+        self.num_calls = 0
+        # (var, param) -> number of reads, param is None for variables without one
+        self.var_reads = Counter()
+        # Registers after the evaluation
+        self.temp = {}
+        self.perm = {}
+
+    @property
+    def num_nodes(self):
+        return len(self.path)
+
+    def __repr__(self):
+        result = f'CB({self.result})' if self.is_callback else self.result
+        return f'EvalResult({result}, nodes={self.num_nodes}, ops={self.num_ops}, var_reads={self.num_var_reads})'
+
+
+def make_variables(feature, variables):
+    """
+    @brief Convert variable values to the form used by the interpreter.
+    @param feature Feature to look variable names up for.
+    @param variables Dict of variable values, see module description for the keys.
+    @return Dict of values with variable number or tuple of variable number and parameter as a key.
+    """
+    res = {}
+    for k, v in (variables or {}).items():
+        if not isinstance(k, str):
+            res[k] = v & 0xffffffff
+            continue
+        var_data = VA2_VARS[feature].get(k)
+        if var_data is None:
+            raise ValueError(f'Unknown variable `{k}` for feature {feature}')
+        key = var_data['var']
+        if 'param' in var_data:
+            key = (key, var_data['param'])
+        mask = (1 << var_data['size']) - 1
+        res[key] = res.get(key, 0) | (v & mask) << var_data['start']
+    return res
+
+
+class _State:
+    def __init__(self, result, variables, related_variables, random_bits):
+        self.result = result
+        self.variables = variables
+        self.related_variables = related_variables
+        self.random_bits = random_bits
+        self.last_value = 0  # var 0x1C, result of the last evaluated switch
+        # Variable names depend on the scope feature so they're converted on the first use
+        self._converted = {}
+
+    def get_variables(self, related, feature):
+        key = (related, feature)
+        res = self._converted.get(key)
+        if res is None:
+            res = self._converted[key] = make_variables(feature, self.related_variables if related else self.variables)
+        return res
+
+
+class Interpreter:
+    def __init__(self, *, code_optimization=0, refs=None, parameters=None, default_value=None):
+        """
+        @brief Create an interpreter.
+        @param code_optimization Optimization level to compile switch code with.
+        @param refs Dict of actions that direct references (`Ref`) point to by id.
+        @param parameters Dict of GRF parameter values (var 0x7F), missing ones are 0.
+        @param default_value Value of variables that weren't passed, None to raise an error.
+        """
+        self.code_optimization = code_optimization
+        self.refs = refs or {}
+        self.parameters = parameters or {}
+        self.default_value = default_value
+        self._decoded = {}
+
+    def evaluate(self, action, variables=None, *, related_variables=None, cargo=None, random_bits=0, perm=None):
+        """
+        @brief Evaluate the action chain.
+        @param action Action to start from: `Action3`/`Map`, `Switch` or `RandomSwitch`.
+        @param variables Dict of variable values of the object.
+        @param related_variables Dict of variable values of the related object (for related scope switches).
+        @param cargo Cargo to pick from the maps of `Action3`, default is used if it's None or not mapped.
+        @param random_bits Random bits of the object for random switches.
+        @param perm Dict of persistent register values, isn't modified.
+        @return EvalResult.
+        """
+        res = EvalResult()
+        res.perm = dict(perm or {})
+        state = _State(res, variables, related_variables, random_bits)
+
+        kind = 'action'
+        if isinstance(action, Action3):
+            action = action.maps.get(cargo, action.default) if cargo is not None else action.default
+            kind, action = self.get_ref(None, get_ref_id(action), action)
+        kind, value = (kind, action) if kind == 'callback' else self._resolve(action, state)
+        res.is_callback = kind == 'callback'
+        res.result = value
+        return res
+
+    def get_ref(self, action, ref_id, obj=None):
+        """
+        @brief Find what the reference from the encoded data of the action points to.
+        @param action Action with the reference.
+        @param ref_id Encoded reference.
+        @param obj Referenced object if it's known.
+        @return Tuple ('callback', value) or ('action', referenced action).
+        """
+        if ref_id & 0x8000:
+            return ('callback', ref_id & 0x7fff)
+        if obj is None:
+            for r in action.get_refs():
+                if isinstance(r, ReferenceableAction) and r.ref_id == ref_id:
+                    obj = r
+                    break
+        if isinstance(obj, Ref) or obj is None:
+            obj = self.refs.get(ref_id)
+            if obj is None:
+                raise ValueError(f'Unknown reference to id {ref_id}')
+        return ('action', obj)
+
+    def compute(self, action, variables=None):
+        """
+        @brief Run the code of a single switch without following references.
+        @param action Switch.
+        @param variables Dict of variable values (of the related object for related scope switches).
+        @return Computed value.
+        """
+        related, adjusts, _, _ = self.decode(action)
+        state = _State(EvalResult(), variables, variables, 0)
+        return self._run(action, related, adjusts, state)
+
+    def decode(self, action):
+        """
+        @brief Decode encoded data of the switch or random switch (result is cached).
+        @param action Switch or RandomSwitch.
+        @return For switch a tuple (related scope flag, adjusts, ranges, default), adjusts are tuples
+                (operation, variable, parameter, shift byte, and mask, add value, div/mod value) and ranges
+                are tuples (reference, low, high). For random switch a tuple (lowest bit, references).
+        """
+        res = self._decoded.get(id(action))
+        if res is not None and res[0] is action:
+            return res[1]
+        context = DummyWriteContext()
+        context.code_optimization = self.code_optimization
+        data = action.get_data(context)
+        if isinstance(action, Switch):
+            decoded = self._decode_switch(data)
+        else:
+            decoded = self._decode_random_switch(data, action.scope == 'relative' and action.feature not in VEHICLE_FEATURES)
+        self._decoded[id(action)] = (action, decoded)
+        return decoded
+
+    def _decode_switch(self, data):
+        if data[3] not in (0x89, 0x8a):
+            raise NotImplementedError(f'Only dword switches are supported, got type 0x{data[3]:02x}')
+        related = data[3] == 0x8a
+        pos = 4
+        adjusts = []
+        while True:
+            op = OP_ADD
+            if adjusts:
+                op = data[pos]
+                pos += 1
+            var = data[pos]
+            pos += 1
+            param = None
+            if 0x60 <= var < 0x80:
+                param = data[pos]
+                pos += 1
+            shift = data[pos]
+            and_mask, = struct.unpack_from('<I', data, pos + 1)
+            pos += 5
+            add_val = divmod_val = None
+            if shift & 0xc0:
+                add_val, divmod_val = struct.unpack_from('<II', data, pos)
+                pos += 8
+            adjusts.append((op, var, param, shift, and_mask, add_val, divmod_val))
+            if not shift & 0x20:
+                break
+        nvar = data[pos]
+        ranges = [struct.unpack_from('<HII', data, pos + 1 + i * 10) for i in range(nvar)]
+        default, = struct.unpack_from('<H', data, pos + 1 + nvar * 10)
+        return related, adjusts, ranges, default
+
+    def _decode_random_switch(self, data, has_count):
+        pos = 5 if has_count else 4
+        lowest_bit, num_groups = data[pos + 1], data[pos + 2]
+        groups = struct.unpack_from('<' + 'H' * num_groups, data, pos + 3)
+        return lowest_bit, groups
+
+    def _resolve(self, action, state):
+        # Follows the chain until something that isn't a switch
+        while True:
+            if isinstance(action, Switch):
+                state.result.path.append(action)
+                related, adjusts, ranges, default = self.decode(action)
+                value = self._run(action, related, adjusts, state)
+                state.last_value = value
+                if not ranges:
+                    # Switch without ranges returns the value as a callback result
+                    return ('callback', value if value == CALLBACK_FAILED else value & 0x7fff)
+                ref_id = default
+                for rid, low, high in ranges:
+                    if low <= value <= high:
+                        ref_id = rid
+                        break
+                kind, action = self.get_ref(action, ref_id)
+            elif isinstance(action, RandomSwitch):
+                state.result.path.append(action)
+                lowest_bit, groups = self.decode(action)
+                ref_id = groups[(state.random_bits >> lowest_bit) & (len(groups) - 1)]
+                kind, action = self.get_ref(action, ref_id)
+            else:
+                return ('action', action)
+            if kind == 'callback':
+                return (kind, action)
+
+    def _run(self, action, related, adjusts, state):
+        res = state.result
+        variables = state.get_variables(related, action._get_code_feature())
+        last_value = 0
+        for op, var, param, shift, and_mask, add_val, divmod_val in adjusts:
+            res.num_ops += 1
+            if var == 0x7e:
+                res.num_calls += 1
+                kind, value = self._resolve(self.get_ref(action, param)[1], state)
+                if kind != 'callback':
+                    value = CALLBACK_FAILED
+            elif var == 0x7b:
+                value = self._read_var(variables, param, last_value, state)
+            else:
+                value = self._read_var(variables, var, param, state)
+            value = (value >> (shift & 0x1f)) & and_mask
+            if shift & 0xc0 == 0x40:
+                value = eval_op(OP_DIV, value + add_val, divmod_val)
+            elif shift & 0xc0 == 0x80:
+                value = eval_op(OP_MOD, value + add_val, divmod_val)
+            if op == OP_TSTO:
+                res.temp[value] = last_value
+            elif op == OP_PSTO:
+                res.perm[value] = last_value
+            else:
+                last_value = eval_op(op, last_value, value)
+        return last_value
+
+    def _read_var(self, variables, var, param, state):
+        res = state.result
+        if var in CONSTANT_VARS:
+            return 0xffffffff
+        if not 0x60 <= var < 0x80:
+            param = None
+        res.num_var_reads += 1
+        res.var_reads[(var, param)] += 1
+        if var == 0x1c:
+            return state.last_value
+        if var == 0x7c:
+            return res.perm.get(param, 0)
+        if var == 0x7d:
+            return res.temp.get(param, 0)
+        if var == 0x7f:
+            return self.parameters.get(param, 0)
+        value = variables.get(var if param is None else (var, param))
+        if value is None:
+            if self.default_value is None:
+                param_str = '' if param is None else f' with parameter 0x{param:02x}'
+                raise ValueError(f'Value of variable 0x{var:02x}{param_str} is not set')
+            value = self.default_value
+        return value
+
+
+def evaluate(action, variables=None, **kw):
+    """
+    @brief Evaluate the action chain with a new interpreter, see `Interpreter.evaluate`.
+    @param action Action to start from.
+    @param variables Dict of variable values.
+    @return EvalResult.
+    """
+    interpreter_args = {k: kw.pop(k) for k in ('code_optimization', 'refs', 'parameters', 'default_value') if k in kw}
+    return Interpreter(**interpreter_args).evaluate(action, variables, **kw)
@@ -0,0 +1,576 @@
+"""
+Optimizer of parsed switch (VarAction2) code.
+
+Works on the list of expressions produced by `parse_code` and returns a new list, nodes of the
+original code are never modified as parsed code is shared between switches.
+
+Level 0 disables optimization, level 1 does:
+- constant folding and removal of operations that don't change the value,
+- folding of masks and shifts into variable reads,
+- swapping operands of commutative operations to avoid spilling to a temporary register,
+- removal of statements without side effects which value is discarded,
+- removal of unused local variables and of temporary stores overwritten before they are read,
+- common subexpression elimination.
+
+Local variables and common subexpressions are assigned temporary registers from 0x80 up (skipping ones
+that the code uses explicitly), register is reused once the last read of its value is evaluated.
+"""
+from collections import Counter
+
+from .parser import Node, Expr, Value, Var, GenericVar, Temp, Perm, Call, CallByName, AssignVariable, \
+                    eval_op, OP_ADD, OP_SUB, OP_MIN, OP_MAX, OP_MINU, OP_MAXU, OP_DIV, OP_DIVU, OP_MODU, \
+                    OP_MUL, OP_AND, OP_OR, OP_XOR, OP_TSTO, OP_PSTO, OP_ROT, OP_SHL, OP_SHRU, OP_SHR
+from .va2vars import VA2_VARS
+
+
+OPTIMIZATION_LEVELS = (0, 1)
+
+# Variables that can change their value while the switch is evaluated
+VOLATILE_VARS = {0x1c, 0x7b, 0x7c, 0x7d, 0x7e}
+
+COMMUTATIVE_OPS = {OP_ADD, OP_MUL, OP_AND, OP_OR, OP_XOR, OP_MIN, OP_MAX, OP_MINU, OP_MAXU}
+ASSOCIATIVE_OPS = {OP_ADD, OP_MUL, OP_AND, OP_OR, OP_XOR}
+
+# Operand value that makes the operation return the first argument unchanged
+IDENTITY_VALUES = {
+    OP_ADD: 0,
+    OP_SUB: 0,
+    OP_OR: 0,
+    OP_XOR: 0,
+    OP_MUL: 1,
+    OP_DIV: 1,
+    OP_DIVU: 1,
+    OP_AND: 0xffffffff,
+}
+SHIFT_OPS = {OP_SHL, OP_SHRU, OP_SHR, OP_ROT}
+
+
+class Def(Node):
+    """Value of an expression kept for later `Use` nodes, becomes a temporary store after register allocation."""
+
+    def __init__(self, expression, slot):
+        super().__init__()
+        self.expression = expression
+        self.slot = slot
+
+    def format(self, parent_priority=0):
+        res = f'${self.slot} = {self.expression.format(2)}'
+        return f'({res})' if parent_priority >= 2 else res
+
+
+class Use(Node):
+    """Reads the value kept by `Def`, becomes a temporary register read after register allocation."""
+
+    def __init__(self, slot):
+        super().__init__()
+        self.slot = slot
+
+    def format(self, parent_priority=0):
+        return f'${self.slot}'
+
+
+class Spill(Node):
+    """
+    Compiles the expression as a complex operand: it's evaluated before the first operand of the operation
+    and kept in a temporary register. Keeps the evaluation order when folding makes an operand simple.
+    """
+
+    def __init__(self, expression):
+        super().__init__()
+        self.expression = expression
+
+    def format(self, parent_priority=0):
+        return self.expression.format(parent_priority)
+
+    def compile(self, context, shift=0, and_mask=0xffffffff):
+        return False, self.expression.compile(context, shift, and_mask)[1]
+
+
+def _is_const_register(register):
+    return isinstance(register, (int, Value))
+
+
+def _register_value(register):
+    return register if isinstance(register, int) else register.value
+
+
+def _is_value(node):
+    # Whether node compiles to a single adjust (as returned by `compile`), determines the evaluation order
+    if isinstance(node, (Temp, Perm)):
+        return _is_const_register(node.register)
+    return not isinstance(node, (Expr, AssignVariable, Def, Spill))
+
+
+def _children(node):
+    # Children in the order they are evaluated
+    if isinstance(node, Expr):
+        return (node.a, node.b) if _is_value(node.b) else (node.b, node.a)
+    if isinstance(node, GenericVar):
+        return () if node.param is None else (node.param,)
+    if isinstance(node, (Temp, Perm)):
+        return () if _is_const_register(node.register) else (node.register,)
+    if isinstance(node, AssignVariable):
+        return (node.expression,)
+    if isinstance(node, (Def, Spill)):
+        return (node.expression,)
+    return ()
+
+
+def _replace_children(node, children):
+    if isinstance(node, Expr):
+        if _is_value(node.b):
+            a, b = children
+        else:
+            b, a = children
+        if a is node.a and b is node.b:
+            return node
+        if not _is_value(node.b) and _is_value(b) and not _is_independent(a, b):
+            # Simple operand would be evaluated after the first one instead of before it
+            b = Spill(b)
+        return Expr(node.op, a, b)
+    if not children or children[0] is _children(node)[0]:
+        return node
+    child, = children
+    if isinstance(node, GenericVar):
+        return _make_var(node, param=child)
+    if isinstance(node, (Temp, Perm)):
+        return node.__class__(child)
+    if isinstance(node, AssignVariable):
+        return AssignVariable(node.variable, child)
+    if isinstance(node, Def):
+        return Def(child, node.slot)
+    if isinstance(node, Spill):
+        return Spill(child)
+    raise ValueError(node)
+
+
+def _make_var(node, **kw):
+    args = dict(var=node.var, shift=node.shift, and_mask=node.and_mask, type=node.type, add_val=node.add_val,
+                divmod_val=node.divmod_val, param=node.param)
+    args.update(kw)
+    return GenericVar(**args)
+
+
+def _transform(node, func):
+    # Applies func to every node after its children in the evaluation order
+    children = _children(node)
+    if children:
+        node = _replace_children(node, tuple(_transform(c, func) for c in children))
+    return func(node)
+
+
+def _walk(node):
+    # Yields nodes in the evaluation order
+    for c in _children(node):
+        yield from _walk(c)
+    yield node
+
+
+def _is_call(node):
+    return isinstance(node, (Call, CallByName)) or isinstance(node, GenericVar) and node.var == 0x7e
+
+
+def _is_pure(node):
+    # Whether node always evaluates to the same value and has no side effects
+    if isinstance(node, Expr):
+        return node.op not in (OP_TSTO, OP_PSTO) and _is_pure(node.a) and _is_pure(node.b)
+    if isinstance(node, GenericVar):
+        return node.var not in VOLATILE_VARS and (node.param is None or _is_pure(node.param))
+    return isinstance(node, (Value, Use))
+
+
+def _has_side_effects(node):
+    for n in _walk(node):
+        if isinstance(n, Expr) and n.op in (OP_TSTO, OP_PSTO):
+            return True
+        if isinstance(n, (AssignVariable, Def)) or _is_call(n):
+            return True
+    return False
+
+
+def _is_independent(a, b):
+    # Whether a and b give the same results in either evaluation order
+    if _has_side_effects(a) and not _is_pure(b):
+        return False
+    return not _has_side_effects(b) or _is_pure(a)
+
+
+def _cost(node):
+    # Estimated number of adjusts in the compiled code
+    if isinstance(node, Expr):
+        if _is_value(node.b):
+            return _cost(node.a) + _cost(node.b)
+        return _cost(node.a) + _cost(node.b) + 2
+    if isinstance(node, (AssignVariable, Def)):
+        return _cost(node.expression) + 1
+    if isinstance(node, Spill):
+        return _cost(node.expression)
+    return sum(_cost(c) for c in _children(node)) + 1
+
+
+def _key(node):
+    # Structural key of a pure node
+    if isinstance(node, Value):
+        return ('v', node.value & 0xffffffff)
+    if isinstance(node, Use):
+        return ('u', node.slot)
+    if isinstance(node, GenericVar):
+        param = None if node.param is None else _key(node.param)
+        return ('g', node.var, node.shift, node.and_mask, node.type, node.add_val, node.divmod_val, param)
+    return ('e', node.op, _key(node.a), _key(node.b))
+
+
+class Optimizer:
+    def __init__(self, feature):
+        self.feature = feature
+        self._next_slot = 0
+
+    def _new_slot(self):
+        self._next_slot += 1
+        return self._next_slot
+
+    def optimize(self, code):
+        code = [_transform(c, self._fold) for c in code]
+        code = self._rename_variables(code)
+        code = self._inline_definitions(code)
+        code = [_transform(c, self._fold) for c in code]
+        code = self._remove_dead_stores(code)
+        code = self._remove_dead_code(code)
+        if not any(_is_call(n) for c in code for n in _walk(c)):
+            # Called switches use the same registers so values can't be kept across calls
+            code = self._eliminate_common_subexpressions(code)
+        code = self._allocate_registers(code)
+        # Operands of uses and definitions may be swapped now to avoid spills
+        return [_transform(c, self._fold) for c in code]
+
+    def _fold(self, node):
+        if isinstance(node, Var):
+            # Replace feature variables with generic ones so masks and shifts can be folded in
+            var_data = VA2_VARS[node.feature].get(node.name)
+            if var_data is None or node.param is not None:
+                return node
+            param = var_data.get('param')
+            return GenericVar(
+                var=var_data['var'],
+                shift=var_data['start'],
+                and_mask=(1 << var_data['size']) - 1,
+                param=None if param is None else Value(param),
+            )
+
+        # Constant parameters and registers are folded to values as children of the node
+        if isinstance(node, (GenericVar, Temp, Perm)):
+            return node
+
+        if not isinstance(node, Expr) or node.op in (OP_TSTO, OP_PSTO):
+            return node
+
+        op, a, b = node.op, node.a, node.b
+        if isinstance(a, Value) and isinstance(b, Value):
+            return Value(eval_op(op, a.value, b.value))
+
+        if op in COMMUTATIVE_OPS and _is_value(a) and (isinstance(a, Value) or not _is_value(b)):
+            # Constant goes second to be folded with the rest, and a complex
+            # operand goes first so it doesn't need a temporary register.
+            # Complex operand is evaluated first in both cases.
+            if not isinstance(b, Value):
+                return self._fold(Expr(op, b, a))
+
+        if not isinstance(b, Value):
+            return node
+        value = b.value & 0xffffffff
+
+        if isinstance(a, Expr) and isinstance(a.b, Value):
+            if op in ASSOCIATIVE_OPS and a.op == op:
+                return self._fold(Expr(op, a.a, Value(eval_op(op, a.b.value, value))))
+            if op in (OP_ADD, OP_SUB) and a.op in (OP_ADD, OP_SUB):
+                total = a.b.value if a.op == OP_ADD else -a.b.value
+                total += value if op == OP_ADD else -value
+                return self._fold(Expr(OP_ADD, a.a, Value(total & 0xffffffff)))
+
+        if IDENTITY_VALUES.get(op) == value:
+            return a
+        if op in SHIFT_OPS and value & 0x1f == 0:
+            return a
+        if op in (OP_MUL, OP_AND) and value == 0 and _is_pure(a):
+            return Value(0)
+        if op == OP_MODU and value == 1 and _is_pure(a):
+            return Value(0)
+
+        if isinstance(a, GenericVar) and a.type == 0:
+            if op == OP_AND:
+                return _make_var(a, and_mask=a.and_mask & value)
+            if op in (OP_SHRU, OP_SHR):
+                shift = value & 0x1f
+                # Arithmetic shift is the same as the logical one for non-negative values
+                if a.shift + shift < 0x20 and (op == OP_SHRU or a.and_mask < 0x80000000):
+                    return _make_var(a, shift=a.shift + shift, and_mask=a.and_mask >> shift)
+
+        return node
+
+    def _rename_variables(self, code):
+        # Gives every assignment of a local variable its own register (allocated on compilation)
+        slots = {}
+
+        def rename(node):
+            if isinstance(node, AssignVariable):
+                slot = self._new_slot()
+                slots[node.variable] = slot
+                return Def(node.expression, slot)
+            if isinstance(node, Var) and node.name not in VA2_VARS[node.feature] and node.name in slots:
+                return Use(slots[node.name])
+            return node
+
+        return [_transform(c, rename) for c in code]
+
+    def _inline_definitions(self, code):
+        # Values used once or as cheap to calculate as to read from a register are calculated in place
+        uses = Counter(n.slot for c in code for n in _walk(c) if isinstance(n, Use))
+        inline = {}
+        for c in code:
+            for n in _walk(c):
+                if isinstance(n, Def) and _is_pure(n.expression) and (uses[n.slot] == 1 or _cost(n.expression) == 1):
+                    inline[n.slot] = n.expression
+
+        def replace(node):
+            if isinstance(node, Def) and node.slot in inline:
+                return node.expression
+            if isinstance(node, Use) and node.slot in inline:
+                # Inlined value can use other inlined values too
+                return _transform(inline[node.slot], replace)
+            return node
+
+        return [_transform(c, replace) for c in code]
+
+    def _unwrap_unused(self, code):
+        uses = Counter(n.slot for c in code for n in _walk(c) if isinstance(n, Use))
+        unwrap = lambda n: n.expression if isinstance(n, Def) and uses[n.slot] == 0 else n
+        return [_transform(c, unwrap) for c in code]
+
+    def _remove_dead_code(self, code):
+        # Values of all statements but the last one are discarded
+        while True:
+            code = self._unwrap_unused(code)
+            res = [c for c in code[:-1] if _has_side_effects(c)] + code[-1:]
+            if len(res) == len(code):
+                return res
+            code = res
+
+    def _remove_dead_stores(self, code):
+        pending = {}  # register -> store node that wasn't read yet
+        dead = set()
+
+        def read_all():
+            pending.clear()
+
+        for c in code:
+            for n in _walk(c):
+                if isinstance(n, Expr) and n.op == OP_TSTO:
+                    if not isinstance(n.b, Value):
+                        read_all()
+                        continue
+                    register = n.b.value
+                    if register in pending:
+                        dead.add(id(pending[register]))
+                    pending[register] = n
+                elif isinstance(n, Temp):
+                    if _is_const_register(n.register):
+                        pending.pop(_register_value(n.register), None)
+                    else:
+                        read_all()
+                elif isinstance(n, GenericVar) and n.var in (0x7b, 0x7d):
+                    if n.var == 0x7d and isinstance(n.param, Value):
+                        pending.pop(n.param.value, None)
+                    else:
+                        read_all()
+                elif _is_call(n):
+                    read_all()
+
+        if not dead:
+            return code
+        remove = lambda n: n.a if id(n) in dead else n
+        return [_transform(c, remove) for c in code]
+
+    def _replace_subexpression(self, code, key):
+        slot = self._new_slot()
+        defined = False
+
+        def replace(node):
+            nonlocal defined
+            if not isinstance(node, Expr) or not _is_pure(node) or _key(node) != key:
+                return node
+            if defined:
+                return Use(slot)
+            defined = True
+            return Def(node, slot)
+
+        return [_transform(c, replace) for c in code]
+
+    def _eliminate_common_subexpressions(self, code):
+        while True:
+            counts = Counter()
+            nodes = {}
+            for c in code:
+                for n in _walk(c):
+                    if isinstance(n, Expr) and _is_pure(n):
+                        key = _key(n)
+                        counts[key] += 1
+                        nodes[key] = n
+            candidates = [k for k, n in counts.items() if n > 1]
+            candidates.sort(key=lambda k: -_cost(nodes[k]))
+            cost = sum(_cost(c) for c in code)
+            for key in candidates:
+                res = self._replace_subexpression(code, key)
+                if sum(_cost(c) for c in res) < cost:
+                    code = res
+                    break
+            else:
+                return code
+
+    def _allocate_registers(self, code):
+        # Linear scan over the evaluation order, register is reused after the last use of its value
+        explicit = get_explicit_registers(code)
+        free = [r for r in range(0xff, 0x7f, -1) if r not in explicit]
+        last_use = {}
+        for i, n in enumerate(n for c in code for n in _walk(c)):
+            if isinstance(n, Use):
+                last_use[n.slot] = i
+        registers = {}
+        position = 0
+
+        def allocate(node):
+            nonlocal position
+            i = position
+            position += 1
+            if isinstance(node, Use):
+                res = Temp(registers[node.slot])
+                if last_use[node.slot] == i:
+                    free.append(registers[node.slot])
+                return res
+            if isinstance(node, Def):
+                if not free:
+                    raise RuntimeError('Out of temporary registers')
+                registers[node.slot] = free.pop()
+                return Expr(OP_TSTO, node.expression, Value(registers[node.slot]))
+            return node
+
+        return [_transform(c, allocate) for c in code]
+
+
+def optimize_code(feature, code, level=1):
+    """
+    @brief Optimize parsed switch code.
+    @param feature Feature the code is parsed for.
+    @param code List of expressions as returned by `parse_code`.
+    @param level Optimization level, 0 returns the code unchanged.
+    @return List of optimized expressions.
+    """
+    if level not in OPTIMIZATION_LEVELS:
+        raise ValueError(f'Invalid optimization level {level}, expected one of {OPTIMIZATION_LEVELS}')
+    if level == 0 or not code:
+        return code
+    return Optimizer(feature).optimize(code)
+
+
+def get_explicit_registers(code):
+    """
+    @brief Get temporary registers that code accesses by number.
+    @param code List of expressions.
+    @return Set of register numbers.
+    """
+    res = set()
+    for c in code:
+        for n in _walk(c):
+            if isinstance(n, Expr) and n.op == OP_TSTO and isinstance(n.b, Value):
+                res.add(n.b.value)
+            elif isinstance(n, Temp) and _is_const_register(n.register):
+                res.add(_register_value(n.register))
+            elif isinstance(n, GenericVar) and n.var == 0x7d and isinstance(n.param, Value):
+                res.add(n.param.value)
+    return res
+
+
+def count_adjusts(code):
+    """
+    @brief Count operations (variable adjusts) in compiled switch code.
+    @param code Compiled code bytes.
+    @return Number of adjusts.
+    """
+    res = 0
+    pos = 0
+    while pos < len(code):
+        if res > 0:
+            pos += 1  # operation
+        var = code[pos]
+        pos += 2 if 0x60 <= var < 0x80 else 1
+        shift = code[pos]
+        pos += 5
+        if shift & 0xc0:
+            pos += 8  # add and div/mod values
+        res += 1
+    return res
+
+
+def _lower(feature, code):
+    optimizer = Optimizer(feature)
+    return [_transform(c, optimizer._fold) for c in code]
+
+
+def _reads_var(node, feature, var):
+    if isinstance(node, GenericVar):
+        return node.var == var
+    if isinstance(node, Var):
+        var_data = VA2_VARS[feature].get(node.name)
+        return var_data is not None and var_data['var'] == var
+    return False
+
+
+def is_transparent(feature, code):
+    """
+    @brief Check whether code can be skipped or evaluated as part of another switch without changing the result.
+    @param feature Feature the code is parsed for.
+    @param code List of expressions as returned by `parse_code`.
+    @return True if code has no side effects and doesn't read the result of the previous switch.
+    """
+    for c in _lower(feature, code):
+        if _has_side_effects(c):
+            return False
+        if any(_reads_var(n, feature, 0x1c) for n in _walk(c)):
+            return False
+    return True
+
+
+def reads_last_result(feature, code):
+    """
+    @brief Check whether code depends on the result of the previously evaluated switch.
+    @param feature Feature the code is parsed for.
+    @param code List of expressions as returned by `parse_code`.
+    @return True if code reads the last computed result or calls other switches.
+    """
+    for c in _lower(feature, code):
+        if any(_reads_var(n, feature, 0x1c) or _is_call(n) for n in _walk(c)):
+            return True
+    return False
+
+
+def get_value_bounds(feature, code):
+    """
+    @brief Get the range of values code can evaluate to.
+    @param feature Feature the code is parsed for.
+    @param code List of expressions as returned by `parse_code`.
+    @return Tuple (low, high) of non-negative bounds or None if code isn't a single masked value.
+    """
+    if len(code) != 1:
+        return None
+    node, = _lower(feature, code)
+    if isinstance(node, Value):
+        value = node.value & 0xffffffff
+        res = (value, value)
+    elif isinstance(node, GenericVar) and node.type == 0 and _is_pure(node):
+        res = (0, node.and_mask)
+    elif isinstance(node, Expr) and node.op == OP_AND and isinstance(node.b, Value) and _is_pure(node.a):
+        res = (0, node.b.value & 0xffffffff)
+    else:
+        return None
+    if res[1] >= 0x80000000:
+        return None
+    return res
@@ -0,0 +1,35 @@
+# Measures encoding of DefineMultiple actions with the maximum number of ids and many numeric properties.
+import random
+import time
+
+import grf
+
+
+N = 200
+COUNT = 255
+
+rng = random.Random(0)
+
+
+def make_props(count):
+    return {
+        'substitute': [rng.randrange(0x100) for _ in range(count)],
+        'availability_years': [rng.randrange(0x10000) for _ in range(count)],
+        'population': [rng.randrange(0x100) for _ in range(count)],
+        'authority_impact': [rng.randrange(0x10000) for _ in range(count)],
+        'name': [rng.randrange(0x10000) for _ in range(count)],
+        'probability': [rng.randrange(0x100) for _ in range(count)],
+        'accepted_cargo': [rng.randrange(0x100000000) for _ in range(count)],
+        'min_year': [rng.randrange(0x10000) for _ in range(count)],
+        'badges': [[rng.randrange(0x10000) for _ in range(rng.randrange(4))] for _ in range(count)],
+    }
+
+
+actions = [grf.DefineMultiple(feature=grf.HOUSE, first_id=0, count=COUNT, props=make_props(COUNT)) for _ in range(N)]
+context = grf.WriteContext()
+
+t0 = time.perf_counter()
+data = [a.get_data(context) for a in actions]
+t1 = time.perf_counter()
+total = sum(map(len, data))
+print(f'{N} actions of {COUNT} ids, {total} bytes: {t1 - t0:.3f} sec, {(t1 - t0) / N * 1e3:.3f} ms/action')
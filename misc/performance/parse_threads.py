@@ -0,0 +1,48 @@
+# Compares parsing and compiling switch code in one thread and in a thread pool.
+# Speedup depends on the interpreter, with GIL-enabled Python threads only add overhead,
+# free-threaded builds can run parsers in parallel.
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grf
+from grf.parser import parse_code
+
+
+N = 20000
+THREADS = 8
+
+FEATURES = (grf.TRAIN, grf.RV, grf.HOUSE, grf.INDUSTRY_TILE)
+TEMPLATES = (
+    'var(0x62, param={i} & 0xff, shift=0x1F, and=0xAD123456) + {i}',
+    'TEMP[{r}] = {i} * 3\n(TEMP[{r}] + {i}) % 7',
+    '({i} > 100) * 2 + ({i} == 5) - ({i} / 3)',
+)
+
+
+def compile_code(args):
+    feature, code = args
+    context = grf.actions.CodeContext(subroutines={}, register=0x80)
+    return b''.join(node.compile(context)[1] for node in parse_code(feature, code))
+
+
+jobs = [
+    (FEATURES[i % len(FEATURES)], TEMPLATES[i % len(TEMPLATES)].format(i=i, r=i % 0x80))
+    for i in range(N)
+]
+
+gil = 'disabled' if hasattr(sys, '_is_gil_enabled') and not sys._is_gil_enabled() else 'enabled'
+print(f'Python {sys.version.split()[0]}, GIL {gil}, {N} programs')
+
+t0 = time.perf_counter()
+sequential = [compile_code(j) for j in jobs]
+t1 = time.perf_counter()
+print(f'1 thread: {t1 - t0:.2f} sec')
+
+with ThreadPoolExecutor(THREADS) as executor:
+    t0 = time.perf_counter()
+    threaded = list(executor.map(compile_code, jobs, chunksize=64))
+    t1 = time.perf_counter()
+print(f'{THREADS} threads: {t1 - t0:.2f} sec')
+
+assert threaded == sequential, 'Threaded parse results differ'
@@ -0,0 +1,44 @@
+# Measures loading of sprites from a large 32bpp sheet with and without the pixel cache (grf.cache.PixelCache).
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import grf
+from grf.cache import PixelCache
+from grf.sprites import set_pixel_cache
+
+
+SIZE = 4096
+SPRITE = 64
+N = 64
+
+rng = np.random.default_rng(0)
+rgba = rng.integers(0, 256, size=(SIZE, SIZE, 4), dtype=np.uint8)
+rgba[:, :, 3] = np.where(rgba[:, :, 3] > 128, 255, 0)
+
+with tempfile.TemporaryDirectory() as tmp:
+    png_path = os.path.join(tmp, 'sheet.png')
+    Image.fromarray(rgba, mode='RGBA').save(png_path)
+    context = grf.WriteContext()
+
+    def load_sprites():
+        png = grf.ImageFile(png_path)
+        t0 = time.perf_counter()
+        for i in range(N):
+            s = grf.FileSprite(png, (i * SPRITE) % SIZE, (i * SPRITE) // SIZE * SPRITE, SPRITE, SPRITE)
+            s.get_data_layers(context)
+        t1 = time.perf_counter()
+        png.unload()
+        return t1 - t0
+
+    print(f'Decoding png: {load_sprites():.3f} sec')
+    cache = PixelCache(os.path.join(tmp, '.cache'))
+    cache.load(clean_build=True)
+    set_pixel_cache(cache)
+    print(f'Filling the pixel cache: {load_sprites():.3f} sec')
+    print(f'Mapped pixels: {load_sprites():.3f} sec')
+    cache.save()
+    set_pixel_cache(None)
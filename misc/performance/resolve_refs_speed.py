@@ -0,0 +1,63 @@
+# Measures reference resolution time on synthetic action graphs of growing size.
+# Time per action should stay roughly constant, i.e. resolution scales linearly.
+import gc
+import sys
+import time
+
+import grf
+
+
+SIZES = (25000, 50000, 100000, 200000)
+LEAVES = 64
+CHAIN = 30
+
+
+def make_group(n):
+    # Leaves are referenced by two hubs so the second hub's references are to already seen actions
+    leaves = [grf.Switch(code=f'var(0x42, shift=0, and=0xff) + {i}', ranges={}, default=grf.CB(i)) for i in range(LEAVES)]
+    first_hub = grf.Switch(code='var(0x42, shift=8, and=0xff)', ranges={i: l for i, l in enumerate(leaves)}, default=leaves[0])
+    second_hub = grf.Switch(code='var(0x42, shift=16, and=0xff)', ranges={i: l for i, l in enumerate(reversed(leaves))}, default=first_hub)
+    top = second_hub
+    for i in range(CHAIN):
+        top = grf.Switch(code=f'var(0x43, shift=0, and=0xff) > {i}', ranges={0: top}, default=grf.CB(n))
+    return grf.Action3(feature=grf.TRAIN, ids=[n % 0x100], maps={}, default=top), LEAVES + 3 + CHAIN
+
+
+def make_deep_chain(depth):
+    # Explicit ids can be reused along the chain so its depth isn't limited by the number of ids
+    top = grf.Switch(code='1', ranges={}, default=grf.CB(0), ref_id=0)
+    for i in range(1, depth):
+        top = grf.Switch(code='1', ranges={}, default=top, ref_id=i % 2)
+    return grf.Action3(feature=grf.TRAIN, ids=[0], maps={}, default=top)
+
+
+def make_sprites(size):
+    sprites = []
+    count = 0
+    while count < size:
+        top, n = make_group(count)
+        sprites.append(top)
+        count += n
+    return sprites, count
+
+
+g = grf.NewGRF(grfid=b'TST\x00', name='resolve speed', description='resolve speed')
+print(f'Python {sys.version.split()[0]}, recursion limit {sys.getrecursionlimit()}')
+for size in SIZES:
+    sprites, count = make_sprites(size)
+    gc.collect()
+    t0 = time.perf_counter()
+    res = g.resolve_refs(sprites)
+    t1 = time.perf_counter()
+    assert len(res) == count, (len(res), count)
+    print(f'{count} actions: {t1 - t0:.2f} sec, {(t1 - t0) / count * 1e6:.2f} usec/action')
+
+depth = sys.getrecursionlimit() * 5
+try:
+    t0 = time.perf_counter()
+    res = g.resolve_refs([make_deep_chain(depth)])
+    t1 = time.perf_counter()
+    assert len(res) == depth + 1
+    print(f'{depth} deep chain: {t1 - t0:.2f} sec')
+except RecursionError:
+    print(f'{depth} deep chain: RecursionError')
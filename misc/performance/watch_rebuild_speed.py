@@ -0,0 +1,59 @@
+# Compares full build with the incremental rebuild used by watch mode after one of the sprite sheets has changed.
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import grf
+
+
+SHEETS = 16
+SHEET_SIZE = 1024
+TILE = 32
+
+
+def save_sheet(path, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 4, size=(SHEET_SIZE, SHEET_SIZE, 4), dtype=np.uint8) * 85
+    a[:, :, 3] = 255
+    Image.fromarray(a, mode='RGBA').save(path)
+
+
+with tempfile.TemporaryDirectory() as d:
+    paths = [os.path.join(d, f'sheet{i}.png') for i in range(SHEETS)]
+    for i, path in enumerate(paths):
+        save_sheet(path, i)
+
+    g = grf.BaseNewGRF(sprite_cache_path=os.path.join(d, '.cache'))
+    g._context.print_handlers.clear()
+    for path in paths:
+        f = grf.ImageFile(path)
+        for y in range(0, SHEET_SIZE, TILE):
+            for x in range(0, SHEET_SIZE, TILE):
+                g.add(grf.FileSprite(f, x, y, TILE, TILE, bpp=grf.BPP_32))
+    grf_file = os.path.join(d, 'test.grf')
+    num_sprites = SHEETS * (SHEET_SIZE // TILE) ** 2
+
+    t0 = time.perf_counter()
+    g.write(grf_file, keep_build=True)
+    t1 = time.perf_counter()
+    print(f'{num_sprites} sprites, clean build: {t1 - t0:.2f} sec')
+
+    save_sheet(paths[0], SHEETS)
+    os.utime(paths[0], (time.time() + 10, time.time() + 10))
+    t0 = time.perf_counter()
+    g.write(grf_file)
+    t1 = time.perf_counter()
+    print(f'Full build after changing one sheet: {t1 - t0:.2f} sec')
+
+    g.write(grf_file, keep_build=True)
+    save_sheet(paths[0], SHEETS + 1)
+    os.utime(paths[0], (time.time() + 20, time.time() + 20))
+    t0 = time.perf_counter()
+    g.rebuild(grf_file, [paths[0]])
+    t1 = time.perf_counter()
+    rebuild_data = open(grf_file, 'rb').read()
+    g.write(grf_file)
+    print(f'Incremental rebuild after changing one sheet: {t1 - t0:.2f} sec, same as full build: {rebuild_data == open(grf_file, "rb").read()}')
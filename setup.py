@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from pathlib import Path
 
 root_path = Path(__file__).parent
@@ -30,6 +30,10 @@ setup(
     package_data={
         "grf.larkparser": ["*.lark"],
     },
+    # Native sprite compression, grf-py falls back to nml encoder if it fails to build
+    ext_modules=[
+        Extension('grf._lz77', sources=['grf/_lz77.c'], optional=True),
+    ],
     install_requires=install_requires,
     python_requires=">=3.12.10",
     setup_requires=["setuptools-git-versioning>=2"],
@@ -1,9 +1,11 @@
 import tempfile
 import os
 
+import numpy as np
 import pytest
+from PIL import Image
 
-from grf import BaseNewGRF, hex_str, WriteContext
+from grf import BaseNewGRF, NewGRF, hex_str, WriteContext, Action1, FileSprite, ImageFile, TRAIN, BPP_32
 
 
 def _do_check_grf(newgrf, expected):
@@ -66,6 +68,35 @@ def check_action(action, result):
 	assert encoded_hex == result
 
 
+def make_newgrf(tmp, **kwargs):
+	map_file = os.path.join(tmp, 'id_map.json')
+	with open(map_file, 'w') as f:
+		f.write('{"version": 1, "index": {}}')
+	return NewGRF(
+		grfid=b'TST\x00',
+		name='Test',
+		description='Test',
+		id_map_file=map_file,
+		sprite_cache_path=os.path.join(tmp, '.cache'),
+		**kwargs,
+	)
+
+
+def make_png(path, width, height, seed=0):
+	rng = np.random.default_rng(seed)
+	rgba = rng.integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+	rgba[:, :, 3] = np.where(rgba[:, :, 3] > 128, 255, 0)
+	Image.fromarray(rgba, mode='RGBA').save(path)
+	return ImageFile(path)
+
+
+def add_file_sprites(g, png, count):
+	# 32x64 sprites side by side
+	g.add(Action1(feature=TRAIN, set_count=1, sprite_count=count))
+	for i in range(count):
+		g.add(FileSprite(png, i * 32, 0, 32, 64, xofs=-16, yofs=-32, bpp=BPP_32))
+
+
 # pytest equivalent of nose @raises
 def raises(*exceptions):
     def decorator(fn):
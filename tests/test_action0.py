@@ -1,4 +1,9 @@
+import struct
+
+import pytest
+
 import grf
+from grf import WriteContext
 
 from .common import check_action
 
@@ -56,3 +61,22 @@ def test_train_basic_properties():
 			6c:6f:77:5f:72:65:66:69:74:2e:ed:c9:2f:a6:00:30:fa:ea:00:00
 		''',
 	)
+
+
+def test_define_multiple_bulk_properties():
+	count = 40
+	props = dict(
+		substitute=list(range(count)),
+		availability_years=[0x100 * i + 1 for i in range(count)],
+		accepted_cargo=[0x1000000 * i + 2 for i in range(count)],
+		badges=[list(range(i % 3)) for i in range(count)],
+	)
+	expected = bytes((0x00, 0x07, 4, count, 0xff, 0x00, 0x00, 0x08)) + bytes(range(count))
+	expected += b'\x0a' + b''.join(struct.pack('<H', 0x100 * i + 1) for i in range(count))
+	expected += b'\x1e' + b''.join(struct.pack('<I', 0x1000000 * i + 2) for i in range(count))
+	expected += b'\x24' + b''.join(struct.pack('<H', i % 3) + b''.join(struct.pack('<H', x) for x in range(i % 3)) for i in range(count))
+	assert grf.DefineMultiple(feature=grf.HOUSE, first_id=0, count=count, props=props).get_data(WriteContext()) == expected
+
+	props['availability_years'][count - 1] = 0x10000
+	with pytest.raises(ValueError, match='Error encoding value 65536 for property availability_years'):
+		grf.DefineMultiple(feature=grf.HOUSE, first_id=0, count=count, props=props).get_data(WriteContext())
@@ -1,3 +1,5 @@
+import pytest
+
 import grf
 from grf.parser import parse_code
 
@@ -60,3 +62,127 @@ def test_code_var_param():
 		'var(0x62, param=(0xAA), shift=0x1F, and=0xAD123456)',
 		[(True, '62:aa:3f:56:34:12:ad')],
 	)
+
+
+def test_switch_code_cache():
+	grf.actions.clear_switch_code_cache()
+	code = 'var(0x62, param=(0xAA), shift=0x1F, and=0xAD123456)'
+	switches = [
+		grf.Switch(feature=grf.TRAIN, ref_id=i, ranges={1: 0}, default=0, code=code)
+		for i in range(3)
+	]
+	for s in switches:
+		hex_eq(s.get_data(grf.WriteContext())[3:], '89:62:aa:1f:56:34:12:ad:01:00:80:01:00:00:00:01:00:00:00:00:80')
+	assert switches[0].parsed_code is switches[2].parsed_code
+	assert grf.actions._parse_switch_code.cache_info().misses == 1
+
+	# Related scope is parsed with a different feature
+	related = grf.Switch(feature=grf.HOUSE, ref_id=0, ranges={}, default=0, code='5', related_scope=True)
+	assert related.parsed_code is not grf.Switch(feature=grf.HOUSE, ref_id=0, ranges={}, default=0, code='5').parsed_code
+
+
+def test_parse_code_threads():
+	from concurrent.futures import ThreadPoolExecutor
+
+	def compile_code(args):
+		feature, code = args
+		context = grf.actions.CodeContext(subroutines={}, register=0x80)
+		return b''.join(a.compile(context)[1] for a in parse_code(feature, code))
+
+	jobs = [((grf.TRAIN, grf.HOUSE)[i % 2], f'var(0x62, param={i % 0x80}, shift=1, and={i}) + {i}') for i in range(500)]
+	expected = [compile_code(j) for j in jobs]
+	with ThreadPoolExecutor(4) as executor:
+		assert list(executor.map(compile_code, jobs)) == expected
+
+
+def test_switch_optimization():
+	from grf.va2opt import optimize_code
+
+	def optimized(code):
+		return [str(x) for x in optimize_code(grf.TRAIN, parse_code(grf.TRAIN, code))]
+
+	assert optimized('1 + 2 * 3') == ['7']
+	assert optimized('2 + var(0x42, shift=0, and=0xffff) * 3') == ['var(0x42, shift=0, and=0xffff) * 3 + 2']
+	assert optimized('(var(0x42, shift=0, and=0xffff) >> 4) & 0xf') == ['var(0x42, shift=4, and=0xf)']
+	# Overwritten store and a statement without side effects are removed
+	assert optimized('TEMP[1] = 5\nvar(0x42, shift=0, and=0xff)\nTEMP[1] = 6\nTEMP[1]') == ['TEMP[0x01] = 6', 'TEMP[1]']
+	# Repeated subexpression is calculated once
+	assert optimized('(var(0x42, shift=0, and=0xff) / 3 + 1) * (var(0x42, shift=0, and=0xff) / 3 + 1)') == \
+		['(TEMP[0x80] = var(0x42, shift=0, and=0xff) / 3 + 1) * TEMP[0x80]']
+
+	switch = grf.Switch(feature=grf.TRAIN, ref_id=0, ranges={}, default=0, code='x = 1 + 2\nx * var(0x42, shift=0, and=0xff)')
+	context = grf.WriteContext(code_optimization=1)
+	hex_eq(switch.get_data(context), '02:00:00:89:42:20:ff:00:00:00:0a:1a:00:03:00:00:00:00:00:80')
+	assert context.code_bytes_saved == 22 and context.code_ops_saved == 3
+
+
+
+
+def test_constant_param_not_folded_without_optimization():
+	code = 'var(0x60, param=1+2, shift=0, and=0xff)'
+	switch = grf.Switch(feature=grf.TRAIN, ref_id=0, ranges={}, default=0, code=code)
+	# Level 0 compiles the code as written
+	hex_eq(switch.get_data(grf.WriteContext()),
+		'02:00:00:89:1a:20:01:00:00:00:00:1a:20:02:00:00:00:0f:7b:60:00:ff:00:00:00:00:00:80')
+	hex_eq(switch.get_data(grf.WriteContext(code_optimization=1)), '02:00:00:89:60:03:00:ff:00:00:00:00:00:80')
+
+@pytest.mark.parametrize('code, result', [
+	# Complex right operand is evaluated before the left one, folding it to a simple one mustn't change that
+	('TEMP[3] = (TEMP[4] = 9) - (TEMP[4] +>> 0)\nTEMP[3]', 9),
+	# Same for the operand that becomes simple after removing a dead store
+	('cmp((TEMP[3] = var(0x42, shift=0, and=0xff)), (TEMP[3] = TEMP[3]))', 2),
+])
+def test_switch_optimization_keeps_evaluation_order(code, result):
+	from grf.va2eval import evaluate
+
+	for level in (0, 1):
+		switch = grf.Switch(feature=grf.TRAIN, ref_id=0, ranges={}, default=0, code=code)
+		assert evaluate(switch, {0x42: 5}, code_optimization=level).result == result
+
+def test_evaluate_switch_chain():
+	from grf.va2eval import evaluate
+
+	procedure = grf.Switch(code='TEMP[3] = 7\n(var(0x42, shift=0, and=0xff) > 5) * 10', ranges={}, default=0)
+	capacity = grf.Switch(code='f() + TEMP[3]', subroutines={'f': procedure}, ranges={(0, 9): 1, (10, 100): 2}, default=3)
+	properties = grf.Switch(code='extra_callback_info1_byte', ranges={0x09: 100, 0x14: capacity}, default=0)
+	graphics = grf.RandomSwitch(scope='self', triggers=0, cmp_all=False, lowest_bit=2, groups=[4, 5, 6, 7])
+	root = grf.Switch(feature=grf.TRAIN, code='current_callback', ranges={0x36: properties}, default=graphics)
+	action3 = grf.Action3(feature=grf.TRAIN, ids=[0], maps={}, default=root)
+	g = grf.BaseNewGRF()
+	g.add(action3)
+	g.resolve_refs(g.generate_sprites())
+
+	for level in (0, 1):
+		res = evaluate(action3, {'current_callback': 0x36, 'extra_callback_info1_byte': 0x14, 0x42: 6}, code_optimization=level)
+		assert res.is_callback and res.result == 2
+		assert res.path == [root, properties, capacity, procedure]
+		assert res.temp[3] == 7 and res.num_calls == 1
+		assert res.var_reads[(0x0c, None)] == 1 and res.var_reads[(0x42, None)] == 1
+
+	res = evaluate(action3, {'current_callback': 0x36, 'extra_callback_info1': 9})
+	assert res.result == 100 and (res.num_nodes, res.num_ops, res.num_var_reads) == (2, 2, 2)
+	res = evaluate(action3, {'current_callback': 0}, random_bits=0b1000)
+	assert res.result == 6 and res.path == [root, graphics]
+
+
+def test_chain_cost():
+	from grf.analyze import analyze, format_report
+
+	chain = grf.Switch(code='var(0x61, param=0x42, shift=0, and=0xff) + var(0x42, shift=0, and=0xff)', ranges={0: 1}, default=2)
+	properties = grf.Switch(code='extra_callback_info1_byte', ranges={0x09: 100, 0x14: chain}, default=0)
+	graphics = grf.RandomSwitch(scope='self', triggers=0, cmp_all=False, lowest_bit=0, groups=[4, 5])
+	root = grf.Switch(feature=grf.TRAIN, code='current_callback', ranges={0x36: properties, 0x10: 7}, default=graphics)
+	g = grf.BaseNewGRF()
+	g.add(grf.Action3(feature=grf.TRAIN, ids=[5], maps={0xff: properties}, default=root))
+	costs = analyze(g.resolve_refs(g.generate_sprites()))
+
+	# Average is over 3 branches of the properties switch
+	res = {(c.name, c.callback): (c.nodes, c.ops, c.expensive) for c in costs}
+	assert res == {
+		('TRAIN 0x05 default', 0): ((2, 2), (1, 1), (0, 0)),
+		('TRAIN 0x05 default', 0x10): ((1, 1), (1, 1), (0, 0)),
+		('TRAIN 0x05 default', 0x36): ((3, pytest.approx(7 / 3)), (4, pytest.approx(8 / 3)), (1, pytest.approx(1 / 3))),
+		('TRAIN 0x05 purchase', 0): ((2, pytest.approx(4 / 3)), (3, pytest.approx(5 / 3)), (1, pytest.approx(1 / 3))),
+	}
+	report = format_report(costs)
+	assert len(report) == 5 and '0x36' in report[1]
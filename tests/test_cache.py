@@ -0,0 +1,313 @@
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import grf
+from grf.cache import PackedSpriteCache, SpriteCache, RemoteSpriteCache, HTTPCacheStore, MemoryCache, PixelCache, make_cache_store
+from grf.cache_server import make_server
+
+from .common import make_newgrf, make_png, add_file_sprites
+
+
+def make_sprite_newgrf(tmp, **kwargs):
+	# Two cacheable sprites from the same file, it's created only once so it keeps its modification time
+	png_path = os.path.join(tmp, 'sprites.png')
+	if not os.path.exists(png_path):
+		make_png(png_path, 64, 64)
+	g = make_newgrf(tmp, **kwargs)
+	add_file_sprites(g, grf.ImageFile(png_path), 2)
+	return g
+
+
+def write_sprite_newgrf(**kwargs):
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_sprite_newgrf(tmp, **kwargs)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file)
+		with open(grf_file, 'rb') as f:
+			return f.read()
+
+
+def test_packed_cache():
+	with tempfile.TemporaryDirectory() as tmp:
+		cache = PackedSpriteCache(tmp)
+		cache.load(clean_build=False)
+		keys = [cache.hexdigest(i) for i in range(4)]
+		for i, k in enumerate(keys):
+			cache.set(k, bytes([i]) * 100)
+		assert cache.get(keys[1]) == bytes([1]) * 100
+		cache.save()
+		size = cache.data_path.stat().st_size
+
+		# Only keys[3] is used, the rest is stale and gets compacted
+		cache = PackedSpriteCache(tmp)
+		cache.load(clean_build=False)
+		assert all(cache.is_cached(k) for k in keys)
+		assert cache.get(keys[3]) == bytes([3]) * 100
+		cache.save()
+
+		cache = PackedSpriteCache(tmp)
+		cache.load(clean_build=False)
+		assert cache.is_cached(keys[3])
+		assert not cache.is_cached(keys[0])
+		assert cache.get(keys[3]) == bytes([3]) * 100
+		assert cache.data_path.stat().st_size < size
+		cache.save()
+
+		# Index from a different data file is ignored
+		index = cache.index_path.read_bytes()
+		cache = PackedSpriteCache(tmp)
+		cache.load(clean_build=True)
+		cache.save()
+		cache.index_path.write_bytes(index)
+		cache = PackedSpriteCache(tmp)
+		cache.load(clean_build=False)
+		assert not cache.is_cached(keys[3])
+
+
+def test_remote_cache_server():
+	with tempfile.TemporaryDirectory() as tmp:
+		server = subprocess.Popen(
+			[sys.executable, '-m', 'grf.cache_server', '--port', '0', os.path.join(tmp, 'server')],
+			stdout=subprocess.PIPE,
+			text=True,
+		)
+		try:
+			url = server.stdout.readline().split()[-1]
+			assert url.startswith('http://')
+
+			cache = RemoteSpriteCache(SpriteCache(os.path.join(tmp, 'a')), make_cache_store(url))
+			cache.load(clean_build=False)
+			keys = [cache.hexdigest(i) for i in range(3)]
+			cache.prefetch(keys)
+			assert not any(cache.is_cached(k) for k in keys)
+			for i, k in enumerate(keys):
+				cache.set(k, bytes([i]) * 10)
+			cache.save()
+
+			# Another machine with empty local cache
+			cache = RemoteSpriteCache(SpriteCache(os.path.join(tmp, 'b')), make_cache_store(url))
+			cache.load(clean_build=False)
+			cache.prefetch(keys + [cache.hexdigest('missing')])
+			assert all(cache.is_cached(k) for k in keys)
+			assert not cache.is_cached(cache.hexdigest('missing'))
+			assert cache.get(keys[2]) == bytes([2]) * 10
+			cache.save()
+			assert cache.local.is_cached(keys[2])
+		finally:
+			server.terminate()
+			server.wait()
+
+
+def test_cache_server_content_length():
+	with tempfile.TemporaryDirectory() as tmp:
+		server = make_server(tmp)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.start()
+		try:
+			host, port = server.server_address[:2]
+			for headers, status in (({}, 411), ({'Content-Length': 'abc'}, 400), ({'Content-Length': '-1'}, 400), ({'Content-Length': '2'}, 204)):
+				conn = http.client.HTTPConnection(host, port)
+				conn.putrequest('PUT', '/sprites/' + '0' * 16)
+				for k, v in headers.items():
+					conn.putheader(k, v)
+				conn.endheaders(b'ok')
+				assert conn.getresponse().status == status
+				conn.close()
+		finally:
+			server.shutdown()
+			server.server_close()
+			thread.join()
+
+
+def test_remote_cache_unavailable(capsys):
+	with tempfile.TemporaryDirectory() as tmp:
+		cache = RemoteSpriteCache(SpriteCache(tmp), HTTPCacheStore('http://127.0.0.1:1', timeout=1))
+		cache.load(clean_build=False)
+		key = cache.hexdigest(0)
+		cache.prefetch([key])
+		assert not cache.is_cached(key)
+		cache.set(key, b'data')
+		cache.save()
+		assert cache.local.is_cached(key)
+	assert 'WARNING' in capsys.readouterr().out
+
+
+def test_memory_cache_eviction():
+	cache = MemoryCache(300)
+	for i in range(3):
+		cache.set(i, bytes([i]) * 100, 100)
+	assert cache.get(0) == bytes([0]) * 100
+	cache.set(3, b'3' * 100, 100)
+	assert 1 not in cache and 0 in cache
+	assert cache.size == 300
+	cache.set(4, b'4' * 400, 400)
+	assert 4 not in cache and len(cache) == 3
+	assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_pixel_cache_removes_mapped_arrays_later(monkeypatch):
+	with tempfile.TemporaryDirectory() as tmp:
+		src = os.path.join(tmp, 'a.bin')
+		with open(src, 'wb') as f:
+			f.write(b'first')
+		cache = PixelCache(os.path.join(tmp, '.cache'))
+		cache.load(clean_build=False)
+		pixels = cache.set(src, np.zeros((2, 2, 4), dtype=np.uint8))
+		old_arrays = set(cache.path.glob('*.npy'))
+
+		with open(src, 'wb') as f:
+			f.write(b'second')
+		os.utime(src, ns=(0, 0))
+		assert cache.get(src) is None
+
+		# Array of the old content is still mapped, removing it fails on Windows
+		unlink = Path.unlink
+
+		def mapped_unlink(self, missing_ok=False):
+			if self in old_arrays:
+				raise PermissionError(self)
+			unlink(self, missing_ok=missing_ok)
+
+		monkeypatch.setattr(Path, 'unlink', mapped_unlink)
+		cache.save()
+		assert all(p.exists() for p in old_arrays)
+
+		monkeypatch.setattr(Path, 'unlink', unlink)
+		del pixels
+		cache = PixelCache(os.path.join(tmp, '.cache'))
+		cache.load(clean_build=False)
+		cache.save()
+		assert not any(p.exists() for p in old_arrays)
+
+
+def test_packed_sprite_cache():
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_sprite_newgrf(tmp, sprite_cache_backend='packed')
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file)
+		with open(grf_file, 'rb') as f:
+			data = f.read()
+		g.write(grf_file)
+		assert g._context.num_cached == 2
+		with open(grf_file, 'rb') as f:
+			assert f.read() == data
+	assert data == write_sprite_newgrf()
+
+
+def test_content_file_fingerprint():
+	for mode, cached in (('mtime', 0), ('content', 2)):
+		with tempfile.TemporaryDirectory() as tmp:
+			g = make_sprite_newgrf(tmp, file_fingerprint=mode)
+			grf_file = os.path.join(tmp, 'test.grf')
+			g.write(grf_file)
+			png_path = os.path.join(tmp, 'sprites.png')
+			st = os.stat(png_path)
+			os.utime(png_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+			g.write(grf_file)
+			assert g._context.num_cached == cached
+
+	# Project moved to another directory together with its cache
+	with tempfile.TemporaryDirectory() as tmp:
+		src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+		os.mkdir(src)
+		g = make_sprite_newgrf(src, file_fingerprint='content')
+		g.write(os.path.join(src, 'test.grf'))
+		os.rename(src, dst)
+		g = make_sprite_newgrf(dst, file_fingerprint='content')
+		g.write(os.path.join(dst, 'test.grf'))
+		assert g._context.num_cached == 2
+
+
+def test_shared_sprite_cache():
+	with tempfile.TemporaryDirectory() as tmp:
+		shared = os.path.join(tmp, 'shared')
+		for name, cached in (('a', 0), ('b', 2)):
+			path = os.path.join(tmp, name)
+			os.mkdir(path)
+			g = make_sprite_newgrf(path, file_fingerprint='content', shared_sprite_cache=shared)
+			g.write(os.path.join(path, 'test.grf'))
+			assert g._context.num_cached == cached
+
+
+def test_action_cache():
+	with tempfile.TemporaryDirectory() as tmp:
+		def make():
+			g = make_newgrf(tmp, persistent_action_cache=True)
+			for i in range(3):
+				g.add(grf.Switch(
+					feature=grf.TRAIN,
+					ref_id=i,
+					ranges={1: 0x8000, (2, 5): 0x8001},
+					default=0x8002,
+					code=f'var(0x62, param=0x{i:02x}, shift=0x1F, and=0xFF) + 1',
+				))
+			return g
+
+		g = make()
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file)
+		assert (g._context.num_actions_cached, g._context.num_actions_encoded) == (0, 3)
+		with open(grf_file, 'rb') as f:
+			data = f.read()
+
+		# Same instance, in memory
+		g.write(grf_file)
+		assert (g._context.num_actions_cached, g._context.num_actions_encoded) == (3, 0)
+
+		# New instance, from disk
+		g = make()
+		g.write(grf_file)
+		assert (g._context.num_actions_cached, g._context.num_actions_encoded) == (3, 0)
+		with open(grf_file, 'rb') as f:
+			assert f.read() == data
+
+		g.write(grf_file, clean_build=True)
+		assert (g._context.num_actions_cached, g._context.num_actions_encoded) == (0, 3)
+
+
+def test_newgrf_memory_caches():
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_sprite_newgrf(tmp, sprite_memory_cache_size=1 << 24, image_memory_cache_size=1 << 24)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file)
+		with open(grf_file, 'rb') as f:
+			data = f.read()
+		assert g._sprite_memory_cache.misses == 2
+		assert g._image_memory_cache.misses == 1
+
+		# Sprites come from memory, the disk cache still keeps them
+		g.write(grf_file)
+		with open(grf_file, 'rb') as f:
+			assert f.read() == data
+		assert g._context.num_cached == 2
+		assert g._sprite_memory_cache.misses == 0
+		assert g._image_memory_cache.misses == 0
+
+
+def test_newgrf_pixel_cache(monkeypatch):
+	expected = write_sprite_newgrf()
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_sprite_newgrf(tmp, pixel_cache=True)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, clean_build=True)
+		with open(grf_file, 'rb') as f:
+			assert f.read() == expected
+		pixels_path = os.path.join(tmp, '.cache', 'pixels')
+		assert len([e for e in os.listdir(pixels_path) if e.endswith('.npy')]) == 1
+
+		# Without encoded sprites they're cut from the mapped pixels without decoding the png
+		for e in os.listdir(os.path.join(tmp, '.cache')):
+			if e != 'pixels':
+				os.remove(os.path.join(tmp, '.cache', e))
+		monkeypatch.setattr(grf.sprites.Image, 'open', None)
+		g.write(grf_file)
+		assert g._context.num_cached == 0
+		with open(grf_file, 'rb') as f:
+			assert f.read() == expected
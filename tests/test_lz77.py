@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from grf import lz77
+
+
+def sample_data():
+	rng = np.random.default_rng(0)
+	yield np.zeros(1, dtype=np.uint8)
+	yield np.arange(5, dtype=np.uint8)
+	yield np.zeros(5000, dtype=np.uint8)
+	yield rng.integers(0, 256, size=3000, dtype=np.uint8)
+	yield rng.integers(0, 4, size=10000, dtype=np.uint8)
+	yield np.tile(rng.integers(0, 256, size=37, dtype=np.uint8), 200)
+	sprite = np.zeros((64, 64, 4), dtype=np.uint8)
+	sprite[16:48, 8:56] = rng.integers(0, 256, size=(32, 48, 4), dtype=np.uint8) // 32 * 32
+	yield sprite.reshape(-1)
+	for _ in range(20):
+		size = int(rng.integers(1, 20000))
+		yield np.repeat(rng.integers(0, int(rng.integers(1, 256)), size=size, dtype=np.uint8), 3)
+
+
+def test_nml_roundtrip():
+	for data in sample_data():
+		assert lz77.decode(lz77.nml_encode(data), data.size) == data.tobytes()
+
+
+def test_encode_matches_nml():
+	for data in sample_data():
+		assert bytes(lz77.encode(data)) == bytes(lz77.nml_encode(data))
+
+
+def test_native_matches_nml():
+	native = pytest.importorskip('grf._lz77')
+	for data in sample_data():
+		assert native.encode(data) == bytes(lz77.nml_encode(data))
+		assert native.encode(data.tobytes()) == bytes(lz77.nml_encode(data))
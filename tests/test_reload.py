@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import grf
+from grf.reload import CodeReloader
+
+
+def write_file(path, text):
+	with open(path, 'w') as f:
+		f.write(text)
+	# Make sure cached bytecode isn't used even if the file is rewritten in the same second
+	st = os.stat(path)
+	os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_code_reload():
+	with tempfile.TemporaryDirectory() as tmp:
+		os.mkdir(os.path.join(tmp, 'rlib'))
+		write_file(os.path.join(tmp, 'rlib', '__init__.py'), '')
+		write_file(os.path.join(tmp, 'rlib', 'consts.py'), 'NAME = "first"\n')
+		write_file(os.path.join(tmp, 'rhelper.py'), 'from rlib.consts import NAME\n')
+		write_file(os.path.join(tmp, 'rother.py'), 'VALUE = 1\n')
+		script = os.path.join(tmp, 'main.py')
+		write_file(script, 'import grf, rhelper, rother\ng = grf.NewGRF(grfid=b"TST\\x00", name=rhelper.NAME, description="")\ngrf.main(g, "test.grf")\n')
+
+		sys.path.insert(0, tmp)
+		try:
+			import rhelper, rother
+			old_g = grf.NewGRF(grfid=b'TST\x00', name=rhelper.NAME, description='')
+			reloader = CodeReloader(script, old_g)
+			consts_path = os.path.join(tmp, 'rlib', 'consts.py')
+			assert reloader.get_files() == {Path(tmp, f).resolve() for f in ('main.py', 'rhelper.py', 'rother.py', 'rlib/__init__.py', 'rlib/consts.py')}
+			assert reloader.get_reload_order([consts_path]) == ['rlib.consts', 'rhelper', 'rlib']
+
+			write_file(consts_path, 'NAME = "second"\n')
+			g = reloader.reload([consts_path])
+			assert g is not old_g and reloader.grf is g
+			assert g.name == 'second'
+			assert sys.modules['rother'] is rother
+			assert g._context.print_handlers is old_g._context.print_handlers
+		finally:
+			sys.path.remove(tmp)
+			for name in ('rlib', 'rlib.consts', 'rhelper', 'rother'):
+				sys.modules.pop(name, None)
+
+
+def test_environment_is_not_project_code(monkeypatch):
+	with tempfile.TemporaryDirectory() as tmp:
+		site_packages = os.path.join(tmp, '.venv', 'lib', 'python3', 'site-packages')
+		os.makedirs(site_packages)
+		write_file(os.path.join(site_packages, 'rinstalled.py'), '')
+		os.mkdir(os.path.join(tmp, 'env'))
+		write_file(os.path.join(tmp, 'env', 'renv.py'), '')
+		write_file(os.path.join(tmp, 'rlocal.py'), '')
+		script = os.path.join(tmp, 'main.py')
+		write_file(script, '')
+		monkeypatch.setattr(sys, 'prefix', os.path.join(tmp, 'env'))
+
+		sys.path[:0] = [tmp, site_packages, os.path.join(tmp, 'env')]
+		try:
+			import rinstalled, renv, rlocal
+			reloader = CodeReloader(script, None)
+			assert reloader.get_files() == {Path(tmp, f).resolve() for f in ('main.py', 'rlocal.py')}
+		finally:
+			del sys.path[:3]
+			for name in ('rinstalled', 'renv', 'rlocal'):
+				sys.modules.pop(name, None)
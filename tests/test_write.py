@@ -0,0 +1,373 @@
+import os
+import struct
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import grf
+from grf.decompile import RealGraphicsSprite, decode_chunked
+
+from .common import make_newgrf, make_png, add_file_sprites
+
+
+def add_sprites(g, tmp):
+	# Cacheable file sprites and an uncacheable image one
+	png = make_png(os.path.join(tmp, 'sprites.png'), 256, 64)
+	add_file_sprites(g, png, 8)
+	g.add(grf.ImageSprite(Image.open(png.path).crop((0, 0, 16, 16))))
+
+
+def write_grf(jobs):
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_newgrf(tmp)
+		add_sprites(g, tmp)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, clean_build=True, jobs=jobs)
+		with open(grf_file, 'rb') as f:
+			return f.read()
+
+
+def test_parallel_write_is_identical():
+	assert write_grf(jobs=1) == write_grf(jobs=2)
+
+
+def test_parallel_write_with_threads(capsys):
+	expected = write_grf(jobs=1)
+	done = threading.Event()
+	thread = threading.Thread(target=done.wait)
+	thread.start()
+	try:
+		capsys.readouterr()
+		assert write_grf(jobs=2) == expected
+		assert 'using a single process' in capsys.readouterr().out
+	finally:
+		done.set()
+		thread.join()
+
+
+def decode_real_sprite(data):
+	info, zoom, h, w, xofs, yofs = struct.unpack_from('<BBHHhh', data)
+	sprite = RealGraphicsSprite(0, 0, None, w, h, info, zoom, xofs, yofs)
+	sprite.decomp_size = w * h * sprite.bpp
+	data = data[10:]
+	if info & 0x08:
+		sprite.decomp_size = struct.unpack_from('<I', data)[0]
+		data = data[4:]
+	raw = grf.lz77.decode(data, sprite.decomp_size)
+	if info & 0x08:
+		return info, decode_chunked(sprite, 2, raw)
+	return info, np.frombuffer(raw, dtype=np.uint8).reshape(h, w, sprite.bpp)
+
+
+def test_tile_compression_roundtrip():
+	rng = np.random.default_rng(1)
+	context = grf.WriteContext()
+	for w, h, mode in ((40, 30, 'RGBA'), (300, 20, 'RGBA'), (200, 10, 'P')):
+		shape = (h, w, 4) if mode == 'RGBA' else (h, w)
+		pixels = rng.integers(0, 256, size=shape, dtype=np.uint8)
+		transparent = rng.random((h, w)) < 0.5
+		transparent[3] = True  # empty row
+		if mode == 'RGBA':
+			pixels[transparent, 3] = 0
+			expected = pixels.copy()
+			expected[pixels[:, :, 3] == 0] = 0
+		else:
+			pixels[transparent] = 0
+			expected = pixels[:, :, None]
+
+		image = Image.fromarray(pixels, mode=mode)
+		if mode == 'P':
+			image.putpalette(grf.PIL_PALETTE)
+		flat_info, flat = decode_real_sprite(grf.ImageSprite(image, crop=False, compression='lz77').get_real_data(context))
+		tile_data = grf.ImageSprite(image, crop=False, compression='tile').get_real_data(context)
+		tile_info, tile = decode_real_sprite(tile_data)
+		assert flat_info & 0x08 == 0
+		assert tile_info == flat_info | 0x08
+		assert np.array_equal(tile, expected)
+
+		lz77_data = grf.ImageSprite(image, crop=False).get_real_data(context)
+		auto_data = grf.ImageSprite(image, crop=False, compression='auto').get_real_data(context)
+		assert len(auto_data) == min(len(tile_data), len(lz77_data))
+
+
+def test_fingerprint_digest():
+	with tempfile.TemporaryDirectory() as tmp:
+		png = make_png(os.path.join(tmp, 'sprites.png'), 32, 64)
+		sprite = grf.FileSprite(png, 0, 0, 32, 64, bpp=grf.BPP_32)
+		moved = grf.MoveSprite(sprite, xofs=1)
+		digest = moved.get_fingerprint_digest()
+		assert moved.get_fingerprint()['sprites'] == [sprite.get_fingerprint_digest()]
+		assert digest != grf.MoveSprite(sprite, xofs=2).get_fingerprint_digest()
+		assert digest == grf.MoveSprite(grf.FileSprite(png, 0, 0, 32, 64, bpp=grf.BPP_32), xofs=1).get_fingerprint_digest()
+
+		image = grf.ImageSprite(Image.new('RGBA', (4, 4)))
+		with pytest.raises(grf.Uncacheable):
+			grf.MoveSprite(image).get_fingerprint_digest()
+
+
+class NonSeekableWriter:
+	def __init__(self):
+		self.data = bytearray()
+
+	def write(self, data):
+		self.data += data
+		return len(data)
+
+
+def test_streaming_write_with_duplicates():
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_newgrf(tmp)
+		png = make_png(os.path.join(tmp, 'sprites.png'), 64, 64)
+		add_file_sprites(g, png, 2)
+		add_file_sprites(g, png, 2)
+
+		out = NonSeekableWriter()
+		g.write(out, clean_build=True)
+		assert g._context.num_duplicate == 2
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file)
+		with open(grf_file, 'rb') as f:
+			assert f.read() == out.data
+
+	# Every sprite reference should point to a written sprite
+	data = bytes(out.data)
+	data_offset = struct.unpack_from('<I', data, 10)[0]
+	pos = 15
+	references = []
+	while True:
+		length, grf_type = struct.unpack_from('<IB', data, pos)
+		if length == 0:
+			break
+		if grf_type == 0xfd:
+			references.append(struct.unpack_from('<I', data, pos + 5)[0])
+		pos += 5 + length
+	assert pos - 10 == data_offset
+	pos += 4
+	sprite_ids = set()
+	while True:
+		sprite_id = struct.unpack_from('<I', data, pos)[0]
+		if sprite_id == 0:
+			break
+		sprite_ids.add(sprite_id)
+		pos += 8 + struct.unpack_from('<I', data, pos + 4)[0]
+	assert pos + 4 == len(data)
+	assert set(references) == sprite_ids
+
+
+def test_cached_sprites_read_once(monkeypatch):
+	expected = write_grf(1)
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_newgrf(tmp)
+		add_sprites(g, tmp)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, clean_build=True)
+
+		reads = Counter()
+		get = grf.cache.SpriteCache.get
+
+		def counting_get(self, key):
+			reads[key] += 1
+			return get(self, key)
+
+		monkeypatch.setattr(grf.cache.SpriteCache, 'get', counting_get)
+		g.write(grf_file)
+		assert g._context.num_cached == 8 and set(reads.values()) == {1}
+
+		# Over the limit, data is read from the cache again when writing. If the cache entry is gone by then,
+		# the sprite is encoded again with its files loaded back
+		def missing_on_second_get(self, key):
+			reads[key] += 1
+			return get(self, key) if reads[key] == 1 else None
+
+		reads.clear()
+		monkeypatch.setattr(sys.modules['grf.grf'], 'KEPT_SPRITE_DATA_BYTES', 0)
+		monkeypatch.setattr(grf.cache.SpriteCache, 'get', missing_on_second_get)
+		g.write(grf_file)
+		assert set(reads.values()) == {2}
+		with open(grf_file, 'rb') as f:
+			assert f.read() == expected
+
+
+def test_uncacheable_sprites_spilled(monkeypatch):
+	expected = write_grf(1)
+	spilled = []
+	add = sys.modules['grf.grf']._SpilledData.add
+
+	def counting_add(self, data):
+		spilled.append(len(data))
+		return add(self, data)
+
+	monkeypatch.setattr(sys.modules['grf.grf'], 'KEPT_SPRITE_DATA_BYTES', 0)
+	monkeypatch.setattr(sys.modules['grf.grf']._SpilledData, 'add', counting_add)
+	assert write_grf(1) == expected
+	assert write_grf(2) == expected
+	# Only the image sprite isn't cacheable
+	assert len(spilled) == 2
+
+
+def test_duplicate_sprites_encoded_once():
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_newgrf(tmp)
+		png = make_png(os.path.join(tmp, 'sprites.png'), 32, 64)
+		image = Image.open(png.path)
+		g.add(grf.Action1(feature=grf.TRAIN, set_count=2, sprite_count=2))
+		for i in range(4):
+			# Uncacheable so only pixel data can tell they're the same
+			g.add(grf.ImageSprite(image, xofs=-16, yofs=-40 + i % 2))
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, clean_build=True)
+		assert g._context.timer.num_skipped == 2
+		with open(grf_file, 'rb') as f:
+			data = f.read()
+		g.write(grf_file, clean_build=True, jobs=2)
+		with open(grf_file, 'rb') as f:
+			assert f.read() == data
+
+
+def test_memory_budgeted_enumeration():
+	with tempfile.TemporaryDirectory() as tmp:
+		sheets = []
+		for i in range(4):
+			path = os.path.join(tmp, f'sheet{i}.png')
+			Image.new('RGBA', (64, 64), (i, 0, 0, 255)).save(path)
+			sheets.append(grf.ImageFile(path))
+		budget = 2 * sheets[0].get_loaded_size()
+		assert budget == 2 * 64 * 64 * 4
+		g = make_newgrf(tmp, max_loaded_bytes=budget)
+		# Sprites interleave sheets, some use two sheets at once
+		g.add(grf.Action1(feature=grf.TRAIN, set_count=1, sprite_count=8))
+		for i in range(8):
+			sprite = grf.FileSprite(sheets[i % 4], 0, 0, 16, 16 + i)
+			if i % 3 == 0:
+				sprite = grf.WithMask(sprite, grf.FileSprite(sheets[(i + 1) % 4], 0, 0, 16, 16 + i, bpp=grf.BPP_8))
+			g.add(sprite)
+
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, clean_build=True)
+		assert g._context.num_sprites == 8
+
+		# Check the plan directly
+		sprites = g.resolve_refs(g.generate_sprites())
+		sprite_map = {r: r for s in sprites if isinstance(s, grf.ResourceAction) for r in s.get_resources()}
+		order = g._enumerate_sprites_budgeted(sprites, sprite_map, set())
+		assert sorted(s.sprite_id for s, _, _ in order) == list(range(1, len(order) + 1))
+		loaded = set()
+		for s, load_files, unload_files in order:
+			loaded.update(load_files or ())
+			needed = [f for f in s.get_resource_files() if isinstance(f, grf.LoadedResourceFile)]
+			assert all(f in loaded for f in needed)
+			assert sum(f.get_loaded_size() for f in loaded) <= max(budget, sum(f.get_loaded_size() for f in needed))
+			loaded.difference_update(unload_files or ())
+		assert not loaded
+
+
+def test_merge_identical_actions():
+	def make_switch(result):
+		return grf.Switch(code='current_callback', ranges={0x36: result}, default=0)
+
+	def make():
+		g = grf.BaseNewGRF()
+		# Identical subgraphs: switch -> switch -> callback result
+		branches = [grf.Switch(code='var(0x42, shift=0, and=0xff)', ranges={1: make_switch(5)}, default=make_switch(6)) for _ in range(3)]
+		root = grf.Switch(feature=grf.TRAIN, code='var(0x43, shift=0, and=0xff)', ranges={i: b for i, b in enumerate(branches)}, default=make_switch(5))
+		g.add(grf.Action3(feature=grf.TRAIN, ids=[0], maps={}, default=root))
+		return g
+
+	g = make()
+	plain = g.resolve_refs(g.generate_sprites())
+
+	g = make()
+	sprites = g.merge_identical_actions(g.generate_sprites())
+	merged = g.resolve_refs(sprites)
+	assert g._context.num_actions_merged == 7
+	assert len(plain) == 12 and len(merged) == 5
+	root = merged[-2]
+	assert len({r.ref.ref_id for r in root._ranges}) == 1
+	branch = root._ranges[0].ref
+	assert root.default is branch._ranges[0].ref
+	# Every action is still defined before it's used
+	for i, s in enumerate(merged):
+		if isinstance(s, grf.ReferencingAction):
+			for r in s.get_refs():
+				if isinstance(r, grf.ReferenceableAction):
+					assert any(r is x for x in merged[:i])
+
+
+def test_resolve_deep_reference_chain():
+	# Reusing explicit ids makes the chain depth unlimited, resolution must not depend on recursion
+	depth = sys.getrecursionlimit() * 3
+	top = grf.Switch(code='1', ranges={}, default=grf.CB(0), ref_id=0)
+	chain = [top]
+	for i in range(1, depth):
+		top = grf.Switch(code='1', ranges={}, default=top, ref_id=i % 2)
+		chain.append(top)
+	g = grf.BaseNewGRF()
+	res = g.resolve_refs([grf.Action3(feature=grf.TRAIN, ids=[0], maps={}, default=top)])
+	assert len(res) == depth + 1
+	assert all(a is b for a, b in zip(res, chain))
+	assert all(s.feature == grf.TRAIN for s in chain)
+
+
+def test_flatten_switch_chains():
+	def make():
+		g = grf.BaseNewGRF()
+		forward = grf.Switch(code='var(0x42, shift=0, and=0xff)', ranges={1: 5}, default=5)
+		properties = grf.Switch(code='extra_callback_info1_byte', ranges={0x09: 100, 0x14: forward}, default=0)
+		last_result = grf.Switch(code='last_computed_result', ranges={}, default=1)
+		root = grf.Switch(
+			feature=grf.TRAIN,
+			code='current_callback',
+			ranges={0x36: properties, 0x10: grf.Switch(code='current_callback', ranges={0x10: 7}, default=8)},
+			default=grf.Switch(code='var(0x43, shift=0, and=0xff)', ranges={0: last_result}, default=last_result),
+		)
+		g.add(grf.Action3(feature=grf.TRAIN, ids=[0], maps={}, default=root))
+		return g, root
+
+	g, root = make()
+	g.flatten_switch_chains(g.generate_sprites())
+	sprites = g.resolve_refs(g.generate_sprites())
+	assert len(sprites) == 4
+	assert root.code == '(current_callback) * 256 + (extra_callback_info1_byte)'
+	assert [(r.low, r.high, r.ref) for r in root._ranges] == [(0x3609, 0x3609, 100), (0x3614, 0x3614, 5), (0x3600, 0x3608, 0), (0x360a, 0x3613, 0), (0x3615, 0x36ff, 0), (0x1000, 0x10ff, 7)]
+	# Switch before the one that reads its result can't be skipped
+	assert root.default.code == 'var(0x43, shift=0, and=0xff)'
+	assert g._context.switch_hops_eliminated == {grf.TRAIN: 3}
+
+
+def test_incremental_rebuild():
+	with tempfile.TemporaryDirectory() as tmp:
+		g = make_newgrf(tmp)
+		png = make_png(os.path.join(tmp, 'sprites.png'), 64, 64)
+		add_file_sprites(g, png, 2)
+		add_file_sprites(g, make_png(os.path.join(tmp, 'other.png'), 32, 64, seed=1), 1)
+		grf_file = os.path.join(tmp, 'test.grf')
+		g.write(grf_file, keep_build=True)
+
+		# Second sprite becomes a duplicate of the first one, only sprites of the changed file are encoded
+		png_path = png.path
+		rgba = np.array(Image.open(png_path))
+		rgba[:, 32:64] = rgba[:, :32]
+		Image.fromarray(rgba, mode='RGBA').save(png_path)
+		st = os.stat(png_path)
+		os.utime(png_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+		g.rebuild(grf_file, [png_path])
+		assert g._context.num_sprites == 2
+		assert g._context.num_duplicate == 1
+		with open(grf_file, 'rb') as f:
+			data = f.read()
+		g.write(grf_file)
+		assert g._context.num_cached == 3
+		with open(grf_file, 'rb') as f:
+			assert f.read() == data
+
+		# Build wasn't kept so it's a full one
+		g.rebuild(grf_file, [png_path])
+		assert g._context.num_sprites == 3
+
+